@@ -5,13 +5,15 @@ function elapse(){
 
 echo "准备开始指标评测..."
 
-DATA_FILE=data/`ls -1rt data/|grep factor|tail -n 1`
-PCT_MODEL_FILE=model/`ls -1rt model/|grep pct_ridge|tail -n 1`
-WINLOSS_MODEL_FILE=model/`ls -1rt model/|grep winloss|tail -n 1`
+# 从模型仓库里找标签为latest的模型(可以用第一个参数指定其他标签，如prod)，数据用训练收益模型时的数据
+TAG=${1:-latest}
+PCT_MODEL_FILE=`python -m mlstock.ml.model_registry path -t pct -g $TAG` || exit 1
+WINLOSS_MODEL_FILE=`python -m mlstock.ml.model_registry path -t winloss -g $TAG` || exit 1
+DATA_FILE=`python -m mlstock.ml.model_registry data -t pct -g $TAG` || exit 1
 
-echo "  使用最新的数据文件：$DATA_FILE"
-echo "  使用最新的收益模型：$PCT_MODEL_FILE"
-echo "  使用最新的涨跌模型：$WINLOSS_MODEL_FILE"
+echo "  使用的数据文件：$DATA_FILE"
+echo "  使用的收益模型[$TAG]：$PCT_MODEL_FILE"
+echo "  使用的涨跌模型[$TAG]：$WINLOSS_MODEL_FILE"
 
 SECONDS=0
 python -m mlstock.ml.evaluate \
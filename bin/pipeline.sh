@@ -3,13 +3,22 @@
 # 后来发现，这样会很不灵活，比如我想调试、或者重新生成模型，都变得困难，而且，当跑全数据的时候，整个过程极其漫长，
 # 所以，就拆成了目前的几段分别做的：prepare_data.py, train.py, evaluate.py, backtest.py,
 # 然后用这个批处理，来串起来，实现我之前想的一键式训练至回测过程。
+#
+# 现在改成了用 mlstock.ml.pipeline 来串：每个阶段都会落盘checkpoint（data/pipeline/），
+# 参数和上游数据没有变化的阶段会被跳过，失败后重跑会从失败的阶段继续，也可以用 -f 指定从某个阶段开始重跑。
 # 运行：
 #   bin/pipeline.sh
 #   调试模式：bin/pipeline.sh 50 # 仅仅使用50只股票的数据
+#   从清洗阶段重跑：bin/pipeline.sh 50 -f clean
 #
 # -----------------------------------------------------------------------------------------------
 
-. bin/prepare_factor.sh $1 # $1 是训练数据的行数，调试时候使用，正式运行不用
-. bin/train.sh all
-. bin/evaluate.sh
-. bin/backtest.sh
\ No newline at end of file
+if [ "$1" != "" ]
+then
+  echo "[ 调试模式 ]"
+  NUM=$1
+  shift
+  python -m mlstock.ml.pipeline -in -s 20080101 -e 20220901 -sp 20190101 -n $NUM "$@"
+else
+  python -m mlstock.ml.pipeline -in -s 20080101 -e 20220901 -sp 20190101
+fi
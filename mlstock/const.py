@@ -1,9 +1,17 @@
 EALIEST_DATE='20080101'
 STOCK_IPO_YEARS = 1 # 至少上市1年的股票
 CONF_PATH = "conf/config.yml"
+FACTOR_SELECTION_PATH = "conf/factor_selection.json" # 精简后的因子列表(research/factor_correlation生成)，存在的话训练、预测只用这些因子
 RESERVED_PERIODS = 50 # 预留50周的数据,目前看到的需要最长预留的是MACD:35，但是中间有各种假期、节日啥的，所以，预留40不够，改到50了
 CODE_DATE = ['ts_code','trade_date'] # 定义一个最常用的取得数据集的 ts_code和 trade_date 的列名
 TARGET = ['target']
+# 横截面正交化的因子组(factor_service.clean_factors的orthogonalize)，组内的顺序是Gram-Schmidt的顺序
+ORTHOGONAL_GROUPS = {
+    'turnover_return': ['turnover_return_1w', 'turnover_return_3w', 'turnover_return_6w', 'turnover_return_12w'],
+    'return': ['return_1w', 'return_3w', 'return_6w', 'return_12w'],
+    'eps': ['basic_eps', 'diluted_eps']
+}
+TARGET_HORIZONS = [1] # 预测目标的周期（周），可以同时生成多个周期的，如[1,2,4,12]，1周的列名是target，N周的是target_Nw
 TRAIN_TEST_SPLIT_DATE = '20190101' # 用来分割Train和Test的日期
 BASELINE_INDEX_CODE = "000300.SH" # 用于计算对比用的基准指数代码，目前是沪深300
 TOP_30 = 30
@@ -194,5 +194,11 @@ class DataSource:
         df = pd.read_sql(sql, self.db_engine)
         return df
 
-    def limit_list(self):
-        return pd.read_sql(f'select * from limit_list', self.db_engine)
+    def limit_list(self, start_date=None, end_date=None):
+        """涨跌停列表，只需要回测区间的，不传日期为全表"""
+        if start_date is None and end_date is None:
+            return pd.read_sql(f'select * from limit_list', self.db_engine)
+        conditions = []
+        if start_date: conditions.append(f'trade_date>="{start_date}"')
+        if end_date: conditions.append(f'trade_date<="{end_date}"')
+        return pd.read_sql(f'select * from limit_list where {" and ".join(conditions)}', self.db_engine)
@@ -5,7 +5,6 @@ import os.path
 import time
 
 import pandas as pd
-import statsmodels.formula.api as sm
 
 from mlstock.factors.factor import ComplexMergeFactor
 from mlstock.factors.fama import fama_model
@@ -98,6 +97,8 @@ class FF3ResidualStd(ComplexMergeFactor):
         :param df_fama: 按照时间序列，所有股票共享的fama-french的三个因子，每周3个值，N期
         :return: 返回的一个每只股票的特异性收益率的时间序列
         """
+        import statsmodels.formula.api as sm
+
         start_time = time.time()
         stock_code = df_one_stock_daily.name  # 保留一下股票名称，因为下面的merge后，就会消失
         # 细节：1个时间截面上，的所有股票，共享fama的3因子数值
@@ -157,7 +158,6 @@ class FF3ResidualStd(ComplexMergeFactor):
 
 # python -m mlstock.factors.ff3_residual_std
 if __name__ == '__main__':
-    from mlstock.data import data_filter
     from mlstock.data import data_loader, data_filter
     from mlstock.data.datasource import DataSource
     from mlstock.data.stock_info import StocksInfo
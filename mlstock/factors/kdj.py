@@ -1,4 +1,3 @@
-import talib
 import pandas as pd
 from mlstock.factors.factor import SimpleFactor
 
@@ -21,6 +20,7 @@ class KDJ(SimpleFactor):
         return "KDJ"
 
     def calculate(self, stock_data):
+        import talib
         df_weekly = stock_data.df_weekly
         K, D = talib.STOCH(
             df_weekly.high,
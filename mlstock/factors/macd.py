@@ -1,4 +1,3 @@
-import talib as ta
 from .factor import SimpleFactor
 
 fastperiod = 12
@@ -27,6 +26,7 @@ class MACD(SimpleFactor):
         return df_weekly.groupby('ts_code').close.apply(self.__macd)
 
     def __macd(self, x):
+        import talib as ta
 
         macd, dea, dif = ta.MACD(x,
                                  fastperiod=fastperiod,
@@ -1,5 +1,3 @@
-import talib
-
 from mlstock.factors.factor import SimpleFactor
 
 PERIOD = 20
@@ -32,4 +30,5 @@ class RSI(SimpleFactor):
 
     # psy 20日
     def rsi(self, x, period=PERIOD):
+        import talib
         return talib.RSI(x, timeperiod=period)
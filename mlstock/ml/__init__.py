@@ -1,5 +1,3 @@
-from mlstock.ml.data import factor_service
-
 import logging
 
 from mlstock.utils import utils
@@ -8,6 +6,9 @@ logger = logging.getLogger(__name__)
 
 
 def load_and_filter_data(data_path, start_date, end_date):
+    # factor_service会import数据库、所有的因子等，用到时才import，mlstock.ml下的模块(命令行入口)启动快
+    from mlstock.ml.data import factor_service
+
     # 加载数据
     utils.check_file_path(data_path)
 
@@ -3,15 +3,13 @@ import logging
 import time
 
 import joblib
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import numpy as np
 from pandas import DataFrame
 
 from mlstock.const import TOP_30
 from mlstock.data.datasource import DataSource
 from mlstock.ml import load_and_filter_data
-from mlstock.ml.backtests import backtest_simple, backtest_backtrader, backtest_deliberate
+from mlstock.ml.backtests import backtest_simple, backtest_deliberate, plotting
 from mlstock.ml.data import factor_conf
 from mlstock.ml.backtests.metrics import metrics
 from mlstock.utils import utils
@@ -19,7 +17,8 @@ from mlstock.utils import utils
 logger = logging.getLogger(__name__)
 
 
-def main(type, data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names):
+def main(type, data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names, engine='broker',
+         predictions_path=None, is_plot=True, save_path=None):
     """
     回测
     :param data_path: 因子数据文件的路径
@@ -28,16 +27,23 @@ def main(type, data_path, start_date, end_date, model_pct_path, model_winloss_pa
     :param model_pct_path: 回测用的预测收益率的模型路径
     :param model_winloss_path: 回测用的，预测收益率的模型路径
     :param factor_names: 因子们的名称，用于过滤预测的X
+    :param engine: deliberate回测用的引擎，broker|vectorized
+    :param predictions_path: 预先算好的预测结果（如walk-forward的样本外预测），提供了就不用模型预测了
+    :param is_plot: 是否画回测图(simple和deliberate)，在后台进程里画，需要调用plotting.wait()等待画完
+    :param save_path: 保存组合每周净值(df_portfolio)的csv路径(simple和deliberate)，None为不保存
     :return:
     """
     if type == 'simple':
-        return backtest_simple.main(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names)
+        return backtest_simple.main(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names,
+                                    predictions_path, is_plot, save_path)
 
     if type == 'deliberate':
         return backtest_deliberate.main(data_path, start_date, end_date, model_pct_path, model_winloss_path,
-                                        factor_names)
+                                        factor_names, engine, predictions_path, is_plot, save_path)
 
     if type == 'deliberate':
+        # backtrader、Bokeh很重，用到时才import
+        from mlstock.ml.backtests import backtest_backtrader
         return backtest_backtrader.main(data_path, start_date, end_date, model_pct_path, model_winloss_path,
                                         factor_names)
 
@@ -46,12 +52,24 @@ def main(type, data_path, start_date, end_date, model_pct_path, model_winloss_pa
 
 """
 python -m mlstock.ml.backtest \
--t deliberate \
+-t deliberate -p -o data/df_portfolio.csv \
+-s 20190101 -e 20220901 \
+-mp model/pct_ridge_20220902112320.model \
+-mw model/winloss_xgboost_20220902112813.model \
+-d data/factor_20080101_20220901_2954_1299032__industry_neutral_20220902112049.csv
+
+python -m mlstock.ml.backtest \
+-t deliberate -en vectorized \
 -s 20190101 -e 20220901 \
 -mp model/pct_ridge_20220902112320.model \
 -mw model/winloss_xgboost_20220902112813.model \
 -d data/factor_20080101_20220901_2954_1299032__industry_neutral_20220902112049.csv
 
+python -m mlstock.ml.backtest \
+-t deliberate -en vectorized \
+-s 20190101 -e 20220901 \
+-pr data/oos_predictions_20140103_20220826_20220903120000.csv
+
 python -m mlstock.ml.backtest \
 -t simple \
 -s 20080101 -e 20190101 \
@@ -71,6 +89,10 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--data', type=str, default=None, help="数据文件")
     parser.add_argument('-mp', '--model_pct', type=str, default=None, help="收益率模型")
     parser.add_argument('-mw', '--model_winloss', type=str, default=None, help="涨跌模型")
+    parser.add_argument('-pr', '--predictions', type=str, default=None, help="预先算好的预测结果，如walk-forward的样本外预测")
+    parser.add_argument('-en', '--engine', type=str, default="broker", help="deliberate回测的引擎：broker|vectorized")
+    parser.add_argument('-p', '--plot', action='store_true', default=False, help="是否画回测图")
+    parser.add_argument('-o', '--output', type=str, default=None, help="保存组合每周净值的csv路径，默认不保存")
 
     args = parser.parse_args()
 
@@ -84,5 +106,10 @@ if __name__ == '__main__':
         args.end_date,
         args.model_pct,
         args.model_winloss,
-        factor_names)
+        factor_names,
+        args.engine,
+        args.predictions,
+        args.plot,
+        args.output)
+    plotting.wait()  # 等后台的画图进程画完
     utils.time_elapse(start_time,"整个回测过程")
@@ -17,7 +17,7 @@ from mlstock.ml.backtests import select_top_n, predict
 from mlstock.ml.backtests.ml_strategy import MachineLearningStrategy
 from mlstock.ml.data import factor_conf
 from mlstock.utils import utils, df_utils
-from mlstock.utils.utils import AStockPlotScheme
+from mlstock.utils.plot_utils import AStockPlotScheme
 
 logger = logging.getLogger(__name__)
 
@@ -58,7 +58,7 @@ def main(data_path, start_date, end_date, model_pct_path, model_winloss_path, fa
 
     df_data = predict(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names)
     df_daily = datasource.daily(df_data.ts_codes,start_date, end_date)
-    df_limit = datasource.limit_list()
+    df_limit = datasource.limit_list(start_date, end_date)
     df_selected_stocks = select_top_n(df_data, df_limit)
 
     # 加载股票数据到脑波
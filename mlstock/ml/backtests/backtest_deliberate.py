@@ -2,18 +2,21 @@ import logging
 
 from mlstock.const import TOP_30
 from mlstock.data.datasource import DataSource
-from mlstock.ml.backtests import predict, select_top_n, plot, timing
+from mlstock.ml.backtests import predict, select_top_n, plotting
 from mlstock.ml.backtests.broker import Broker
 from mlstock.ml.backtests.metrics import metrics
+from mlstock.ml.backtests.vectorized import VectorizedBroker
 
 logger = logging.getLogger(__name__)
 
 
-def load_datas(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names):
+def load_datas(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names,
+               predictions_path=None):
     datasource = DataSource()
 
-    df_data = predict(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names)
-    df_limit = datasource.limit_list()
+    df_data = predict(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names,
+                      predictions_path)
+    df_limit = datasource.limit_list(start_date, end_date)
     df_index = datasource.index_weekly('000001.SH', start_date, end_date)
     ts_codes = df_data.ts_code.unique().tolist()
     df_daily = datasource.daily(ts_codes, start_date, end_date, adjust='')
@@ -23,15 +26,24 @@ def load_datas(data_path, start_date, end_date, model_pct_path, model_winloss_pa
     return df_data, df_daily, df_index, df_baseline, df_limit, df_calendar
 
 
-def run_broker(df_data, df_daily, df_index, df_baseline, df_limit, df_calendar,
-               start_date, end_date, factor_names,
-               top_n, df_timing):
-    df_selected_stocks = select_top_n(df_data, df_limit, top_n)
-
-    broker = Broker(df_selected_stocks, df_daily, df_calendar, conservative=False, df_timing=df_timing)
+def backtest_portfolio(df_selected_stocks, df_daily, df_index, df_baseline, df_calendar, df_timing=None,
+                       conservative=False, engine='broker', **commission_rates):
+    """
+    对选好的股票跑回测，得到周频的组合收益
+    :param engine: broker|vectorized，broker是逐日逐笔的撮合，vectorized是基于价格矩阵的向量化回测，快得多
+    :param commission_rates: buy_commission_rate、sell_commission_rate，不传用broker里的默认费率
+    :return: df_portfolio，佣金总额
+    """
+    if engine == 'broker':
+        broker = Broker(df_selected_stocks, df_daily, df_calendar, conservative=conservative, df_timing=df_timing,
+                        **commission_rates)
+    elif engine == 'vectorized':
+        broker = VectorizedBroker(df_selected_stocks, df_daily, df_calendar, conservative=conservative,
+                                  df_timing=df_timing, **commission_rates)
+    else:
+        raise ValueError(f"无效的回测引擎：{engine}")
     broker.execute()
     df_portfolio = broker.df_values
-    df_portfolio.sort_values('trade_date')
 
     # 只筛出来周频的市值来
     df_portfolio = df_baseline.merge(df_portfolio, how='left', on='trade_date')
@@ -49,24 +61,43 @@ def run_broker(df_data, df_daily, df_index, df_baseline, df_limit, df_calendar,
         df_portfolio[['next_pct_chg', 'next_pct_chg_baseline']].apply(lambda x: (x + 1).cumprod() - 1)
 
     df_portfolio = df_portfolio[~df_portfolio.cumulative_pct_chg.isna()]
+    return df_portfolio, broker.total_commission
+
 
-    save_path = 'data/plot_{}_{}_top{}.jpg'.format(start_date, end_date, top_n)
-    plot(df_portfolio, save_path)
+def run_broker(df_data, df_daily, df_index, df_baseline, df_limit, df_calendar,
+               start_date, end_date, factor_names,
+               top_n, df_timing, engine='broker', is_plot=True, save_path=None):
+    """
+    :param engine: broker|vectorized
+    :param is_plot: 是否画图，画图是在后台进程里画的，需要调用plotting.wait()等待画完
+    :param save_path: 保存组合每周净值(df_portfolio)的csv路径，None为不保存
+    """
+    df_selected_stocks = select_top_n(df_data, df_limit, top_n)
+
+    df_portfolio, total_commission = backtest_portfolio(df_selected_stocks, df_daily, df_index, df_baseline,
+                                                        df_calendar, df_timing, engine=engine)
 
     # 计算各项指标
-    logger.info("佣金总额：%.2f", broker.total_commission)
-    metrics(df_portfolio)
+    logger.info("佣金总额：%.2f", total_commission)
+    result = metrics(df_portfolio, save_path=save_path)
+
+    if is_plot:
+        plot_path = 'data/plot_{}_{}_top{}.jpg'.format(start_date, end_date, top_n)
+        plotting.plot_async(df_portfolio, plot_path)
+    return result
 
 
-def main(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names):
+def main(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names, engine='broker',
+         predictions_path=None, is_plot=True, save_path=None):
     """
     先预测出所有的下周收益率、下周涨跌 => df_data，
     然后选出每周的top30 => df_selected_stocks，
     然后使用Broker，来遍历每天的交易，每周进行调仓，并，记录下每周的股票+现价合计价值 => df_portfolio
-    最后计算出next_pct_chg、cumulative_pct_chg，并画出plot，计算metrics
+    最后计算出next_pct_chg、cumulative_pct_chg，计算metrics，并画出plot(is_plot)
     """
     df_data, df_daily, df_index, df_baseline, df_limit, df_calendar = \
-        load_datas(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names)
+        load_datas(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names,
+                   predictions_path)
 
     """
     # df_timing = timing.ma(df_index)
@@ -85,5 +116,5 @@ def main(data_path, start_date, end_date, model_pct_path, model_winloss_path, fa
     # 去掉择时了
     df_timing = None
 
-    run_broker(df_data, df_daily, df_index, df_baseline, df_limit, df_calendar, start_date, end_date, factor_names,
-               TOP_30, df_timing)
+    return run_broker(df_data, df_daily, df_index, df_baseline, df_limit, df_calendar, start_date, end_date,
+                      factor_names, TOP_30, df_timing, engine, is_plot, save_path)
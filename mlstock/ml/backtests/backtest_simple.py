@@ -3,7 +3,7 @@ import logging
 
 from mlstock.const import TOP_30
 from mlstock.data.datasource import DataSource
-from mlstock.ml.backtests import plot, predict, select_top_n
+from mlstock.ml.backtests import predict, select_top_n, plotting
 from mlstock.ml.backtests.metrics import metrics
 from mlstock.ml.data import factor_conf
 from mlstock.utils import utils
@@ -11,7 +11,8 @@ from mlstock.utils import utils
 logger = logging.getLogger(__name__)
 
 
-def main(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names):
+def main(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names, predictions_path=None,
+         is_plot=True, save_path=None):
     """
     回测
     :param data_path: 因子数据文件的路径
@@ -20,13 +21,17 @@ def main(data_path, start_date, end_date, model_pct_path, model_winloss_path, fa
     :param model_pct_path: 回测用的预测收益率的模型路径
     :param model_winloss_path: 回测用的，预测收益率的模型路径
     :param factor_names: 因子们的名称，用于过滤预测的X
+    :param predictions_path: 预先算好的预测结果的路径（如walk-forward的样本外预测）
+    :param is_plot: 是否画图，画图是在后台进程里画的，需要调用plotting.wait()等待画完
+    :param save_path: 保存组合每周收益(df_portfolio)的csv路径，None为不保存
     :return:
     """
 
     datasource = DataSource()
 
-    df_data = predict(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names)
-    df_limit = datasource.limit_list()
+    df_data = predict(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names,
+                      predictions_path)
+    df_limit = datasource.limit_list(start_date, end_date)
 
     df_selected_stocks = select_top_n(df_data, df_limit,TOP_30)
     df_selected_stocks = df_selected_stocks.reset_index(drop=True)
@@ -46,11 +51,12 @@ def main(data_path, start_date, end_date, model_pct_path, model_winloss_path, fa
 
     df_portfolio.sort_values('trade_date')
 
-    # 画出回测图
-    plot(df_portfolio, f"data/plot_simple_{start_date}_{end_date}")
-
     # 计算各项指标
-    metrics(df_portfolio)
+    result = metrics(df_portfolio, save_path=save_path)
+
+    # 画出回测图
+    if is_plot: plotting.plot_async(df_portfolio, f"data/plot_simple_{start_date}_{end_date}")
+    return result
 
 
 """
@@ -76,6 +82,8 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--data', type=str, default=None, help="数据文件")
     parser.add_argument('-mp', '--model_pct', type=str, default=None, help="收益率模型")
     parser.add_argument('-mw', '--model_winloss', type=str, default=None, help="涨跌模型")
+    parser.add_argument('-p', '--plot', action='store_true', default=False, help="是否画回测图")
+    parser.add_argument('-o', '--output', type=str, default=None, help="保存组合每周收益的csv路径，默认不保存")
 
     args = parser.parse_args()
 
@@ -86,4 +94,7 @@ if __name__ == '__main__':
          args.end_date,
          args.model_pct,
          args.model_winloss,
-         factor_names)
+         factor_names,
+         is_plot=args.plot,
+         save_path=args.output)
+    plotting.wait()  # 等后台的画图进程画完
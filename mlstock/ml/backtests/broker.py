@@ -1,9 +1,10 @@
 import logging
 import math
 
+import numpy as np
 from pandas import DataFrame
 
-from mlstock.utils.data_utils import next_trade_day
+from mlstock.ml.backtests.price_panel import PricePanel
 
 logger = logging.getLogger(__name__)
 
@@ -12,7 +13,16 @@ buy_commission_rate = 0.00025 + 0.0002  # 券商佣金、过户费
 sell_commission_rate = 0.00025 + 0.0002 + 0.001  # 券商佣金、过户费、印花税
 
 
+def distribute_cash(total_cash, buy_stock_num, commission_rate):
+    """
+    剩余的现金平分给剩余待买的股票，预留出买入的佣金，买完加上佣金不会超出现金
+    """
+    return math.floor(total_cash / (buy_stock_num * (1 + commission_rate)))
+
+
 class Trade:
+    __slots__ = ['ts_code', 'target_date', 'action', 'actual_date']
+
     def __init__(self, ts_code, target_date, action):
         self.ts_code = ts_code
         self.target_date = target_date
@@ -21,6 +31,8 @@ class Trade:
 
 
 class Position:
+    __slots__ = ['ts_code', 'position', 'create_date', 'initial_value']
+
     def __init__(self, ts_code, position, create_date, initial_value):
         self.ts_code = ts_code
         self.position = position
@@ -29,77 +41,90 @@ class Position:
 
 
 class Broker:
-
-    def __init__(self, df_selected_stocks, df_daily, df_calendar, conservative=False, df_timing=None):
+    """
+    逐日撮合的回测：
+    - 持仓、待买、待卖都是按ts_code索引的dict，判断在不在仓位/卖单中、撤掉买单，都是O(1)的，
+      每天的处理量只和当天的变化（挂单数、持仓数）有关
+    - 选股结果、择时、下一个交易日，都在构造时预先算好成dict，不用每个调仓日再去过滤DataFrame
+    - 每天的市值先记到list里，执行完再一次性生成df_values
+    """
+
+    def __init__(self, df_selected_stocks, df_daily, df_calendar, conservative=False, df_timing=None,
+                 buy_commission_rate=buy_commission_rate, sell_commission_rate=sell_commission_rate):
         self.cash = cash
-        self.daily_trade_dates = df_daily.trade_date.unique()
-        self.df_daily = df_daily.set_index(['trade_date', 'ts_code'])  # 设索引是为了加速，太慢了否则
+        # 价格面板，只需要被选中过的股票，按下标查价格，比df_daily.loc[(date,code)]快几千倍
+        self.panel = PricePanel(df_daily, codes=df_selected_stocks.ts_code.unique())
+        self.daily_trade_dates = self.panel.dates
         self.df_selected_stocks = df_selected_stocks
-        self.weekly_trade_dates = df_selected_stocks.trade_date.unique()
         self.df_calendar = df_calendar
         self.conservative = conservative
         self.total_commission = 0
         self.df_timing = df_timing
+        self.buy_commission_rate = buy_commission_rate
+        self.sell_commission_rate = sell_commission_rate
+
+        # 调仓日 => 要买的股票（保持原顺序，去重）
+        self.selected_stocks = {date: list(dict.fromkeys(codes)) for date, codes in
+                                df_selected_stocks.groupby('trade_date', sort=False).ts_code}
+        # 调仓日 => 下一个交易日
+        calendar = np.sort(df_calendar.values)
+        next_positions = np.searchsorted(calendar, list(self.selected_stocks.keys()), side='right')
+        self.next_trade_dates = {date: calendar[pos] if pos < len(calendar) else None
+                                 for date, pos in zip(self.selected_stocks.keys(), next_positions)}
+        # 调仓日 => 是否适合交易
+        self.transactions = {} if df_timing is None else dict(zip(df_timing.trade_date, df_timing.transaction))
 
         # 存储数据的结构
         self.positions = {}
-        self.trades = []
+        self.buy_trades = {}
+        self.sell_trades = {}
+        self.values = []
         self.df_values = DataFrame()
 
     def distribute_cash(self):
         if self.cash <= 0:
             return None
-        buy_stock_num = self.get_buy_trade_num()
-        cash4stock = math.floor(self.cash / buy_stock_num)
-        return cash4stock
+        return distribute_cash(self.cash, self.get_buy_trade_num(), self.buy_commission_rate)
 
     def sell(self, trade, trade_date):
-        try:
-            df_stock = self.df_daily.loc[(trade_date, trade.ts_code)]
-        except KeyError:
+        i, j = self.panel.locate(trade_date, trade.ts_code)
+        if not self.panel.is_valid(i, j):
             logger.warning("股票[%s]没有在[%s]无数据，无法卖出，只能延后", trade.ts_code, trade_date)
             return False
 
-        # assert len(df_stock) == 1, f"根据{trade_date}和{trade.ts_code}筛选出多于1行的数据：{len(df_stock)}行"
-
         if self.conservative:
-            price = df_stock.low
+            price = self.panel.low[i, j]
         else:
-            price = df_stock.open
+            price = self.panel.open[i, j]
         position = self.positions[trade.ts_code]
         amount = price * position.position
-        commission = amount * sell_commission_rate
+        commission = amount * self.sell_commission_rate
         self.total_commission += commission
 
         # 更新头寸,仓位,交易历史
-        self.trades.remove(trade)
+        del self.sell_trades[trade.ts_code]
         self.cashin(amount - commission)
         self.positions.pop(trade.ts_code, None)  # None可以防止pop异常
         _return = (amount - position.initial_value) / position.initial_value
 
-        trade.trade_date = trade_date
+        trade.actual_date = trade_date
 
         logger.debug("[%s]于[%s]以[%.2f]卖出,买入=>卖出[%.2f=>%.2f],佣金[%.2f],收益[%.1f%%]",
                      trade.ts_code, trade_date, price, position.initial_value, amount, commission, _return * 100)
         return True
 
     def buy(self, trade, trade_date):
-        # 使用try/exception + 索引loc是为了提速，直接用列，或者防止KeyError的intersection，都非常慢， 60ms vs 3ms，20倍关系
-        # 另外，trade_date列是否是str还是date/int对速度影响不大
-        # df_stock = self.df_daily.loc[self.df_daily.index.intersection([(trade_date, trade.ts_code)])]
-        try:
-            df_stock = self.df_daily.loc[(trade_date, trade.ts_code)]
-        except KeyError:
+        # 之前用try/exception + 索引loc，3ms一次，现在用价格面板的整数下标，不到1微秒
+        i, j = self.panel.locate(trade_date, trade.ts_code)
+        if not self.panel.is_valid(i, j):
             logger.warning("股票[%s]没有在[%s]无数据，无法买入，只能延后", trade.ts_code, trade_date)
             return False
 
-        # assert len(df_stock) == 1, f"根据{trade_date}和{trade.ts_code}筛选出多于1行的数据：{len(df_stock)}行"
-
         # 保守取最高价
         if self.conservative:
-            price = df_stock.high
+            price = self.panel.high[i, j]
         else:
-            price = df_stock.open
+            price = self.panel.open[i, j]
         # 看看能分到多少钱
         cash4stock = self.distribute_cash()
         if cash4stock is None:
@@ -116,13 +141,14 @@ class Broker:
         # 计算实际费用
         actual_cost = position * price
         # 计算佣金
-        commission = buy_commission_rate * actual_cost
+        commission = self.buy_commission_rate * actual_cost
         self.total_commission += commission
 
         # 更新仓位,头寸,交易历史
-        self.trades.remove(trade)
+        del self.buy_trades[trade.ts_code]
         self.positions[trade.ts_code] = Position(trade.ts_code, position, trade_date, actual_cost)
         self.cashout(actual_cost + commission)
+        trade.actual_date = trade_date
 
         logger.debug("股票[%s]已于[%s]日按照最高价[%.2f]买入%d股,买入金额[%.2f],佣金[%.2f]",
                      trade.ts_code, trade_date, price, position, actual_cost, commission)
@@ -139,39 +165,29 @@ class Broker:
         logger.debug("现金减少：%2.f=>%.2f", old, self.cash)
 
     def is_in_position(self, ts_code):
-        for position_ts_code, _ in self.positions.items():
-            if position_ts_code == ts_code: return True
-        return False
+        return ts_code in self.positions
 
     def clear_buy_trades(self):
-        self.trades = [t for t in self.trades if t.action == 'sell']
+        self.buy_trades = {}
 
     def is_in_sell_trades(self, ts_code):
-        for t in self.trades:
-            if t.action != 'sell': continue
-            if t.ts_code == ts_code: return True
-        return False
+        return ts_code in self.sell_trades
 
     def get_buy_trade_num(self):
-        return len([t for t in self.trades if t.action == 'buy'])
+        return len(self.buy_trades)
+
+    def create_sell_trade(self, ts_code, day_date, next_trade_date):
+        if self.is_in_sell_trades(ts_code):
+            logger.warning("股票[%s]已经在卖单中，可能是还未卖出，无需再创建卖单了", ts_code)
+            return
+        self.sell_trades[ts_code] = Trade(ts_code, next_trade_date, 'sell')
+        logger.debug("%s ，创建下个交易日[%s]卖单，卖出持仓股票 [%s]", day_date, next_trade_date, ts_code)
 
     def handle_adjust_day(self, day_date):
         """
         处理调仓日
         """
-        next_trade_date = next_trade_day(day_date, self.df_calendar)
-
-        if self.df_timing is not None and not self.df_timing[self.df_timing.trade_date==day_date].iloc[0].transaction:
-            logger.warning("[%s]接下来的下周不适合交易，清仓",day_date)
-            for ts_code, position in self.positions.items():
-                if self.is_in_sell_trades(ts_code):
-                    logger.warning("股票[%s]已经在卖单中，可能是还未卖出，无需再创建卖单了", ts_code)
-                    continue
-                self.trades.append(Trade(ts_code, next_trade_date, 'sell'))
-                logger.debug("%s ，创建下个交易日[%s]卖单，卖出持仓股票 [%s]", day_date, next_trade_date, ts_code)
-            return
-
-        df_buy_stocks = self.df_selected_stocks[self.df_selected_stocks.trade_date == day_date].ts_code
+        next_trade_date = self.next_trade_dates[day_date]
 
         # 到调仓日，所有的买交易都取消了，但保留卖交易(没有卖出的要持续尝试卖出)
         self.clear_buy_trades()
@@ -180,23 +196,28 @@ class Broker:
             logger.warning("无法获得[%s]的下一个交易日,不做任何调仓", day_date)
             return
 
-        logger.debug("调仓日[%s]模型建议买入%d只股票，清仓%d只股票", day_date, len(df_buy_stocks), len(self.positions))
+        if not self.transactions.get(day_date, True):
+            logger.warning("[%s]接下来的下周不适合交易，清仓", day_date)
+            for ts_code in self.positions:
+                self.create_sell_trade(ts_code, day_date, next_trade_date)
+            return
 
-        for ts_code, position in self.positions.items():
-            if ts_code in df_buy_stocks.unique():
+        buy_stocks = self.selected_stocks[day_date]
+        buy_stock_set = set(buy_stocks)
+
+        logger.debug("调仓日[%s]模型建议买入%d只股票，清仓%d只股票", day_date, len(buy_stocks), len(self.positions))
+
+        for ts_code in self.positions:
+            if ts_code in buy_stock_set:
                 logger.info("待清仓股票[%s]在本周购买列表中，无需卖出", ts_code)
                 continue
-            if self.is_in_sell_trades(ts_code):
-                logger.warning("股票[%s]已经在卖单中，可能是还未卖出，无需再创建卖单了", ts_code)
-                continue
-            self.trades.append(Trade(ts_code, next_trade_date, 'sell'))
-            logger.debug("%s ，创建下个交易日[%s]卖单，卖出持仓股票 [%s]", day_date, next_trade_date, ts_code)
+            self.create_sell_trade(ts_code, day_date, next_trade_date)
 
-        for stock in df_buy_stocks.unique():
+        for stock in buy_stocks:
             if self.is_in_position(stock):
                 logger.info("待买股票[%s]已经在仓位中，无需买入", stock)
                 continue
-            self.trades.append(Trade(stock, next_trade_date, 'buy'))
+            self.buy_trades[stock] = Trade(stock, next_trade_date, 'buy')
             logger.debug("%s ，创建下个交易日[%s]买单，买入股票 [%s]", day_date, next_trade_date, stock)
 
     def update_market_value(self, trade_date):
@@ -206,23 +227,20 @@ class Broker:
         """
         total_position_value = 0
         for ts_code, position in self.positions.items():
-            # logger.debug("查找股票[%s] %s数据", ts_code, trade_date)
-
-            try:
-                df_the_stock = self.df_daily.loc[(trade_date, ts_code)]
-                # assert len(df_the_stock) == 1, f"根据{trade_date}和{ts_code}筛选出多于1行的数据：{len(df_the_stock)}行"
-                market_value = df_the_stock.close * position.position
-            except KeyError:
+            i, j = self.panel.locate(trade_date, ts_code)
+            if self.panel.is_valid(i, j):
+                market_value = self.panel.close[i, j] * position.position
+            else:
                 logger.warning(" %s 日没有股票 %s 的数据，当天它的市值计作 0 ", trade_date, ts_code)
                 market_value = 0
 
             total_position_value += market_value
 
         total_value = total_position_value + self.cash
-        self.df_values = self.df_values.append({'trade_date': trade_date,
-                                                'total_value': total_value,
-                                                'total_position_value': total_position_value,
-                                                'cash': self.cash}, ignore_index=True)
+        self.values.append({'trade_date': trade_date,
+                            'total_value': total_value,
+                            'total_position_value': total_position_value,
+                            'cash': self.cash})
         logger.debug("%s 市值 %.2f = %d只股票市值 %.2f + 持有现金 %.2f",
                      trade_date, total_value, len(self.positions), total_position_value, self.cash)
 
@@ -230,33 +248,19 @@ class Broker:
         for day_date in self.daily_trade_dates:
             original_position_size = len(self.positions)
 
-            if day_date in self.weekly_trade_dates:
+            if day_date in self.selected_stocks:
                 logger.debug(" ================ 调仓日：%s ================", day_date)
                 self.handle_adjust_day(day_date)
 
-            is_transaction_succeeded = []
-            for trade in self.trades:
-                # 只有大于和等于交易的目标日才交易（下单是在第二天才执行）
-                if trade.target_date < day_date: continue
-                if trade.action == "buy":
-                    is_transaction_succeeded.append(self.buy(trade, day_date))
-                    continue
-                elif trade.action == "sell":
-                    is_transaction_succeeded.append(self.sell(trade, day_date))
-                    continue
-                raise ValueError(f"无效的交易类型：{trade.action}")
-
-            # 先卖
-            sell_trades = [x for x in self.trades if x.action == 'sell']
-            for trade in sell_trades:
+            # 只有到了交易的目标日才交易（调仓日下单，是在下一个交易日才执行），先卖后买
+            for trade in [t for t in self.sell_trades.values() if t.target_date <= day_date]:
                 self.sell(trade, day_date)
-
-            # 后买
-            buy_trades = [x for x in self.trades if x.action == 'buy']
-            for trade in buy_trades:
+            for trade in [t for t in self.buy_trades.values() if t.target_date <= day_date]:
                 self.buy(trade, day_date)
 
             if original_position_size != len(self.positions):
                 logger.debug("%s 日后，仓位变化，从%d=>%d 只", day_date, original_position_size, len(self.positions))
 
             self.update_market_value(day_date)
+
+        self.df_values = DataFrame(self.values)
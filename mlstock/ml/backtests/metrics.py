@@ -1,13 +1,43 @@
 from datetime import datetime
 import logging
 import numpy as np
-from empyrical import max_drawdown
+import pandas as pd
 
 from mlstock.const import RISK_FREE_ANNUALLY_RETRUN
 from mlstock.utils import utils
 
 logger = logging.getLogger(__name__)
 
+"""
+回测的各项指标。
+
+metrics_matrix是核心：输入一个 期数x策略 的收益率矩阵（每列是一个策略/参数组合），
+用numpy对所有列一起算出年化收益、波动率、夏普、最大回撤、跟踪误差、信息比率、胜率，
+参数扫描时几十上百个组合一次算完；rolling_metrics是滚动窗口的版本。
+metrics是对单个组合的df_portfolio的封装，保持原来的中文指标名。
+
+A股每年250个交易日，50个交易周，所以周频的年化系数是50。
+"""
+
+PERIODS_PER_YEAR = 50
+
+# metrics_matrix的列名 => metrics里的中文指标名
+METRIC_NAMES = {
+    'cumulative_return': '累计收益',
+    'cumulative_baseline_return': '累计基准收益',
+    'annual_return': '年化收益率',
+    'annual_active_return': '年化超额收益',
+    'volatility': '周波动率',
+    'annual_volatility': '年化波动率',
+    'sharpe': '夏普比率',
+    'max_drawdown': '最大回撤',
+    'active_max_drawdown': '超额收益最大回撤',
+    'track_error': '年化跟踪误差',
+    'information_ratio': '信息比率',
+    'annual_information_ratio': '年化信息比率',
+    'win_rate': 'PK基准胜率'
+}
+
 
 def scope(df):
     start_date = datetime.strptime(df.trade_date.min(), "%Y%m%d")
@@ -18,6 +48,102 @@ def scope(df):
     return f"{years}年{months}月{weeks}周"
 
 
+def _max_drawdown(returns):
+    """每列的最大回撤，NaN视为当期收益为0，净值从1开始算（第一期就亏也算回撤）"""
+    wealth = np.cumprod(1 + np.nan_to_num(returns), axis=0)
+    peak = np.maximum(np.maximum.accumulate(wealth, axis=0), 1)
+    return (wealth / peak - 1).min(axis=0, initial=0)
+
+
+def _annualize(cumulative_return, count, periods_per_year):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.power(cumulative_return + 1, periods_per_year / count) - 1
+
+
+def metrics_matrix(df_returns, baseline=None, periods_per_year=PERIODS_PER_YEAR,
+                   risk_free=RISK_FREE_ANNUALLY_RETRUN, save_path=None):
+    """
+    对所有的策略(列)，一次算出各项指标
+    :param df_returns: DataFrame，index是期（如trade_date），每列是一个策略的每期收益率，NaN为该期没有数据
+    :param baseline: Series，和df_returns同index的基准的每期收益率，None则不算和基准相关的指标
+    :param periods_per_year: 每年的期数，周频为50
+    :param risk_free: 年化的无风险收益率
+    :param save_path: 保存的路径，None为不保存
+    :return: DataFrame，index是策略，列是各项指标
+    """
+    returns = df_returns.to_numpy(dtype=np.float64)
+    valid = ~np.isnan(returns)
+    count = valid.sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nanmean(returns, axis=0)
+        std = np.nanstd(returns, axis=0, ddof=1)
+        cumulative_return = np.nanprod(1 + returns, axis=0) - 1
+
+        result = {
+            'periods': count,
+            'cumulative_return': cumulative_return,
+            'annual_return': _annualize(cumulative_return, count, periods_per_year),
+            'volatility': std,
+            'annual_volatility': std * np.sqrt(periods_per_year),
+            # 夏普比率 = (收益均值-无风险收益率) / 收益的标准差，年化
+            'sharpe': (mean - risk_free / periods_per_year) / std * np.sqrt(periods_per_year),
+            'max_drawdown': _max_drawdown(returns)
+        }
+
+        if baseline is not None:
+            baseline = baseline.reindex(df_returns.index).to_numpy(dtype=np.float64)[:, None]
+            # 只在策略有数据的期上比较
+            baseline = np.where(valid, baseline, np.nan)
+            active = returns - baseline
+            cumulative_baseline_return = np.nanprod(1 + baseline, axis=0) - 1
+            active_std = np.nanstd(active, axis=0, ddof=1)
+            active_count = (~np.isnan(active)).sum(axis=0)
+            result['cumulative_baseline_return'] = cumulative_baseline_return
+            # 年化超额收益：用累计收益-累计基准收益 来年化
+            result['annual_active_return'] = \
+                _annualize(cumulative_return - cumulative_baseline_return, count, periods_per_year)
+            result['active_max_drawdown'] = _max_drawdown(active)
+            result['track_error'] = active_std * np.sqrt(periods_per_year)
+            # 信息比率 = 超额收益均值 / 超额收益的标准差(不年化，和原来的metrics一致)，另外给一个年化的
+            result['information_ratio'] = np.nanmean(active, axis=0) / active_std
+            result['annual_information_ratio'] = result['information_ratio'] * np.sqrt(periods_per_year)
+            result['win_rate'] = (active > 0).sum(axis=0) / active_count
+
+    df_metrics = pd.DataFrame(result, index=df_returns.columns)
+    if save_path:
+        df_metrics.to_csv(save_path)
+        logger.info("指标保存到：%s", save_path)
+    return df_metrics
+
+
+def rolling_metrics(df_returns, window, baseline=None, periods_per_year=PERIODS_PER_YEAR,
+                    risk_free=RISK_FREE_ANNUALLY_RETRUN):
+    """
+    滚动窗口的指标（最大回撤是路径相关的，不算滚动的）
+    :param window: 窗口的期数，如50为滚动1年
+    :return: DataFrame，列是(指标, 策略)的MultiIndex，index和df_returns一样
+    """
+    rolling = df_returns.rolling(window, min_periods=window)
+    mean = rolling.mean()
+    std = rolling.std()
+    log_return = np.log1p(df_returns).rolling(window, min_periods=window).sum()
+    result = {
+        'annual_return': np.expm1(log_return * periods_per_year / window),
+        'annual_volatility': std * np.sqrt(periods_per_year),
+        'sharpe': (mean - risk_free / periods_per_year) / std * np.sqrt(periods_per_year)
+    }
+    if baseline is not None:
+        active = df_returns.sub(baseline.reindex(df_returns.index), axis=0)
+        active_rolling = active.rolling(window, min_periods=window)
+        active_std = active_rolling.std()
+        result['track_error'] = active_std * np.sqrt(periods_per_year)
+        result['information_ratio'] = active_rolling.mean() / active_std
+        result['annual_information_ratio'] = result['information_ratio'] * np.sqrt(periods_per_year)
+        result['win_rate'] = (active > 0).astype(float).where(active.notna()).rolling(window, min_periods=window).mean()
+    return pd.concat(result, axis=1)
+
+
 def annually_profit(df):
     """
     年化收益率
@@ -27,7 +153,7 @@ def annually_profit(df):
     # 累计收益
     cumulative_return = df['cumulative_pct_chg'].iloc[-1] + 1
     total_weeks = len(df)
-    return np.power(cumulative_return, 50 / total_weeks) - 1
+    return np.power(cumulative_return, PERIODS_PER_YEAR / total_weeks) - 1
 
 
 def volatility(df):
@@ -37,31 +163,33 @@ def volatility(df):
 
 def sharp_ratio(df):
     """
-    夏普比率 = 收益均值-无风险收益率 / 收益方差
+    夏普比率 = 收益均值-无风险收益率 / 收益的标准差，年化
     无风险收益率,在我国无风险收益率一般取值十年期国债收益
     """
-    return (df['next_pct_chg'].mean() - RISK_FREE_ANNUALLY_RETRUN / 50) / df['next_pct_chg'].mean()
+    return (df['next_pct_chg'].mean() - RISK_FREE_ANNUALLY_RETRUN / PERIODS_PER_YEAR) / df['next_pct_chg'].std() \
+        * np.sqrt(PERIODS_PER_YEAR)
 
 
 def max_drawback(df):
     """最大回撤"""
-    return max_drawdown(df.next_pct_chg)
+    return _max_drawdown(df[['next_pct_chg']].to_numpy(dtype=np.float64))[0]
 
 
 def annually_active_return(df):
     """年化主动收益率"""
     cumulative_active_return = df['cumulative_active_pct_chg'].iloc[-1] + 1
     total_weeks = len(df)
-    return np.power(cumulative_active_return, 50 / total_weeks) - 1
+    return np.power(cumulative_active_return, PERIODS_PER_YEAR / total_weeks) - 1
 
 
 def active_return_max_drawback(df):
     """年化主动收最大回撤"""
-    pass
+    return _max_drawdown(df[['active_pct_chg']].to_numpy(dtype=np.float64))[0]
 
 
 def annually_track_error(df):
     """年化跟踪误差"""
+    return df['active_pct_chg'].std() * np.sqrt(PERIODS_PER_YEAR)
 
 
 def information_ratio(df):
@@ -76,12 +204,17 @@ def information_ratio(df):
     return df.active_pct_chg.mean() / df.active_pct_chg.std()
 
 
+def annually_information_ratio(df):
+    """年化信息比率 = 信息比率 * √50"""
+    return information_ratio(df) * np.sqrt(PERIODS_PER_YEAR)
+
+
 def win_rate(df):
     """胜率"""
     return (df['active_pct_chg'] > 0).sum() / len(df)
 
 
-def metrics(df):
+def metrics(df, save_path=None):
     """
     :param df:
         df[
@@ -91,14 +224,13 @@ def metrics(df):
             'cumulative_pct_chg',           # 当期累计收益率
             'cumulative_pct_chg_baseline'   # 当期基准收益率
         ]
-    :param df_base:
+    :param save_path: 保存df的路径，None为不保存
     :return:
     """
     if df is not None:
-        df.to_csv("data/df_portfolio.csv")
+        if save_path: df.to_csv(save_path)
     else:
-        import pandas as pd
-        df = pd.read_csv("data/df_portfolio.csv",header=0)
+        df = pd.read_csv("data/df_portfolio.csv", header=0)
         df['trade_date'] = df['trade_date'].astype(str)
 
     assert 'next_pct_chg' in df.columns, "缺少列：next_pct_chg"
@@ -121,7 +253,10 @@ def metrics(df):
     result['周波动率'] = volatility(df)
     result['夏普比率'] = sharp_ratio(df)
     result['最大回撤'] = max_drawback(df)
+    result['超额收益最大回撤'] = active_return_max_drawback(df)
+    result['年化跟踪误差'] = annually_track_error(df)
     result['信息比率'] = information_ratio(df)
+    result['年化信息比率'] = annually_information_ratio(df)
     result['PK基准胜率'] = win_rate(df)
 
     logger.info("投资详细指标：")
@@ -132,7 +267,7 @@ def metrics(df):
     return result
 
 
-# python -m mlstock.ml.evaluate.metrics
+# python -m mlstock.ml.backtests.metrics
 if __name__ == '__main__':
     utils.init_logger(file=False)
     metrics(None)
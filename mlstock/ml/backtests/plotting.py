@@ -0,0 +1,189 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+from matplotlib import ticker
+from matplotlib.figure import Figure
+
+logger = logging.getLogger(__name__)
+
+"""
+回测的画图。
+
+之前backtests.plot每次回测都画一张300dpi、3个Y轴的图，用pyplot的全局状态，最后还plt.show()，
+参数扫描和CI里这是最大的耗时，没有显示器的时候还会卡住。现在：
+    - 用面向对象的Figure API，不经过pyplot，不依赖交互式的backend，天然是headless的（Agg）
+    - 画图是可选的，默认不show
+    - plot_async把画图丢到后台的单进程里，主流程算完指标就可以继续，最后调用wait()等画完
+    - plot_batch把很多条净值曲线画到一张图里，参数扫描的时候用
+"""
+
+DPI = 300
+BATCH_DPI = 150
+
+matplotlib.rcParams['font.sans-serif'] = ['SimHei']
+matplotlib.rcParams['axes.unicode_minus'] = False
+
+
+# 画A股,参考：https://deepinout.com/matplotlib/matplotlib-axis/matplotlib-the-hidden-scale-mode-shows-the-three-y-axes.html
+# 创建第三条Y轴，把第三条Y轴的其它三边隐藏起来，只留下右边显示
+def make_patch_spines_invisible(ax):
+    ax.set_frame_on(True)
+    ax.patch.set_visible(False)
+    for sp in ax.spines.values():
+        sp.set_visible(False)
+
+
+def plot(df, save_path, show=False, dpi=DPI):
+    """
+    1. 每期实际收益
+    2. 每期实际累计收益
+    3. 基准累计收益率
+    4. 上证指数
+    :param df:
+    :param save_path: 图片保存路径
+    :param show: 是否弹出窗口显示（需要有显示器）
+    :return:
+    """
+    x = df.trade_date.values
+    y1 = df.next_pct_chg.values
+    y2 = df.cumulative_pct_chg.values
+    y3 = df.cumulative_pct_chg_baseline.values
+    y4 = df.index_close.values
+
+    color_y1 = '#2A9CAD'
+    color_y2 = "#FAB03D"
+    color_y3 = "#D3D3D3"
+    color_y4 = "#008000"
+
+    title = '资产组合收益率及累积收益率'
+
+    label_x = '周'
+    label_y1 = '资产组合周收益率'
+    label_y2 = '资产组合累积收益率'
+    label_y3 = '基准累积收益率'
+    label_y4 = '上证指数'
+
+    fig = _figure((10, 6), dpi, show)
+    ax1 = fig.add_subplot()
+    ax1.tick_params(axis='x', labelrotation=60)
+    ax2 = ax1.twinx()  # 做镜像处理
+
+    ax1.bar(x=x, height=y1, label=label_y1, color=color_y1, alpha=0.7)
+    ax1.set_xlabel(label_x)  # 设置x轴标题
+    ax1.set_ylabel(label_y1)  # 设置Y1轴标题
+    ax1.grid(False)
+    # 12周间隔，3个月相当于，为了让X轴稀疏一些，太密了，如果不做的话
+    ax1.xaxis.set_major_locator(ticker.MultipleLocator(12))
+
+    ax2.plot(x, y2, color=color_y2, ms=10, label=label_y2)
+    ax2.plot(x, y3, color=color_y3, ms=10, label=label_y3)
+    ax2.set_ylabel(label_y2 + "/" + label_y3)  # 设置Y2轴标题
+    ax2.grid(False)
+    ax2.xaxis.set_major_locator(ticker.MultipleLocator(12))
+
+    ax3 = ax1.twinx()
+    ax3.spines["right"].set_position(("axes", 1.2))
+    make_patch_spines_invisible(ax3)
+    ax3.spines["right"].set_visible(True)
+    p3, = ax3.plot(x, y4, color=color_y4, ms=10, label=label_y4)
+    ax3.set_ylabel(label_y4)
+    ax3.grid(False)
+    ax3.xaxis.set_major_locator(ticker.MultipleLocator(12))
+    ax3.yaxis.label.set_color(p3.get_color())
+
+    # 添加标签
+    ax1.legend(loc='upper left')
+    ax2.legend(loc='upper right')
+    ax3.legend(loc='lower right')
+
+    ax3.set_title(title)  # 添加标题
+    ax3.grid(axis="y")  # 背景网格
+
+    _save(fig, save_path, show)
+
+
+def plot_batch(df_returns, save_path, baseline=None, title='净值曲线', show=False, dpi=BATCH_DPI):
+    """
+    把多个策略的净值曲线画到一张图上
+    :param df_returns: DataFrame，index是trade_date，每列是一个策略的每期收益率
+    :param baseline: Series，基准的每期收益率，画成灰色的粗线
+    """
+    df_values = (df_returns.fillna(0) + 1).cumprod()
+    x = df_values.index.values
+
+    fig = _figure((12, 6), dpi, show)
+    ax = fig.add_subplot()
+    ax.tick_params(axis='x', labelrotation=60)
+    for column in df_values.columns:
+        ax.plot(x, df_values[column].values, linewidth=0.8, label=str(column))
+    if baseline is not None:
+        baseline = (baseline.reindex(df_values.index).fillna(0) + 1).cumprod()
+        ax.plot(x, baseline.values, color="#A9A9A9", linewidth=2, label='基准')
+    ax.xaxis.set_major_locator(ticker.MultipleLocator(12))
+    ax.set_xlabel('周')
+    ax.set_ylabel('净值')
+    ax.set_title(title)
+    # 曲线太多的时候，图例放不下
+    if len(df_values.columns) <= 20: ax.legend(loc='upper left', fontsize='small')
+
+    _save(fig, save_path, show)
+
+
+def _figure(figsize, dpi, show):
+    """只有要显示的时候才用pyplot（需要交互式的backend），否则直接用Figure，不经过pyplot"""
+    if show:
+        import matplotlib.pyplot as plt
+        return plt.figure(figsize=figsize, dpi=dpi)
+    return Figure(figsize=figsize, dpi=dpi)
+
+
+def _save(fig, save_path, show):
+    fig.savefig(save_path)
+    logger.debug("图片保存到：%s", save_path)
+    if show:
+        import matplotlib.pyplot as plt
+        plt.show()
+
+
+class PlotWorker:
+    """
+    后台画图的单进程，画图不占用主流程的时间
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.futures = []
+
+    def submit(self, function, *args, **kwargs):
+        if self.pool is None: self.pool = ProcessPoolExecutor(max_workers=1)
+        self.futures.append(self.pool.submit(function, *args, **kwargs))
+
+    def wait(self):
+        """等所有的图画完，画图失败只记录日志，不影响回测结果"""
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception:
+                logger.exception("后台画图失败")
+        self.futures = []
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+_worker = PlotWorker()
+
+
+def plot_async(df, save_path, **kwargs):
+    """在后台进程画plot，调用wait()等待画完"""
+    _worker.submit(plot, df, save_path, **kwargs)
+
+
+def plot_batch_async(df_returns, save_path, **kwargs):
+    """在后台进程画plot_batch，调用wait()等待画完"""
+    _worker.submit(plot_batch, df_returns, save_path, **kwargs)
+
+
+def wait():
+    _worker.wait()
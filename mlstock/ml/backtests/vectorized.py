@@ -0,0 +1,217 @@
+import logging
+
+import numpy as np
+from pandas import DataFrame
+
+from mlstock.ml.backtests.broker import Broker, cash, buy_commission_rate, sell_commission_rate, distribute_cash
+from mlstock.ml.backtests.price_panel import PricePanel
+
+logger = logging.getLogger(__name__)
+
+"""
+向量化的回测引擎，是Broker的替代实现，构造参数和Broker一样，执行后同样产出df_values和total_commission。
+
+Broker是逐日、逐笔地用df_daily.loc[(date, code)]查价格，每天还要DataFrame.append一行市值，
+3年多的回测要跑好几分钟。这里的做法是：
+    - 先把df_daily变成稠密的 日期x股票 的价格矩阵（PricePanel，只保留被选中过的股票，几百列），缺失的价格为NaN
+    - 每只股票的持仓股数、挂单（待买/待卖）都是长度为股票数的向量，
+      每天的买卖、佣金、现金的计算，都是对这些向量的数组运算，不再逐笔的查DataFrame
+    - 每天的持仓记到 日期x股票 的持仓矩阵里，最后 持仓矩阵*收盘价矩阵 一次算出每天的市值
+
+交易规则和Broker一致：
+    - 调仓日(周频)根据选股结果下单，下一个交易日执行，先卖后买
+    - 买入用开盘价(conservative=True时用最高价)，卖出用开盘价(conservative=True时用最低价)
+    - 买入时，按选股的顺序依次买，每只分到 剩余现金/(剩余待买的股票数*(1+买入佣金率))，预留出佣金，现金不会为负，
+      按1手(100股)取整，分不到1手的不买，前面买剩的零头会分给后面的
+    - 当天没有数据(停牌)的股票，买卖都顺延到下一个有数据的交易日，待买的单子到下个调仓日作废
+    - 择时(df_timing)不适合交易的调仓日，清仓，不买入
+买卖都只涉及当天的几十只股票，按顺序的循环很便宜；慢的是逐日的市值计算，这里一次矩阵运算算完。
+和Broker唯一的区别是：Broker遇到停牌的股票当天市值计作0，这里用最近的收盘价计算市值，
+所以现金(cash列)和Broker是一样的，持仓没有停牌的日子，总市值也一样，见parity_check。
+"""
+
+
+class VectorizedBroker:
+
+    def __init__(self, df_selected_stocks, df_daily, df_calendar, conservative=False, df_timing=None,
+                 buy_commission_rate=buy_commission_rate, sell_commission_rate=sell_commission_rate):
+        self.cash = cash
+        self.buy_commission_rate = buy_commission_rate
+        self.sell_commission_rate = sell_commission_rate
+        self.df_selected_stocks = df_selected_stocks
+        self.df_calendar = df_calendar
+        self.conservative = conservative
+        self.df_timing = df_timing
+        self.total_commission = 0
+        self.df_values = DataFrame()
+        self.holdings = None  # 日期x股票 的持仓股数
+
+        # 只有被选中过的股票才可能被持有，所以只需要这些股票的价格
+        self.panel = PricePanel(df_daily, codes=df_selected_stocks.ts_code.unique())
+        self.dates = self.panel.dates
+        self.codes = self.panel.codes
+        self.calendar = np.sort(df_calendar.values)
+
+    def _next_trade_date_index(self, day_date):
+        """调仓日的下一个交易日(交易日历)，执行日是self.dates中不早于它的第一个日子，返回它的位置，找不到返回None"""
+        pos = np.searchsorted(self.calendar, day_date, side='right')
+        if pos >= len(self.calendar): return None
+        index = np.searchsorted(self.dates, self.calendar[pos])
+        return index if index < len(self.dates) else None
+
+    def _orders(self):
+        """
+        把每个调仓日的选股结果，变成 调仓日在self.dates中的位置 => (是否交易, 选股的下标(按选股顺序), 执行日的位置)，
+        没有下一个交易日的，执行日的位置是None
+        """
+        df = self.df_selected_stocks[['trade_date', 'ts_code']]
+        transactions = {}
+        if self.df_timing is not None:
+            transactions = dict(zip(self.df_timing.trade_date, self.df_timing.transaction))
+
+        orders = {}
+        for day_date in np.sort(df.trade_date.unique()):
+            day_index = self.panel.date_index.get(day_date)
+            if day_index is None: continue
+            next_index = self._next_trade_date_index(day_date)
+            selected = [self.panel.code_index[c] for c in dict.fromkeys(df.ts_code[df.trade_date == day_date])
+                        if c in self.panel.code_index]
+            orders[day_index] = (transactions.get(day_date, True), np.array(selected, dtype=int), next_index)
+        return orders
+
+    def execute(self):
+        panel = self.panel
+        num_dates, num_codes = panel.shape
+        buy_price = panel.high if self.conservative else panel.open
+        sell_price = panel.low if self.conservative else panel.open
+        orders = self._orders()
+
+        shares = np.zeros(num_codes)
+        pending_buy = np.zeros(num_codes, dtype=bool)
+        pending_sell = np.zeros(num_codes, dtype=bool)
+        sell_from = np.zeros(num_codes, dtype=int)  # 卖单最早的执行日
+        buy_from = 0  # 买单最早的执行日（买单都是同一个调仓日下的）
+        buy_order = np.zeros(0, dtype=int)  # 买单的股票下标，按选股的顺序
+        holdings = np.zeros((num_dates, num_codes))
+        cash_values = np.zeros(num_dates)
+
+        for d in range(num_dates):
+            if d in orders:
+                transaction, selected, next_index = orders[d]
+                # 到调仓日，所有的买单都取消了，但保留卖单(没有卖出的要持续尝试卖出)
+                pending_buy = np.zeros(num_codes, dtype=bool)
+                buy_order = selected[:0]
+                if next_index is None:
+                    logger.warning("无法获得[%s]的下一个交易日,不做任何调仓", self.dates[d])
+                else:
+                    held = shares > 0
+                    if transaction:
+                        target = np.zeros(num_codes, dtype=bool)
+                        target[selected] = True
+                        new_sell = held & ~target & ~pending_sell
+                        pending_buy = target & ~held
+                        buy_order = selected[pending_buy[selected]]
+                    else:
+                        logger.warning("[%s]接下来的下周不适合交易，清仓", self.dates[d])
+                        new_sell = held & ~pending_sell
+                    pending_sell |= new_sell
+                    sell_from[new_sell] = next_index
+                    buy_from = next_index
+                    logger.debug("调仓日[%s]买单%d只，卖单%d只", self.dates[d], pending_buy.sum(), pending_sell.sum())
+
+            # 先卖
+            can_sell = pending_sell & panel.valid[d] & (sell_from <= d)
+            if can_sell.any():
+                amount = sell_price[d, can_sell] * shares[can_sell]
+                commission = (amount * self.sell_commission_rate).sum()
+                self.total_commission += commission
+                self.cash += amount.sum() - commission
+                shares[can_sell] = 0
+                pending_sell &= ~can_sell
+
+            # 后买，按选股的顺序，剩余的现金平分给剩余待买的股票（包括今天没有数据，买不成的），预留出佣金
+            if d >= buy_from and pending_buy.any():
+                for j in buy_order[panel.valid[d, buy_order] & pending_buy[buy_order]]:
+                    if self.cash <= 0: break
+                    cash4stock = distribute_cash(self.cash, pending_buy.sum(), self.buy_commission_rate)
+                    price = buy_price[d, j]
+                    position = 100 * ((cash4stock / price) // 100)  # 最小单位是1手=100股
+                    if position == 0: continue
+                    actual_cost = position * price
+                    commission = actual_cost * self.buy_commission_rate
+                    self.total_commission += commission
+                    self.cash -= actual_cost + commission
+                    shares[j] = position
+                    pending_buy[j] = False
+
+            holdings[d] = shares
+            cash_values[d] = self.cash
+
+        # 停牌的股票，用最近的收盘价计算市值
+        close = panel.ffill_close()
+        total_position_value = np.nansum(holdings * close, axis=1)
+        self.holdings = holdings
+        self.df_values = DataFrame({'trade_date': self.dates,
+                                    'total_value': total_position_value + cash_values,
+                                    'total_position_value': total_position_value,
+                                    'cash': cash_values})
+        logger.debug("向量化回测完成：%d个交易日，%d只股票，佣金总额%.2f", num_dates, num_codes, self.total_commission)
+
+
+def parity_check(df_selected_stocks, df_daily, df_calendar, conservative=False, df_timing=None,
+                 tolerance=1e-6, **commission_rates):
+    """
+    同样的输入，分别用Broker和VectorizedBroker回测，比较逐日的现金(所有的成交都反映在现金上)，
+    和持仓都有数据(没有停牌)的日子的总市值
+    :param tolerance: 允许的最大相对误差
+    :return: (最大的现金相对误差，最大的总市值相对误差)
+    """
+    broker = Broker(df_selected_stocks, df_daily, df_calendar, conservative, df_timing, **commission_rates)
+    broker.execute()
+    vectorized = VectorizedBroker(df_selected_stocks, df_daily, df_calendar, conservative, df_timing,
+                                  **commission_rates)
+    vectorized.execute()
+
+    df_broker, df_vectorized = broker.df_values, vectorized.df_values
+    if len(df_broker) != len(df_vectorized) or (df_broker.trade_date.values != df_vectorized.trade_date.values).any():
+        raise ValueError(f"回测的交易日不一致：Broker {len(df_broker)}天，VectorizedBroker {len(df_vectorized)}天")
+
+    cash_error = np.abs(df_broker.cash.values - df_vectorized.cash.values).max() / cash
+    # Broker把停牌的持仓的市值计作0，只比较持仓都有数据的日子
+    complete = ~((vectorized.holdings > 0) & ~vectorized.panel.valid).any(axis=1)
+    value_error = np.abs(df_broker.total_value.values[complete] - df_vectorized.total_value.values[complete]).max(
+        initial=0) / cash
+    logger.info("Broker vs VectorizedBroker：最终市值 %.2f vs %.2f，现金最大相对误差%.2e，总市值最大相对误差%.2e(%d/%d天)",
+                df_broker.total_value.iloc[-1], df_vectorized.total_value.iloc[-1], cash_error, value_error,
+                complete.sum(), len(complete))
+    if cash_error > tolerance or value_error > tolerance:
+        raise ValueError(f"VectorizedBroker和Broker的结果不一致：现金误差{cash_error:.2e}，总市值误差{value_error:.2e}")
+    if (df_vectorized.cash < 0).any() or (df_broker.cash < 0).any(): raise ValueError("回测的现金出现了负数")
+    return cash_error, value_error
+
+
+# python -m mlstock.ml.backtests.vectorized
+if __name__ == '__main__':
+    import pandas as pd
+    from mlstock.utils import utils
+
+    utils.init_logger(file=False, simple=True, log_level=logging.INFO)
+
+    # 合成数据：300只股票、3年的日线，随机游走的价格，2%的行缺失(停牌)，每周五选30只
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range('20190101', '20211231').strftime('%Y%m%d').values
+    codes = [f"{i:06d}.SZ" for i in range(300)]
+    close = 10 * np.exp(np.cumsum(rng.normal(0, 0.02, (len(dates), len(codes))), axis=0))
+    df_daily = pd.DataFrame({'trade_date': np.repeat(dates, len(codes)),
+                             'ts_code': np.tile(codes, len(dates)),
+                             'close': close.ravel()})
+    df_daily['open'] = df_daily.close * (1 + rng.normal(0, 0.005, len(df_daily)))
+    df_daily['high'] = df_daily[['open', 'close']].max(axis=1) * 1.01
+    df_daily['low'] = df_daily[['open', 'close']].min(axis=1) * 0.99
+    df_daily = df_daily[rng.random(len(df_daily)) > 0.02]
+    fridays = dates[pd.to_datetime(dates).dayofweek == 4]
+    df_selected = pd.DataFrame([(date, code) for date in fridays for code in rng.choice(codes, 30, replace=False)],
+                               columns=['trade_date', 'ts_code'])
+    df_calendar = pd.Series(dates)
+    parity_check(df_selected, df_daily, df_calendar)
+    parity_check(df_selected, df_daily, df_calendar, conservative=True)
@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+"""
+因子数据的调试诊断信息：每个因子的统计(describe)、NA统计、缺失率过高的股票明细等。
+
+之前clean_factors里直接对全量数据(1300万行x70多列)做describe()、isna().sum()，
+每次都要几分钟，还要生成一个和原数据一样大的临时矩阵，而且哪怕日志级别根本不会输出它们，也照算不误。
+现在把它们都挪到这里：
+    - 默认不开启，不开启时，所有的诊断都是空操作，传入的计算函数也不会被调用
+    - 开启后，默认只在抽样的数据上计算(sample_size行)，sample_size=None则用全量数据，
+      统计按列分块单次遍历计算，不生成全矩阵的临时数据
+"""
+
+SAMPLE_SIZE = 100000
+COLUMN_CHUNK = 16  # 每次处理多少列，控制临时矩阵的大小
+
+
+class Diagnostics:
+
+    def __init__(self, enabled=False, sample_size=SAMPLE_SIZE, seed=0):
+        """
+        :param enabled: 是否开启诊断
+        :param sample_size: 抽样行数，None为使用全量数据
+        :param seed: 抽样的随机种子
+        """
+        self.enabled = enabled
+        self.sample_size = sample_size
+        self.seed = seed
+        self.results = {}
+
+    def _sample(self, df):
+        if self.sample_size is None or len(df) <= self.sample_size: return df
+        return df.sample(n=self.sample_size, random_state=self.seed)
+
+    def profile(self, title, df, columns):
+        """
+        对指定的列做统计：行数、NA数、NA率、均值、标准差、最小值、最大值
+        """
+        if not self.enabled: return None
+        df = self._sample(df)
+        df_profile = profile(df, columns)
+        self._record(title, df_profile, sampled=len(df))
+        return df_profile
+
+    def lazy(self, title, func):
+        """
+        只有开启诊断的时候，才调用func计算诊断信息
+        :param func: 无参函数，返回DataFrame/Series/dict
+        """
+        if not self.enabled: return None
+        result = func()
+        self._record(title, result)
+        return result
+
+    def _record(self, title, result, sampled=None):
+        self.results[title] = result
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None):
+            if sampled:
+                logger.info("(诊断)%s（抽样%d行）：\n%r", title, sampled, result)
+            else:
+                logger.info("(诊断)%s：\n%r", title, result)
+
+    def save(self, path):
+        """把诊断结果保存成json"""
+        if not self.enabled: return None
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name): os.makedirs(dir_name)
+        data = {}
+        for title, result in self.results.items():
+            if isinstance(result, pd.DataFrame):
+                data[title] = json.loads(result.to_json(orient='index', force_ascii=False))
+            elif isinstance(result, pd.Series):
+                data[title] = json.loads(result.to_json(force_ascii=False))
+            else:
+                data[title] = result
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4, default=str)
+        logger.info("诊断信息保存到：%s", path)
+        return path
+
+
+def profile(df, columns):
+    """
+    按列分块，单次遍历算出每列的统计值，
+    不像describe()那样要算分位数（要排序），也不会生成全量的isna()矩阵
+    """
+    stats = []
+    n = len(df)
+    for i in range(0, len(columns), COLUMN_CHUNK):
+        chunk_columns = columns[i:i + COLUMN_CHUNK]
+        values = df[chunk_columns].to_numpy(dtype=np.float64, na_value=np.nan)
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0)
+        filled = np.where(valid, values, 0.)
+        _sum = filled.sum(axis=0)
+        _sum_sq = (filled * filled).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = _sum / count
+            var = (_sum_sq - count * mean * mean) / (count - 1)
+            _min = np.where(valid, values, np.inf).min(axis=0)
+            _max = np.where(valid, values, -np.inf).max(axis=0)
+        empty = count == 0
+        stats.append(pd.DataFrame({
+            'count': count,
+            'na': n - count,
+            'na_rate': (n - count) / n if n > 0 else np.nan,
+            'mean': mean,
+            'std': np.sqrt(np.maximum(var, 0)),
+            'min': np.where(empty, np.nan, _min),
+            'max': np.where(empty, np.nan, _max)
+        }, index=chunk_columns))
+    if len(stats) == 0: return pd.DataFrame()
+    return pd.concat(stats).sort_values('na')
@@ -1,3 +1,8 @@
+import json
+import logging
+import os
+
+from mlstock.const import FACTOR_SELECTION_PATH
 from mlstock.factors.alpha_beta import AlphaBeta
 from mlstock.factors.daily_indicator import DailyIndicator
 from mlstock.factors.ff3_residual_std import FF3ResidualStd
@@ -14,8 +19,13 @@ from mlstock.factors.std import Std
 from mlstock.factors.returns import Return
 from mlstock.factors.turnover_return import TurnoverReturn
 
+logger = logging.getLogger(__name__)
+
 """
 所有的因子配置，有的因子类只包含一个feature，有的因子类可能包含多个features。
+
+因子计算总是算所有的因子；如果有conf/factor_selection.json(research/factor_correlation去冗余后生成的)，
+训练、预测只用里面的因子(get_factor_names())，分析因子的工具用get_factor_names(selected=False)看全部的因子。
 """
 
 # 测试用
@@ -45,9 +55,10 @@ FACTORS = [TurnoverReturn,
            StakeHolder]
 
 
-def get_factor_names():
+def get_factor_names(selected=True):
     """
     获得所有的因子名
+    :param selected: 是否只要精简后的因子(conf/factor_selection.json)，没有这个文件时返回所有的因子
     :return:
     """
 
@@ -58,9 +69,44 @@ def get_factor_names():
             names += _names
         else:
             names += [_names]
+    if selected: names = select_factor_names(names)
     return names
 
 
+def select_factor_names(factor_names):
+    """按精简后的因子(conf/factor_selection.json)过滤，保持原来的顺序，没有这个文件时原样返回"""
+    selection = load_selection()
+    if selection is None: return list(factor_names)
+    return [name for name in factor_names if name in selection]
+
+
+def load_selection(path=FACTOR_SELECTION_PATH):
+    """
+    精简后的因子列表，没有文件返回None
+    :return: set(因子名)
+    """
+    if not os.path.exists(path): return None
+    with open(path, encoding='utf-8') as f:
+        selection = json.load(f)
+    factor_names = selection.get('factor_names')
+    if not factor_names: raise ValueError(f"因子选择文件[{path}]里没有factor_names")
+    all_names = get_factor_names(selected=False)
+    unknown = [name for name in factor_names if name not in all_names]
+    if unknown: raise ValueError(f"因子选择文件[{path}]里的因子不在因子列表中：{unknown}")
+    logger.debug("使用因子选择文件[%s]：%d/%d个因子", path, len(factor_names), len(all_names))
+    return set(factor_names)
+
+
+def save_selection(factor_names, path=FACTOR_SELECTION_PATH, **info):
+    """保存精简后的因子列表，info是附带的说明(如生成的方法、阈值)"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory): os.makedirs(directory)
+    with open(path, "w", encoding='utf-8') as f:
+        json.dump({'factor_names': list(factor_names), **info}, f, ensure_ascii=False, indent=2)
+    logger.info("精简后的因子列表(%d个)保存到：%s", len(factor_names), path)
+    return path
+
+
 def get_factor_class_by_name(name):
     """
     根据名字获得Factor Class
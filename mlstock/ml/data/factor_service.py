@@ -4,28 +4,36 @@ import logging
 import os
 import time
 
+import numpy as np
 import pandas as pd
 from sklearn.preprocessing import StandardScaler
 
-from mlstock.const import CODE_DATE, BASELINE_INDEX_CODE
+from mlstock.const import CODE_DATE, BASELINE_INDEX_CODE, TARGET_HORIZONS, ORTHOGONAL_GROUPS
 from mlstock.data import data_filter, data_loader
 from mlstock.data.datasource import DataSource
 from mlstock.data.stock_info import StocksInfo
 from mlstock.ml.data import factor_conf
+from mlstock.ml.data.diagnostics import Diagnostics
 from mlstock.ml.data.factor_conf import FACTORS
-from mlstock.utils import utils
+from mlstock.ml.data.preprocessor import FactorPreprocessor, preprocessor_path
+from mlstock.utils import utils, instrument
 from mlstock.utils.industry_neutral import IndustryMarketNeutral
+from mlstock.utils.orthogonalize import FactorOrthogonalizer
 from mlstock.utils.utils import time_elapse
 
 logger = logging.getLogger(__name__)
 
 
-def calculate(factor_classes, start_date, end_date, num, is_industry_neutral):
+def calculate(factor_classes, start_date, end_date, num, is_industry_neutral, horizons=None, diagnose=False,
+              orthogonalize=None):
     """
     从头开始计算因子
     :param start_date:
     :param end_date:
     :param num:
+    :param horizons: 预测目标的周期列表(周)，默认const.TARGET_HORIZONS
+    :param diagnose: 是否输出清洗过程中的调试诊断信息（describe、NA统计等，抽样计算）
+    :param orthogonalize: 因子组正交化的方法，gram_schmidt|symmetric|pca，None为不做
     :return:
     """
 
@@ -33,36 +41,58 @@ def calculate(factor_classes, start_date, end_date, num, is_industry_neutral):
     data_source = DataSource()
 
     # 加载股票数据
-    stock_data, ts_codes = load_stock_data(data_source, start_date, end_date, num)
+    with instrument.stage('load') as record:
+        stock_data, ts_codes = load_stock_data(data_source, start_date, end_date, num)
+        record.rows_out = len(stock_data.df_weekly)
 
     # 加载（计算）因子
-    df_weekly, factor_names = calculate_factors(factor_classes, data_source, stock_data,
-                                                StocksInfo(ts_codes, start_date, end_date))
+    with instrument.stage('factors', len(stock_data.df_weekly)) as record:
+        df_weekly, factor_names = calculate_factors(factor_classes, data_source, stock_data,
+                                                    StocksInfo(ts_codes, start_date, end_date))
+        record.rows_out = len(df_weekly)
 
     # 显存一份最原始的数据
     time_elapse(start_time, "⭐️ 全部因子加载完成")
 
     # 加载基准（指数）数据
-    df_weekly = prepare_target(df_weekly, start_date, end_date, data_source)
+    with instrument.stage('targets', len(df_weekly)) as record:
+        df_weekly = prepare_target(df_weekly, start_date, end_date, data_source, horizons)
+        record.rows_out = len(df_weekly)
 
     # 清晰因子数据
-    df_weekly = clean_factors(df_weekly, factor_names, start_date, end_date, is_industry_neutral)
+    with instrument.stage('clean', len(df_weekly)) as record:
+        diagnostics = Diagnostics(enabled=diagnose)
+        preprocessor = FactorPreprocessor(factor_names)
+        df_weekly = clean_factors(df_weekly, factor_names, start_date, end_date, is_industry_neutral, diagnostics,
+                                  preprocessor, orthogonalize)
+        diagnostics.save(f"data/diagnostics_{utils.now()}.json")
+        record.rows_out = len(df_weekly)
+
+    # 保存原始数据和处理后的数据，以及预处理的状态（预测服务处理新数据用）
+    csv_file_name = save_factors(df_weekly, start_date, end_date, len(ts_codes), is_industry_neutral)
+    preprocessor.save(preprocessor_path(csv_file_name))
 
-    # 保存原始数据和处理后的数据
-    # factor_开始日_结束日_股票数_总行数_行业中性_时间戳.csv
-    # factor_20090101_20220901_s2109_l13940192l_20220826165226.csv
+    return df_weekly, factor_names, csv_file_name
+
+
+def save_factors(df_weekly, start_date, end_date, stock_num, is_industry_neutral):
+    """
+    保存清洗后的因子数据到csv文件
+    文件名：factor_开始日_结束日_股票数_总行数_行业中性_时间戳.csv
+    如：factor_20090101_20220901_s2109_l13940192l_20220826165226.csv
+    :return: csv文件路径
+    """
     industry_neutral = "_industry_neutral" if is_industry_neutral else ""
     csv_file_name = "data/factor_{}_{}_{}_{}_{}_{}.csv".format(
         start_date,
         end_date,
-        len(ts_codes),
+        stock_num,
         len(df_weekly),
         industry_neutral,
         utils.now())
     df_weekly.to_csv(csv_file_name, header=True, index=False)  # 保留列名
     logger.info("保存因子数据 %d 行，到文件：%s", len(df_weekly), csv_file_name)
-
-    return df_weekly, factor_names, csv_file_name
+    return csv_file_name
 
 
 def load_stock_data(data_source, start_date, end_date, num):
@@ -120,9 +150,11 @@ def calculate_factors(factor_classes, data_source, stock_data, stocks_info):
 
     # 获取每一个因子（特征），并且，并入到股票数据中
     for factor_class in factor_classes:
-        factor = factor_class(data_source, stocks_info)
-        df_factor = factor.calculate(stock_data)
-        df_weekly = factor.merge(df_weekly, df_factor)
+        with instrument.stage(f"factor/{factor_class.__name__}", len(df_weekly)) as record:
+            factor = factor_class(data_source, stocks_info)
+            df_factor = factor.calculate(stock_data)
+            df_weekly = factor.merge(df_weekly, df_factor)
+            record.rows_out = len(df_factor)
         factor_names += factor.name if type(factor.name) == list else [factor.name]
         logger.info("获取因子%r %d 行数据", factor.name, len(df_factor))
 
@@ -144,8 +176,12 @@ def load_from_file(factors_file_path):
     return df_features
 
 
-def extract_features(df):
-    return df[factor_conf.get_factor_names()]
+def extract_features(df, factor_names=None):
+    """
+    :param factor_names: 模型训练时用的因子(model_registry.model_factor_names)，默认为当前配置的因子
+    """
+    if factor_names is None: factor_names = factor_conf.get_factor_names()
+    return df[factor_names]
 
 
 # def extract_train_data(df):
@@ -157,13 +193,17 @@ def extract_features(df):
 #     return df[CODE_DATE + factor_conf.get_factor_names() + TARGET]
 
 
-def prepare_target(df_weekly, start_date, end_date, datasource):
+def prepare_target(df_weekly, start_date, end_date, datasource, horizons=None):
     """
     计算基准的收益率等各种预测用的收益率
     :param df_weekly:
     :param datasource:
+    :param horizons: 预测的周期列表（单位：周），如[1,2,4,12]，默认只有1周，
+                     1周的还是原来的列名：target、next_pct_chg、next_pct_chg_baseline，
+                     N周的列名带上后缀：target_Nw、next_pct_chg_Nw、next_pct_chg_baseline_Nw
     :return:
     """
+    if horizons is None: horizons = TARGET_HORIZONS
 
     # 合并沪深300的周收益率，为何用它呢，是为了计算超额收益(r_i = pct_chg - next_pct_chg_baseline)
     df_baseline = datasource.index_weekly(BASELINE_INDEX_CODE, start_date, end_date)
@@ -174,19 +214,74 @@ def prepare_target(df_weekly, start_date, end_date, datasource):
     df_weekly = df_weekly.merge(df_baseline, on=['trade_date'], how='left')
     logger.info("合并基准[%s] %d=>%d", BASELINE_INDEX_CODE, len(df_weekly), len(df_weekly))
 
-    # 计算出和基准的超额收益率  ，并且基于它，设置预测标签'target'（预测下一期，所以做shift）
+    # 计算出和基准的超额收益率
     df_weekly['rm_rf'] = df_weekly.pct_chg - df_weekly.pct_chg_baseline
 
-    # target即预测目标，是"下一期"的超额收益，训练主要靠这个，他就是训练的y
-    df_weekly['target'] = df_weekly.groupby('ts_code').rm_rf.shift(-1)  # 别忘了把rm-rf做一个shift(-1),好变成下一期
+    # 一次排好序，后面所有周期的"下N期"收益，都是在排好序的数组上按位置偏移算出来的，不再逐个groupby().shift()
+    df_weekly = df_weekly.sort_values(CODE_DATE, kind='stable').reset_index(drop=True)
+    codes = df_weekly.ts_code.values
+    next_pct_chgs = forward_returns(codes, df_weekly.pct_chg.values, horizons)
+    next_pct_chg_baselines = forward_returns(codes, df_weekly.pct_chg_baseline.values, horizons)
+
+    for horizon in horizons:
+        target, next_pct_chg, next_pct_chg_baseline = target_names(horizon)
+        # 下N期的收益率，这个是为了将来做回测评价用
+        df_weekly[next_pct_chg] = next_pct_chgs[horizon]
+        # 下N期的基准收益率
+        df_weekly[next_pct_chg_baseline] = next_pct_chg_baselines[horizon]
+        # target即预测目标，是"下N期"的累计超额收益，训练主要靠这个，他就是训练的y
+        # 1期的时候，就是下一期的rm_rf
+        df_weekly[target] = next_pct_chgs[horizon] - next_pct_chg_baselines[horizon]
+    logger.info("计算了%r周的预测目标(target)、下期收益和下期基准收益", horizons)
 
-    # 下一期的收益率，这个是为了将来做回测评价用，注意，是下一期，所以做了shift(-1)
-    df_weekly['next_pct_chg'] = df_weekly.groupby('ts_code').pct_chg.shift(-1)
+    return df_weekly
 
-    # 下一期的基准收益率
-    df_weekly['next_pct_chg_baseline'] = df_weekly.groupby('ts_code').pct_chg_baseline.shift(-1)
 
-    return df_weekly
+def target_names(horizon):
+    """
+    N周的预测目标、下N期收益、下N期基准收益的列名，1周的保持原来的列名
+    """
+    if horizon == 1: return 'target', 'next_pct_chg', 'next_pct_chg_baseline'
+    return f'target_{horizon}w', f'next_pct_chg_{horizon}w', f'next_pct_chg_baseline_{horizon}w'
+
+
+def forward_returns(codes, returns, horizons):
+    """
+    计算每一行往后N期的累计收益：(1+r[i+1])*...*(1+r[i+N]) - 1，
+    要求数据已经按照[ts_code, trade_date]排好序，
+    用log(1+r)的累加和相减得到区间累计收益，所有周期共用一次累加，
+    往后N行如果已经跨到了下一只股票，或者区间内有nan，结果为nan
+
+    :param codes: 排好序的股票代码数组
+    :param returns: 同样顺序的每期收益率数组
+    :param horizons: 周期列表，如[1,2,4,12]
+    :return: {周期: 累计收益数组}
+    """
+    codes = np.asarray(codes)
+    returns = np.asarray(returns, dtype=np.float64)
+    n = len(returns)
+    if n == 0: return {h: np.array([], dtype=np.float64) for h in horizons}
+
+    nan_mask = np.isnan(returns)
+    # 前面补一个0，这样cum[j+1]-cum[i+1]就是r[i+1..j]的和
+    cum_log = np.concatenate([[0.], np.cumsum(np.log1p(np.where(nan_mask, 0., returns)))])
+    cum_nan = np.concatenate([[0], np.cumsum(nan_mask)])
+
+    # 每一行所在股票的最后一行的位置
+    is_last = np.append(codes[1:] != codes[:-1], True)
+    group_ids = np.cumsum(np.append(True, is_last[:-1])) - 1
+    group_last_rows = np.flatnonzero(is_last)[group_ids]
+
+    rows = np.arange(n)
+    results = {}
+    for horizon in horizons:
+        ends = rows + horizon
+        valid = ends <= group_last_rows
+        ends = np.minimum(ends, n - 1)
+        log_sum = cum_log[ends + 1] - cum_log[rows + 1]
+        nan_count = cum_nan[ends + 1] - cum_nan[rows + 1]
+        results[horizon] = np.where(valid & (nan_count == 0), np.expm1(log_sum), np.nan)
+    return results
 
 
 def _scaller(x, df_median, df_scope):
@@ -223,16 +318,21 @@ def _scaller(x, df_median, df_scope):
     return x
 
 
-def clean_factors(df_weekly, factor_names, start_date, end_date, is_industry_market_neutral):
+def clean_factors(df_weekly, factor_names, start_date, end_date, is_industry_market_neutral, diagnostics=None,
+                  preprocessor=None, orthogonalize=None):
     """
     对因子数据做进一步的清洗，这步很重要，也很慢
     :param df_features:
     :param factor_names:
     :param start_date: 因为前面的日期中，为了防止MACD之类的技术指标出现NAN预加载了数据，所以要过滤掉这些start_date之前的数据
+    :param diagnostics: 调试诊断信息(describe、NA统计等)，None则不做诊断，参考：diagnostics.Diagnostics
+    :param preprocessor: FactorPreprocessor，记录去极值、标准化、中性化的状态，用于预测新的数据，None则不记录
+    :param orthogonalize: 对const.ORTHOGONAL_GROUPS里的因子组做横截面正交化的方法，gram_schmidt|symmetric|pca，None为不做
     :return:
     """
 
     start_time = time.time()
+    if diagnostics is None: diagnostics = Diagnostics(enabled=False)
 
     """
     因为前面的日期中，为了防止MACD之类的技术指标出现NAN预加载了数据，所以要过滤掉这些start_date之前的数据
@@ -241,10 +341,7 @@ def clean_factors(df_weekly, factor_names, start_date, end_date, is_industry_mar
     df_weekly = df_weekly[df_weekly.trade_date >= start_date]
     logger.info("过滤掉[%s]之前的数据（为防止技术指标nan）后：%d => %d 行", start_date, original_length, len(df_weekly))
 
-    logger.info("(调试)特征处理之前的数据情况：\n%r", df_weekly[CODE_DATE + factor_names].describe())
-
-    with pd.option_context('display.max_rows', None, 'display.max_columns', None):
-        logger.info("(调试)特征处理之前NA统计：数据特征中的NAN数：\n%r", df_weekly[factor_names].isna().sum().sort_values())
+    diagnostics.profile("特征处理之前的数据情况(含NA统计)", df_weekly, factor_names)
 
     """
     如果target缺失比较多，就删除掉这些股票
@@ -259,25 +356,24 @@ def clean_factors(df_weekly, factor_names, start_date, end_date, is_industry_mar
     """
     去除那些因子值中超过20%缺失的股票（看所有因子中确实最大的那个，百分比超过20%，这只股票整个剔除掉）
     """
-    # 计算每只股票的每个特征的缺失百分比
-    # 仅用[ 特征s, 股票,日期 ] 这些列作为统计手段
-    df_na_miss_percent_by_code = df_weekly[CODE_DATE + factor_names].groupby(by='ts_code').apply(
-        lambda df: (df.shape[0] - df.count()) / df.shape[0])
+    # 计算每只股票的每个特征的缺失百分比，count()不计nan，用它和行数算出缺失比
+    df_group = df_weekly.groupby(by='ts_code')
+    df_na_miss_percent_by_code = 1 - df_group[factor_names].count().div(df_group.size(), axis=0)
 
     # 找出最大的那个特征的缺失比，如果其>80%，就剔除这只股票
-    df_na_miss_codes = df_na_miss_percent_by_code[df_na_miss_percent_by_code.max(axis=1) > 0.8]['ts_code']
-    # 把这些行找出来，打印到日志中，方便后期调试
-    df_missed_info = df_na_miss_percent_by_code[
-        df_na_miss_percent_by_code.apply(lambda x: x.name in df_na_miss_codes, axis=1)]
-    # 0缺失的列，需要扣掉，只保留确实列打印出来调试
-    need_drop_columns = df_missed_info.sum()[df_missed_info.sum() == 0].index
-    # 仅保留确实存在确实的列，打印出来调试
-    df_missed_info = df_missed_info.drop(need_drop_columns, axis=1)
-    logger.info("(调试)以下股票的某些特征的'缺失(NA)率'，超过80%%，%d 只(需要被删掉的股票)：\n%r", len(df_missed_info), df_missed_info)
+    df_na_miss_codes = df_na_miss_percent_by_code.index[df_na_miss_percent_by_code.max(axis=1) > 0.8]
+
+    # 把这些股票的缺失信息打印出来，方便后期调试，只保留确实存在缺失的列
+    def missed_info():
+        df_missed_info = df_na_miss_percent_by_code.loc[df_na_miss_codes]
+        return df_missed_info.loc[:, df_missed_info.sum() > 0]
+
+    diagnostics.lazy("以下股票的某些特征的'缺失(NA)率'，超过80%(需要被删掉的股票)", missed_info)
+
     # 剔除这些问题股票
-    origin_stock_size = len(df_weekly.ts_code.unique())
+    origin_stock_size = len(df_na_miss_percent_by_code)
     origin_data_size = df_weekly.shape[0]
-    df_weekly = df_weekly[df_weekly.ts_code.apply(lambda x: x not in df_na_miss_codes)]
+    df_weekly = df_weekly[~df_weekly.ts_code.isin(df_na_miss_codes)]
     logger.info("从%d只股票中剔除了%d只，占比%.1f%%；剔除相关数据%d=>%d行，剔除占比%.2f%%",
                 origin_stock_size,
                 len(df_na_miss_codes),
@@ -303,17 +399,18 @@ def clean_factors(df_weekly, factor_names, start_date, end_date, is_industry_mar
     # 每个值，都和中位数相减后，取绝对值，然后在找到绝对值们的中位数，这个就是要限定的范围值
     df_scope = df_features_only.apply(lambda x: x - df_median[x.name]).abs().median()
     df_features_only = df_features_only.apply(lambda x: _scaller(x, df_median, df_scope))
+    if preprocessor is not None: preprocessor.record_clip(df_median, df_scope)
 
     # 标准化：
     # 将中性化处理后的因子暴露度序列减去其现在的均值、除以其标准差，得到一个新的近似服从N(0,1)分布的序列。
     scaler = StandardScaler()
     scaler.fit(df_features_only)
     df_weekly[factor_names] = scaler.transform(df_features_only)
+    if preprocessor is not None: preprocessor.record_scaler(scaler)
     logger.info("对%d个特征进行了标准化(中位数去极值)处理：%d 行", len(factor_names), len(df_weekly))
 
-    # 去除所有的NAN数据(with用来显示所有航)
-    with pd.option_context('display.max_rows', None, 'display.max_columns', None):
-        logger.info("NA统计：数据特征中的NAN数：\n%r", df_weekly[factor_names].isna().sum().sort_values())
+    # 去除所有的NAN数据
+    diagnostics.profile("标准化之后的数据情况(含NA统计)", df_weekly, factor_names)
     df_weekly = filter_invalid_data(df_weekly, factor_names)
 
     original_length = len(df_weekly)
@@ -336,16 +433,29 @@ def clean_factors(df_weekly, factor_names, start_date, end_date, is_industry_mar
     # 行业中性化处理
     if is_industry_market_neutral:
         start_time1 = time.time()
-        industry_market_neutral = IndustryMarketNeutral(factor_names,
-                                                        market_value_name='total_market_value_log',
-                                                        industry_name='industry')
-        industry_market_neutral.fit(df_weekly)
-        df_weekly = industry_market_neutral.transform(df_weekly)
+        with instrument.stage('industry_neutral', len(df_weekly)) as record:
+            industry_market_neutral = IndustryMarketNeutral(factor_names,
+                                                            market_value_name='total_market_value_log',
+                                                            industry_name='industry')
+            industry_market_neutral.fit(df_weekly)
+            df_weekly = industry_market_neutral.transform(df_weekly)
+            if preprocessor is not None: preprocessor.record_neutralizer(industry_market_neutral)
+            record.rows_out = len(df_weekly)
         time_elapse(start_time1, "行业中性化处理")
 
-    # 保存最后的训练数据：ts_code、trade_date、factors、target
-    df_data = df_weekly[CODE_DATE + factor_names + ['target']]
-    logger.info("特征处理之后的数据情况：\n%r", df_data.describe())
+    # 高度相关的因子组，每个截面做正交化
+    if orthogonalize:
+        start_time1 = time.time()
+        with instrument.stage('orthogonalize', len(df_weekly)) as record:
+            groups = {name: columns for name, columns in ORTHOGONAL_GROUPS.items() if set(columns) <= set(factor_names)}
+            orthogonalizer = FactorOrthogonalizer(groups, orthogonalize).fit(df_weekly)
+            df_weekly = orthogonalizer.transform(df_weekly)
+            if preprocessor is not None: preprocessor.record_orthogonalizer(orthogonalizer)
+            record.rows_out = len(df_weekly)
+        time_elapse(start_time1, f"因子组正交化({orthogonalize})：{list(groups.keys())}")
+
+    # 最后的训练数据：ts_code、trade_date、factors、target
+    diagnostics.profile("特征处理之后的数据情况", df_weekly, factor_names + ['target'])
 
     time_elapse(start_time, "⭐️ 全部因子预处理完成")
     return df_weekly
@@ -416,6 +526,8 @@ if __name__ == '__main__':
     parser.add_argument('-e', '--end_date', type=str, default="20220801", help="结束日期")
     parser.add_argument('-n', '--num', type=int, default=100000, help="股票数量，调试用")
     parser.add_argument('-in', '--industry_neutral', action='store_true', default=False, help="是否做行业中性处理")
+    parser.add_argument('-hz', '--horizons', type=str, default=None, help="预测目标的周期(周)，逗号分隔，如：1,2,4,12")
+    parser.add_argument('-dg', '--diagnose', action='store_true', default=False, help="是否输出清洗过程的诊断信息")
 
     # 全局的
     parser.add_argument('-d', '--debug', action='store_true', default=True, help="是否调试")
@@ -428,4 +540,6 @@ if __name__ == '__main__':
     else:
         utils.init_logger(file=True, log_level=logging.INFO)
 
-    calculate(FACTORS, args.start_date, args.end_date, args.num, args.industry_neutral)
+    horizons = [int(h) for h in args.horizons.split(",")] if args.horizons else None
+    calculate(FACTORS, args.start_date, args.end_date, args.num, args.industry_neutral, horizons, args.diagnose)
+    instrument.save_report(extra=vars(args))
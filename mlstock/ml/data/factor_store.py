@@ -0,0 +1,212 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from mlstock.utils import utils
+
+logger = logging.getLogger(__name__)
+
+"""
+按年分区的因子存储，给out-of-core训练用。
+
+因子csv(13M行x73列)用pd.read_csv加载，再.values成X_train，内存里同时有3份float64的数据，
+比数据集小的机器训练不了全市场。这里把csv一块一块的读出来，按年切分，每一块存成一个分片(shard)：
+    root/
+        meta.json               因子名、target列名、每个分片的行数和日期范围
+        2009_000/
+            factors.npy         float32，行数x因子数，训练时用mmap打开，不占内存
+            targets.npy         float64，行数xtarget列数
+            dates.npy           int32，YYYYMMDD，按日期过滤、按时间切分用
+            keys.pkl            ts_code和trade_date，预测结果拼回股票用
+训练时一个分片一个分片的流式读(batches)，每次内存里只有一个分片。
+"""
+
+META_FILE = "meta.json"
+CHUNK_ROWS = 500000  # 从csv转换时，每次读的行数
+TARGET_PREFIXES = ('target', 'next_pct_chg')
+
+
+class Batch:
+    """一个分片(过滤日期后)的数据"""
+
+    __slots__ = ('X', 'targets', 'dates', 'shard')
+
+    def __init__(self, X, targets, dates, shard):
+        self.X = X
+        self.targets = targets
+        self.dates = dates
+        self.shard = shard
+
+
+class FactorStore:
+
+    def __init__(self, root):
+        meta_path = os.path.join(root, META_FILE)
+        if not os.path.exists(meta_path):
+            raise ValueError(f"因子存储不存在：{root}")
+        self.root = root
+        with open(meta_path, encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.factor_names = self.meta['factor_names']
+        self.target_names = self.meta['target_names']
+        self.shards = self.meta['shards']
+
+    def __len__(self):
+        return sum(shard['rows'] for shard in self.shards)
+
+    def select_shards(self, start_date=None, end_date=None):
+        """日期范围(闭区间)有重叠的分片"""
+        start, end = _to_int_date(start_date, 0), _to_int_date(end_date, 99999999)
+        return [shard for shard in self.shards if shard['end_date'] >= start and shard['start_date'] <= end]
+
+    def dates(self, start_date=None, end_date=None):
+        """日期范围内所有的交易日(int)，排好序的，只读dates.npy，很快"""
+        dates = [batch.dates for batch in self.batches(start_date, end_date, factors=False)]
+        if len(dates) == 0: return np.array([], dtype=np.int32)
+        return np.unique(np.concatenate(dates))
+
+    def batches(self, start_date=None, end_date=None, factor_names=None, target_names=None, factors=True):
+        """
+        按分片流式读数据
+        :param start_date: 开始日期(含)，'YYYYMMDD'或int
+        :param end_date: 结束日期(含)
+        :param factor_names: 需要的因子，默认为存储里所有的因子
+        :param target_names: 需要的target列，默认为['target']
+        :param factors: 是否读因子，只要日期的时候，不用打开factors.npy
+        :return: Batch的生成器，X是mmap的(整个分片都在日期范围内，且要全部因子时)或者过滤后的拷贝
+        """
+        start, end = _to_int_date(start_date, 0), _to_int_date(end_date, 99999999)
+        factor_index = self._column_index(self.factor_names, factor_names)
+        target_index = self._column_index(self.target_names, target_names or ['target'])
+        for shard in self.select_shards(start_date, end_date):
+            path = os.path.join(self.root, shard['name'])
+            dates = np.load(os.path.join(path, "dates.npy"))
+            mask = None
+            if shard['start_date'] < start or shard['end_date'] > end:
+                mask = (dates >= start) & (dates <= end)
+                dates = dates[mask]
+            if len(dates) == 0: continue
+
+            targets = np.load(os.path.join(path, "targets.npy"), mmap_mode='r')
+            targets = targets[:, target_index] if target_index is not None else np.asarray(targets)
+            X = np.load(os.path.join(path, "factors.npy"), mmap_mode='r') if factors else None
+            if mask is not None:
+                targets = targets[mask]
+                if factors: X = X[mask]
+            if factors and factor_index is not None: X = X[:, factor_index]
+            yield Batch(X, targets, dates, shard['name'])
+
+    @staticmethod
+    def _column_index(all_names, names):
+        """names在all_names里的位置，names就是all_names时返回None，不用再取列了"""
+        if names is None or list(names) == all_names: return None
+        missing = [name for name in names if name not in all_names]
+        if missing: raise ValueError(f"因子存储里没有这些列：{missing}")
+        return [all_names.index(name) for name in names]
+
+    def load_keys(self, shard_name):
+        return pd.read_pickle(os.path.join(self.root, shard_name, "keys.pkl"))
+
+
+class FactorStoreWriter:
+    """
+    把DataFrame一块一块的追加到存储里，按年切分，每次追加的每一年是一个分片
+    """
+
+    def __init__(self, root, factor_names, target_names=None):
+        if os.path.exists(os.path.join(root, META_FILE)):
+            raise ValueError(f"因子存储已经存在：{root}")
+        if not os.path.exists(root): os.makedirs(root)
+        self.root = root
+        self.factor_names = list(factor_names)
+        self.target_names = target_names
+        self.shards = []
+        self.parts = {}  # 每年已经写了几个分片
+
+    def append(self, df):
+        if self.target_names is None:
+            self.target_names = [c for c in df.columns if c.startswith(TARGET_PREFIXES)]
+        trade_dates = df.trade_date.astype(str)
+        years = trade_dates.str[:4]
+        for year in sorted(years.unique()):
+            mask = (years == year).values
+            self._write_shard(year, df[mask], trade_dates[mask])
+
+    def _write_shard(self, year, df, trade_dates):
+        part = self.parts.get(year, 0)
+        self.parts[year] = part + 1
+        name = f"{year}_{part:03d}"
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path): os.makedirs(path)
+
+        dates = trade_dates.astype(np.int32).values
+        np.save(os.path.join(path, "factors.npy"),
+                np.ascontiguousarray(df[self.factor_names].values, dtype=np.float32))
+        np.save(os.path.join(path, "targets.npy"), df[self.target_names].values.astype(np.float64))
+        np.save(os.path.join(path, "dates.npy"), dates)
+        pd.DataFrame({'ts_code': df.ts_code.values, 'trade_date': trade_dates.values}).to_pickle(
+            os.path.join(path, "keys.pkl"))
+        self.shards.append({'name': name,
+                            'rows': len(df),
+                            'start_date': int(dates.min()),
+                            'end_date': int(dates.max())})
+
+    def close(self):
+        """写meta.json，写完了才算一个完整的存储"""
+        self.shards.sort(key=lambda shard: (shard['start_date'], shard['name']))
+        meta = {'factor_names': self.factor_names,
+                'target_names': self.target_names,
+                'shards': self.shards,
+                'created': utils.now()}
+        with open(os.path.join(self.root, META_FILE), "w", encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        logger.info("因子存储保存到：%s，%d个分片，%d行",
+                    self.root, len(self.shards), sum(shard['rows'] for shard in self.shards))
+        return FactorStore(self.root)
+
+
+def build_from_csv(csv_path, root, factor_names, chunk_rows=CHUNK_ROWS):
+    """
+    把factor_service保存的因子csv转成分区存储，按块读，内存里只有一块
+    """
+    utils.check_file_path(csv_path)
+    writer = FactorStoreWriter(root, factor_names)
+    for df_chunk in pd.read_csv(csv_path, header=0, chunksize=chunk_rows, dtype={'trade_date': str}):
+        writer.append(df_chunk)
+    return writer.close()
+
+
+def build_from_dataframe(df, root, factor_names):
+    writer = FactorStoreWriter(root, factor_names)
+    writer.append(df)
+    return writer.close()
+
+
+def _to_int_date(date, default):
+    if date is None: return default
+    return int(date)
+
+
+"""
+python -m mlstock.ml.data.factor_store \
+-d data/factor_20080101_20220901_2954_1299032__industry_neutral_20220902112049.csv \
+-o data/factor_store/20080101_20220901
+"""
+if __name__ == '__main__':
+    utils.init_logger(file=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--data', type=str, help="因子数据csv文件")
+    parser.add_argument('-o', '--output', type=str, help="因子存储的目录")
+    parser.add_argument('-c', '--chunk_rows', type=int, default=CHUNK_ROWS, help="每次读csv的行数")
+    args = parser.parse_args()
+
+    from mlstock.ml.data import factor_conf
+
+    start_time = time.time()
+    build_from_csv(args.data, args.output, factor_conf.get_factor_names(selected=False), args.chunk_rows)
+    utils.time_elapse(start_time, "因子csv转换成分区存储")
@@ -0,0 +1,84 @@
+import logging
+import os
+
+import joblib
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+"""
+因子清洗(clean_factors)的状态：中位数去极值的中位数和范围、标准化的均值和标准差、行业市值中性化的回归模型、
+因子组正交化(FactorOrthogonalizer)。
+
+clean_factors是在全量数据上fit的，之前这些状态用完就丢了，只留下了清洗后的csv，
+新的一周的原始因子，没法做和训练数据一样的处理。现在clean_factors可以把状态记到FactorPreprocessor里，
+和因子csv保存在一起(xxx.csv => xxx.preprocessor.pkl)，预测服务(serve)用它处理原始的因子。
+"""
+
+
+class FactorPreprocessor:
+
+    def __init__(self, factor_names):
+        self.factor_names = list(factor_names)
+        self.median = None
+        self.scope = None
+        self.mean = None
+        self.scale = None
+        self.neutralizer = None  # IndustryMarketNeutral，不做行业中性化时为None
+        self.orthogonalizer = None  # FactorOrthogonalizer，不做正交化时为None
+
+    def record_clip(self, df_median, df_scope):
+        self.median = df_median[self.factor_names].values.astype(np.float64)
+        self.scope = df_scope[self.factor_names].values.astype(np.float64)
+
+    def record_scaler(self, scaler):
+        self.mean = scaler.mean_.astype(np.float64)
+        self.scale = scaler.scale_.astype(np.float64)
+
+    def record_neutralizer(self, neutralizer):
+        self.neutralizer = neutralizer
+
+    def record_orthogonalizer(self, orthogonalizer):
+        self.orthogonalizer = orthogonalizer
+
+    @property
+    def required_columns(self):
+        """除了因子之外，处理需要的列(行业中性化需要行业和市值)"""
+        if self.neutralizer is None: return []
+        return [self.neutralizer.industry_name, self.neutralizer.market_value_name]
+
+    def transform(self, df):
+        """
+        对原始的因子做和clean_factors一样的处理：去极值、标准化、行业市值中性化、因子组正交化
+        :param df: 包含factor_names(和required_columns)的DataFrame，正交化是按trade_date的截面做的，没有trade_date当作一个截面
+        :return: 处理后的DataFrame(拷贝)
+        """
+        if self.median is None or self.mean is None:
+            raise ValueError("预处理的状态不完整，需要clean_factors记录过的FactorPreprocessor")
+        X = df[self.factor_names].values.astype(np.float64)
+        X = np.clip(X, self.median - 5 * self.scope, self.median + 5 * self.scope)
+        X = (X - self.mean) / self.scale
+        df = df.copy()
+        df[self.factor_names] = X
+        if self.neutralizer is not None:
+            df = self.neutralizer.transform(df)
+        # 旧的状态文件里没有这个属性
+        if getattr(self, 'orthogonalizer', None) is not None:
+            df = self.orthogonalizer.transform(df)
+        return df
+
+    def save(self, path):
+        joblib.dump(self, path)
+        logger.info("因子预处理的状态保存到：%s", path)
+        return path
+
+    @staticmethod
+    def load(path):
+        if not os.path.exists(path):
+            raise ValueError(f"因子预处理的状态文件不存在：{path}")
+        return joblib.load(path)
+
+
+def preprocessor_path(csv_path):
+    """因子csv对应的预处理状态文件"""
+    return os.path.splitext(csv_path)[0] + ".preprocessor.pkl"
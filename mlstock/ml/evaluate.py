@@ -1,27 +1,28 @@
 import argparse
 import logging
 
-import joblib
 import numpy as np
 import pandas as pd
 from pandas import DataFrame
 from sklearn.metrics import r2_score, mean_absolute_error, mean_squared_error, accuracy_score, precision_score, \
     recall_score, f1_score
 
-from mlstock.ml import load_and_filter_data
+from mlstock.ml import load_and_filter_data, ic_analysis
 from mlstock.ml.data import factor_service, factor_conf
 from mlstock.ml.data.factor_service import extract_features
+from mlstock.ml.model_registry import ModelRegistry, load_model, model_factor_names
 from mlstock.utils import utils
 
 logger = logging.getLogger(__name__)
 
 
-def classification_metrics(df, model):
+def classification_metrics(df, model, factor_names=None):
     """
     https://ningshixian.github.io/2020/08/24/sklearn%E8%AF%84%E4%BC%B0%E6%8C%87%E6%A0%87/
+    :param factor_names: 模型训练时用的因子，默认为当前配置的因子
     """
 
-    X = extract_features(df)
+    X = extract_features(df, factor_names)
     y = df.target.apply(lambda x: 1 if x > 0 else 0)
 
     y_pred = model.predict(X)
@@ -35,23 +36,30 @@ def classification_metrics(df, model):
     return metrics
 
 
-def regression_metrics(df, model):
+def regression_metrics(df, model, horizons=None, factor_names=None):
     """
     https://blog.csdn.net/u012735708/article/details/84337262
+    :param horizons: rank IC衰减看的未来的期数(如ic_analysis.IC_HORIZONS)，None不看，每一期都要重新排名，比较慢
+    :param factor_names: 模型训练时用的因子，默认为当前配置的因子
     """
     metrics = {}
 
     df['y'] = df['target']
-    X = extract_features(df)
+    X = extract_features(df, factor_names)
 
     df['y_pred'] = model.predict(X)
 
-    metrics['corr'] = df[['y', 'y_pred']].corr().iloc[0, 1]  # 测试标签y和预测y_pred相关性，到底准不准啊
-
-    # 看一下rank的IC，不看值相关性，而是看排名的相关性
-    df['y_rank'] = df.y.rank(ascending=False)  # 并列的默认使用排名均值
-    df['y_pred_rank'] = df.y_pred.rank(ascending=False)
-    metrics['rank_corr'] = df[['y_rank', 'y_pred_rank']].corr().iloc[0, 1]
+    # 每周横截面上的IC(预测和收益的相关性)，和rank IC(排名的相关性)，而不是所有行混在一起的相关性
+    df_summary, df_decay = ic_analysis.ic_report(df, ['y_pred'], 'y', horizons=horizons)
+    pearson, spearman = df_summary.loc[('pearson', 'y_pred')], df_summary.loc[('spearman', 'y_pred')]
+    metrics['ic'] = pearson.ic_mean
+    metrics['ic_ir'] = pearson.ic_ir
+    metrics['rank_ic'] = spearman.ic_mean
+    metrics['rank_ic_ir'] = spearman.ic_ir
+    metrics['rank_ic_hit_rate'] = spearman.hit_rate
+    if df_decay is not None:
+        for horizon, ic_mean in df_decay.loc['y_pred', 'ic_mean'].items():
+            metrics[f'rank_ic_decay_h{horizon}'] = ic_mean
 
     metrics['RMSE'] = np.sqrt(mean_squared_error(df.y, df.y_pred))
 
@@ -63,40 +71,60 @@ def regression_metrics(df, model):
     return metrics
 
 
-def factor_weights(model):
+def factor_weights(model, factor_names=None):
     """
     显示权重的影响
     :param model:
+    :param factor_names: 模型训练时用的因子，和model.coef_一一对应，默认为当前配置的因子
     :return:
     """
 
     param_weights = model.coef_
-    param_names = factor_conf.get_factor_names()
+    param_names = factor_names if factor_names is not None else factor_conf.get_factor_names()
     df = pd.DataFrame({'names': param_names, 'weights': param_weights})
     df = df.reindex(df.weights.abs().sort_values().index)
     logger.info("参数和权重排序：")
     logger.info(df.to_string().replace('\n', '\n\t'))
 
 
-def main(args):
+def evaluate(data_path, start_date, end_date, model_pct_path, model_winloss_path, horizons=None):
+    """
+    评测模型
+    :param data_path: 因子数据文件的路径
+    :param start_date: 评测的开始日期
+    :param end_date: 评测的结束日期
+    :param model_pct_path: 收益率模型的路径，None则不评测
+    :param model_winloss_path: 涨跌模型的路径，None则不评测
+    :param horizons: 收益率模型的rank IC衰减看的未来的期数，None不看
+    :return: {'regression': 回归指标, 'classification': 分类指标}
+    """
     # 查看数据文件和模型文件路径是否正确
-    if args.model_pct: utils.check_file_path(args.model_pct)
-    if args.model_winloss: utils.check_file_path(args.model_winloss)
-
-    df_data = load_and_filter_data(args.data, args.start_date, args.end_date)
+    if model_pct_path: utils.check_file_path(model_pct_path)
+    if model_winloss_path: utils.check_file_path(model_winloss_path)
 
+    df_data = load_and_filter_data(data_path, start_date, end_date)
 
     # 加载模型；如果参数未提供，为None
-    model_pct = joblib.load(args.model_pct) if args.model_pct else None
-    model_winloss = joblib.load(args.model_winloss) if args.model_winloss else None
-
+    model_pct = load_model(model_pct_path) if model_pct_path else None
+    model_winloss = load_model(model_winloss_path) if model_winloss_path else None
 
+    # 每个模型用它训练时的因子，没登记的模型文件才用当前配置的因子
+    registry = ModelRegistry()
+    result = {}
     if model_pct:
-        factor_weights(model_pct)
-        regression_metrics(df_data, model_pct)
+        factor_names = model_factor_names(model_pct_path, model_pct, factor_conf.get_factor_names(), registry)
+        factor_weights(model_pct, factor_names)
+        result['regression'] = regression_metrics(df_data, model_pct, horizons, factor_names)
 
     if model_winloss:
-        classification_metrics(df_data, model_winloss)
+        factor_names = model_factor_names(model_winloss_path, model_winloss, factor_conf.get_factor_names(), registry)
+        result['classification'] = classification_metrics(df_data, model_winloss, factor_names)
+
+    # 评测的指标补充到模型仓库里的模型上，带上评测区间
+    for model_path, kind in [(model_pct_path, 'regression'), (model_winloss_path, 'classification')]:
+        if model_path and kind in result:
+            metrics = {f"{kind}_{start_date}_{end_date}_{k}": float(v) for k, v in result[kind].items()}
+            registry.update_metrics(model_path, metrics)
 
     logger.info("原始数据统计：")
     logger.info("周收益平均值：%.2f%%", df_data.target.mean() * 100)
@@ -105,6 +133,12 @@ def main(args):
     logger.info("绝对值平均值：%.2f%%", df_data.target.abs().mean() * 100)
     logger.info("绝对值标准差：%.2f%%", df_data.target.abs().std() * 100)
     logger.info("绝对值中位数：%.2f%%", df_data.target.abs().median() * 100)
+    return result
+
+
+def main(args):
+    horizons = list(range(1, args.horizons + 1)) if args.horizons else None
+    return evaluate(args.data, args.start_date, args.end_date, args.model_pct, args.model_winloss, horizons)
 
 
 """
@@ -112,6 +146,7 @@ python -m mlstock.ml.evaluate \
 -s 20190101 -e 20220901 \
 -mp model/pct_ridge_20220902112320.model \
 -mw model/winloss_xgboost_20220902112813.model \
+-hz 12 \
 -d data/factor_20080101_20220901_2954_1299032__industry_neutral_20220902112049.csv
 """
 if __name__ == '__main__':
@@ -124,6 +159,7 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--data', type=str, default=None, help="数据文件")
     parser.add_argument('-mp', '--model_pct', type=str, default=None, help="收益率模型")
     parser.add_argument('-mw', '--model_winloss', type=str, default=None, help="涨跌模型")
+    parser.add_argument('-hz', '--horizons', type=int, default=0, help="rank IC衰减看到未来第几周，0为不算衰减")
 
     args = parser.parse_args()
 
@@ -0,0 +1,80 @@
+import logging
+import time
+
+import numpy as np
+
+from mlstock.utils import utils
+
+logger = logging.getLogger(__name__)
+
+"""
+批量预测。
+
+之前backtests.predict对每个模型都 X = df_data[factor_names]，全量数据的DataFrame拷贝两次，
+sklearn、xgboost内部还要再校验、再拷贝一次。现在：
+    - 特征只物化一次，一个连续的float32矩阵
+    - 按行分块，每块依次给所有的模型打分，结果直接写进预先分配好的数组
+    - 线性模型(Ridge)直接 X·coef + intercept，不经过sklearn的校验
+    - xgboost用inplace_predict，不构造DMatrix
+"""
+
+CHUNK_ROWS = 200000
+
+
+def feature_matrix(df, factor_names):
+    """从DataFrame里取出特征，转成一个连续的float32矩阵，只拷贝一次"""
+    return np.ascontiguousarray(df[factor_names].values, dtype=np.float32)
+
+
+def predict(X, models, chunk_rows=CHUNK_ROWS):
+    """
+    按行分块，用多个模型对同一个特征矩阵打分
+    :param X: 特征矩阵，最好是feature_matrix的结果
+    :param models: {输出的名字: 模型}，如{'pct_pred': model_pct, 'winloss_pred': model_winloss}
+    :return: {输出的名字: 预测结果(np.ndarray)}
+    """
+    predictors = {name: _predictor(model) for name, model in models.items() if model is not None}
+    outputs = {name: None for name in predictors}
+    elapsed = {name: 0.0 for name in predictors}
+    for start in range(0, len(X), chunk_rows):
+        X_chunk = X[start:start + chunk_rows]
+        for name, predictor in predictors.items():
+            start_time = time.time()
+            values = predictor(X_chunk)
+            if outputs[name] is None: outputs[name] = np.empty(len(X), dtype=values.dtype)
+            outputs[name][start:start + len(values)] = values
+            elapsed[name] += time.time() - start_time
+    for name in predictors:
+        logger.debug("预测[%s]：%d行，耗时%.2f秒", name, len(X), elapsed[name])
+        if outputs[name] is None: outputs[name] = np.empty(0)
+    return outputs
+
+
+def predict_dataframe(df, factor_names, models, chunk_rows=CHUNK_ROWS):
+    """对DataFrame打分，预测结果作为新的列写回df，模型为None的跳过"""
+    models = {name: model for name, model in models.items() if model is not None}
+    if len(models) == 0: return df
+    start_time = time.time()
+    X = feature_matrix(df, factor_names)
+    for name, values in predict(X, models, chunk_rows).items():
+        df[name] = values
+    utils.time_elapse(start_time, f"预测{list(models.keys())}: {len(df)}行 ")
+    return df
+
+
+def _predictor(model):
+    """根据模型的类型，选一个最快的预测方法"""
+    # 线性模型(Ridge、LinearRegression)，系数也转成float32，float32 x float64会先把X转成float64，慢好几倍，
+    # 73个因子的点积，float32的相对误差在1e-6左右，不影响排序选股
+    coef = getattr(model, 'coef_', None)
+    if coef is not None and np.ndim(coef) == 1 and hasattr(model, 'intercept_'):
+        coef, intercept = np.asarray(coef, dtype=np.float32), float(model.intercept_)
+        return lambda X: (X @ coef).astype(np.float64) + intercept
+
+    # 旧的XGBClassifier模型，直接用booster的inplace_predict，二分类输出的是涨的概率
+    if hasattr(model, 'get_booster'):
+        booster = model.get_booster()
+        return lambda X: (booster.inplace_predict(X) > 0.5).astype(np.int64)
+
+    # WinLossClassifier内部已经是inplace_predict了，以及其他的模型
+    return lambda X: np.asarray(model.predict(X))
@@ -0,0 +1,290 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import sqlite3
+
+import joblib
+
+from mlstock.utils import utils
+from mlstock.utils.hash_utils import hash_file, hash_object
+
+logger = logging.getLogger(__name__)
+
+"""
+本地的模型仓库。
+
+之前TrainAction.save_model存成 ./model/pct_ridge_<时间戳>.model，bin/backtest.sh、evaluate.sh
+用 `ls -1rt | grep | tail -n 1` 找"最新的"模型和数据，模型用的什么因子、什么数据、什么超参，全靠文件名猜。现在：
+    model/
+        registry.db     sqlite的索引：因子列表、训练区间、数据的哈希、超参、指标、训练耗时
+        blobs/          模型文件(joblib)，文件名带内容的哈希：<名字>_<sha1前12位>.model，不会覆盖已有的模型
+    - 每次训练自动登记，并打上latest标签，按类型(pct|winloss)+标签，或者按条件查询
+    - 加载用joblib的mmap_mode='r'，模型里的大数组(xgboost的树)不用读到内存再拷贝一遍
+    - 命令行：python -m mlstock.ml.model_registry path -t pct，给shell脚本用
+"""
+
+REGISTRY_DIR = "model"
+DB_FILE = "registry.db"
+BLOB_DIR = "blobs"
+LATEST = 'latest'
+JSON_FIELDS = ['factor_names', 'params', 'metrics']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    model_type TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    factor_names TEXT,
+    factor_hash TEXT,
+    start_date TEXT,
+    end_date TEXT,
+    data_path TEXT,
+    data_hash TEXT,
+    params TEXT,
+    metrics TEXT,
+    train_seconds REAL,
+    created TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    model_type TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    model_id INTEGER NOT NULL,
+    PRIMARY KEY (model_type, tag)
+);
+"""
+
+_data_hashes = {}  # (路径, 大小, 修改时间) => 哈希，同一次训练的两个模型，数据文件只算一次哈希
+
+
+class ModelRegistry:
+
+    def __init__(self, root=REGISTRY_DIR):
+        self.root = root
+        self.blob_dir = os.path.join(root, BLOB_DIR)
+        if not os.path.exists(self.blob_dir): os.makedirs(self.blob_dir)
+        self.db_path = os.path.join(root, DB_FILE)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def register(self, model, model_type, name, factor_names=None, start_date=None, end_date=None, data_path=None,
+                 params=None, metrics=None, train_seconds=None, tags=None):
+        """
+        登记一个模型，并打上latest标签
+        :param model: 模型对象，或者已经存在的模型文件的路径(导入旧的模型)
+        :param model_type: pct | winloss
+        :param name: 模型文件名，如pct_ridge_20220902112320.model，实际的文件名会加上内容的哈希
+        :param data_path: 训练数据的路径(因子csv或者因子存储的目录)，会记录它的哈希
+        :param params: 超参
+        :param metrics: 指标(训练时的验证集指标，评测的指标可以之后用update_metrics补上)
+        :param tags: 额外的标签，如['prod']
+        :return: 模型的记录(dict)
+        """
+        # 先写到临时文件，算出哈希，再改成带哈希的文件名：同一秒训练的两个模型(文件名一样)不会互相覆盖，
+        # 已经存在的同名文件内容一定是一样的
+        temp_path = os.path.join(self.blob_dir, f".{name}.{os.getpid()}.tmp")
+        if isinstance(model, str):
+            utils.check_file_path(model)
+            shutil.copyfile(model, temp_path)
+        else:
+            joblib.dump(model, temp_path)
+        sha1 = hash_file(temp_path)
+        stem, ext = os.path.splitext(name)
+        path = os.path.normpath(os.path.join(self.blob_dir, f"{stem}_{sha1[:12]}{ext}"))
+        os.replace(temp_path, path)
+
+        factor_names = list(factor_names) if factor_names is not None else None
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO models(name, model_type, path, sha1, factor_names, factor_hash, start_date, end_date, "
+                "data_path, data_hash, params, metrics, train_seconds, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, model_type, path, sha1,
+                 _to_json(factor_names), hash_object(factor_names) if factor_names else None,
+                 _to_str(start_date), _to_str(end_date),
+                 data_path, data_hash(data_path) if data_path else None,
+                 _to_json(params), _to_json(metrics), train_seconds, utils.now()))
+            model_id = cursor.lastrowid
+            for tag in [LATEST] + list(tags or []):
+                self._tag(conn, model_id, model_type, tag)
+        logger.info("模型[%s]登记到仓库：id=%d，%s", model_type, model_id, path)
+        return self.get(model_id)
+
+    def tag(self, model_id, tag):
+        """给模型打标签，同一类型的模型，一个标签只在一个模型上"""
+        record = self.get(model_id)
+        with self._connect() as conn:
+            self._tag(conn, model_id, record['model_type'], tag)
+
+    @staticmethod
+    def _tag(conn, model_id, model_type, tag):
+        conn.execute("INSERT OR REPLACE INTO tags(model_type, tag, model_id) VALUES (?, ?, ?)",
+                     (model_type, tag, model_id))
+
+    def get(self, model_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM models WHERE id = ?", (model_id,)).fetchone()
+        if row is None: raise ValueError(f"模型仓库里没有id={model_id}的模型")
+        return self._record(row)
+
+    def find(self, model_type=None, tag=None, **conditions):
+        """
+        按类型、标签、条件查询，最新的在前
+        :param conditions: models表的字段=值，如data_hash='...'，start_date='20090101'
+        :return: [模型记录]
+        """
+        sql = "SELECT models.* FROM models"
+        where, values = [], []
+        if tag:
+            sql += " JOIN tags ON tags.model_id = models.id"
+            where.append("tags.tag = ?")
+            values.append(tag)
+        if model_type:
+            where.append("models.model_type = ?")
+            values.append(model_type)
+        for field, value in conditions.items():
+            if value is None: continue
+            if not field.isidentifier(): raise ValueError(f"无效的查询字段：{field}")
+            where.append(f"models.{field} = ?")
+            values.append(_to_str(value))
+        if where: sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY models.id DESC"
+        with self._connect() as conn:
+            return [self._record(row) for row in conn.execute(sql, values).fetchall()]
+
+    def lookup(self, model_type, tag=LATEST, model_id=None):
+        """按id，或者类型+标签，找到一个模型"""
+        if model_id is not None: return self.get(model_id)
+        records = self.find(model_type, tag)
+        if len(records) == 0: raise ValueError(f"模型仓库里没有类型为{model_type}、标签为{tag}的模型")
+        return records[0]
+
+    def find_by_path(self, path):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM models WHERE path = ? ORDER BY id DESC",
+                               (os.path.normpath(path),)).fetchone()
+        return self._record(row) if row else None
+
+    def update_metrics(self, path, metrics):
+        """给已经登记的模型补充指标(如评测的结果)，模型不在仓库里(手工指定的文件)返回False"""
+        record = self.find_by_path(path)
+        if record is None: return False
+        merged = {**(record['metrics'] or {}), **metrics}
+        with self._connect() as conn:
+            conn.execute("UPDATE models SET metrics = ? WHERE id = ?", (_to_json(merged), record['id']))
+        return True
+
+    def load(self, model_type, tag=LATEST, model_id=None, mmap=True):
+        return load_model(self.lookup(model_type, tag, model_id)['path'], mmap)
+
+    def _record(self, row):
+        record = dict(row)
+        for field in JSON_FIELDS:
+            if record[field] is not None: record[field] = json.loads(record[field])
+        return record
+
+
+def load_model(path, mmap=True):
+    """
+    加载模型文件，mmap的话，模型里的numpy数组是只读的内存映射，不会读进内存再拷贝一遍
+    """
+    utils.check_file_path(path)
+    return joblib.load(path, mmap_mode='r' if mmap else None)
+
+
+def model_factor_names(path, model=None, default=None, registry=None):
+    """
+    模型训练时用的因子列表：登记过的模型用仓库里记录的，手工指定的(没登记的)模型文件用default(一般是当前的因子配置)，
+    因子配置(conf/factor_selection.json)可能在训练之后改过，不能直接用当前的配置去给老模型打分
+    :param model: 加载好的模型，提供了就和它的特征数核对
+    :return: 因子名的列表
+    """
+    record = (registry or ModelRegistry()).find_by_path(path)
+    if record is not None and record['factor_names']:
+        factor_names = record['factor_names']
+    else:
+        if default is None: raise ValueError(f"模型[{path}]没有登记在模型仓库里，需要指定它训练时用的因子")
+        factor_names = list(default)
+    check_feature_num(model, factor_names, path)
+    return factor_names
+
+
+def check_feature_num(model, factor_names, path=None):
+    """模型的特征数和因子列表的长度不一致时报错，否则特征会错位，预测出来的是错的，却不会报错"""
+    feature_num = getattr(model, 'n_features_in_', None)
+    if feature_num is None or feature_num == len(factor_names): return
+    raise ValueError(f"模型[{path}]训练时用了{feature_num}个因子，给定的因子列表却有{len(factor_names)}个，"
+                     f"因子配置(conf/factor_selection.json)可能在训练之后改过")
+
+
+def data_hash(data_path):
+    """训练数据的哈希，因子存储(目录)用它的meta.json"""
+    if os.path.isdir(data_path): data_path = os.path.join(data_path, "meta.json")
+    stat = os.stat(data_path)
+    key = (os.path.abspath(data_path), stat.st_size, stat.st_mtime)
+    if key not in _data_hashes: _data_hashes[key] = hash_file(data_path)
+    return _data_hashes[key]
+
+
+def _to_json(value):
+    if value is None: return None
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _to_str(value):
+    if value is None: return None
+    return str(value)
+
+
+def _print_records(records):
+    for r in records:
+        metrics = ", ".join(f"{k}={v:.6g}" if isinstance(v, float) else f"{k}={v}"
+                            for k, v in (r['metrics'] or {}).items())
+        print(f"{r['id']:>4} {r['model_type']:<8} {r['name']:<40} {r['start_date']}~{r['end_date']} "
+              f"因子{len(r['factor_names'] or [])}个 {r['params']} {metrics}")
+
+
+"""
+python -m mlstock.ml.model_registry list -t pct
+python -m mlstock.ml.model_registry path -t winloss -g latest
+python -m mlstock.ml.model_registry data -t pct
+python -m mlstock.ml.model_registry tag -i 12 -g prod
+python -m mlstock.ml.model_registry register -t pct -f model/pct_ridge_20220902112320.model -d data/factor_xxx.csv
+"""
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', type=str, help="list|path|data|tag|register")
+    parser.add_argument('-t', '--type', type=str, default=None, help="模型类型：pct|winloss")
+    parser.add_argument('-g', '--tag', type=str, default=None, help="标签，path/data默认为latest")
+    parser.add_argument('-i', '--id', type=int, default=None, help="模型id")
+    parser.add_argument('-f', '--file', type=str, default=None, help="register：要导入的模型文件")
+    parser.add_argument('-d', '--data', type=str, default=None, help="register：模型的训练数据")
+    parser.add_argument('-r', '--root', type=str, default=REGISTRY_DIR, help="模型仓库的目录")
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.root)
+    if args.command == 'list':
+        _print_records(registry.find(args.type, args.tag))
+    elif args.command == 'path':
+        print(registry.lookup(args.type, args.tag or LATEST, args.id)['path'])
+    elif args.command == 'data':
+        # 给shell脚本用的，只有因子csv才能直接拿去回测、评测，没有登记数据、或者是因子存储的目录，都报错退出
+        record = registry.lookup(args.type, args.tag or LATEST, args.id)
+        data_path = record['data_path']
+        if not data_path or not os.path.isfile(data_path) or not data_path.endswith('.csv'):
+            raise ValueError(f"模型[id={record['id']}]的训练数据[{data_path}]不是一个存在的因子csv文件")
+        print(data_path)
+    elif args.command == 'tag':
+        registry.tag(args.id, args.tag)
+    elif args.command == 'register':
+        registry.register(args.file, args.type, os.path.basename(args.file), data_path=args.data)
+    else:
+        raise ValueError(f"无效的命令：{args.command}")
@@ -0,0 +1,345 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import joblib
+
+from mlstock.const import TARGET_HORIZONS
+from mlstock.utils import utils, instrument
+from mlstock.utils.hash_utils import hash_file, hash_files, hash_object
+
+logger = logging.getLogger(__name__)
+
+"""
+一站式的流水线：加载数据 → 计算因子 → 计算target → 清洗 → 训练 → 评测 → 回测
+
+之前是用bin/pipeline.sh串起来prepare_factor/train/evaluate/backtest几个脚本，靠 `ls -1rt | tail -n 1` 找上一步的产出，
+而且因子计算和清洗在一个函数里，清洗一失败，几个小时的因子计算就白算了。
+
+现在每个阶段(stage)都有一个产出物(artifact)，落盘到checkpoint目录，并记录到manifest.json里：
+    - 产出物的类型（pickle/csv/json）、路径、内容哈希、附加信息(meta，如因子名、股票数、模型路径)
+    - 这个阶段的参数哈希，和它依赖的上游阶段的产出物哈希
+再次运行的时候，如果某个阶段的参数和上游产出物的哈希都没变，且产出物文件还在，就直接跳过它；
+也可以用 --from_stage 指定从某个阶段开始（强制）重跑，上游阶段则直接复用checkpoint。
+"""
+
+STAGES = ['load', 'factors', 'targets', 'clean', 'train', 'evaluate', 'backtest']
+
+# 每个阶段依赖的上游阶段
+DEPENDENCIES = {
+    'load': [],
+    'factors': ['load'],
+    'targets': ['factors'],
+    'clean': ['targets'],
+    'train': ['clean'],
+    'evaluate': ['clean', 'train'],
+    'backtest': ['clean', 'train']
+}
+
+CHECKPOINT_DIR = "data/pipeline"
+
+
+class Artifact:
+    """
+    阶段的产出物
+    kind: pickle(joblib序列化的python对象) | csv(因子数据文件) | json(模型路径、指标等)
+    """
+
+    def __init__(self, stage, kind, path, hash, meta=None):
+        self.stage = stage
+        self.kind = kind
+        self.path = path
+        self.hash = hash
+        self.meta = meta if meta else {}
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def to_dict(self):
+        return {'stage': self.stage, 'kind': self.kind, 'path': self.path, 'hash': self.hash, 'meta': self.meta}
+
+    @staticmethod
+    def from_dict(d):
+        return Artifact(d['stage'], d['kind'], d['path'], d['hash'], d.get('meta'))
+
+
+class Pipeline:
+
+    def __init__(self, start_date, end_date, split_date, num, is_industry_neutral,
+                 backtest_type='deliberate', checkpoint_dir=CHECKPOINT_DIR, horizons=None, orthogonalize=None):
+        """
+        :param start_date: 数据的开始日期
+        :param end_date: 数据的结束日期
+        :param split_date: 训练集和测试集的分割日期，[start_date,split_date)训练，[split_date,end_date]评测和回测
+        :param num: 股票数量，调试用
+        :param is_industry_neutral: 是否做行业中性化
+        :param backtest_type: simple|deliberate
+        :param checkpoint_dir: checkpoint的存放目录
+        :param horizons: 预测目标的周期列表(周)，默认const.TARGET_HORIZONS
+        :param orthogonalize: 因子组正交化的方法，gram_schmidt|symmetric|pca，None为不做
+        """
+        self.start_date = start_date
+        self.end_date = end_date
+        self.split_date = split_date
+        self.num = num
+        self.is_industry_neutral = is_industry_neutral
+        self.backtest_type = backtest_type
+        self.checkpoint_dir = checkpoint_dir
+        self.horizons = horizons if horizons else TARGET_HORIZONS
+        self.orthogonalize = orthogonalize
+        self.manifest_path = os.path.join(checkpoint_dir, "manifest.json")
+        self.manifest = self._load_manifest()
+        self.artifacts = {}
+        self._values = {}  # 本次运行中已经加载到内存的产出物，防止相邻阶段反复读盘
+        self._data_source = None
+
+    # ---------------------------------------- 调度 ----------------------------------------
+
+    def run(self, from_stage=None, to_stage=None):
+        """
+        :param from_stage: 从哪个阶段开始强制重跑，None则只重跑有变化的阶段
+        :param to_stage: 运行到哪个阶段为止（包含），None则运行到最后
+        :return: 各个阶段的产出物
+        """
+        if from_stage is not None and from_stage not in STAGES:
+            raise ValueError(f"无效的阶段名：{from_stage}，必须是{STAGES}之一")
+        if to_stage is not None and to_stage not in STAGES:
+            raise ValueError(f"无效的阶段名：{to_stage}，必须是{STAGES}之一")
+
+        from_index = STAGES.index(from_stage) if from_stage else len(STAGES)
+        to_index = STAGES.index(to_stage) if to_stage else len(STAGES) - 1
+
+        start_time = time.time()
+        for index, stage in enumerate(STAGES[:to_index + 1]):
+            inputs = {dep: self.artifacts[dep] for dep in DEPENDENCIES[stage]}
+            params_hash = hash_object(self._stage_params(stage))
+            inputs_hash = {name: artifact.hash for name, artifact in inputs.items()}
+
+            if index < from_index and self._is_up_to_date(stage, params_hash, inputs_hash):
+                self.artifacts[stage] = Artifact.from_dict(self.manifest[stage]['artifact'])
+                logger.info("阶段[%s]的参数和输入都没有变化，复用checkpoint：%s", stage, self.artifacts[stage].path)
+                continue
+
+            logger.info(" ================ 开始运行阶段[%s] ================", stage)
+            stage_start_time = time.time()
+            with instrument.stage(stage):
+                artifact = getattr(self, f"_run_{stage}")(inputs)
+            self.artifacts[stage] = artifact
+            self._release(index)
+            self.manifest[stage] = {
+                'params': params_hash,
+                'inputs': inputs_hash,
+                'artifact': artifact.to_dict(),
+                'seconds': time.time() - stage_start_time,
+                'time': utils.now()
+            }
+            # 每个阶段完成都立刻保存manifest，这样后面的阶段失败了，前面的也不用重跑
+            self._save_manifest()
+            utils.time_elapse(stage_start_time, f"阶段[{stage}]")
+
+        utils.time_elapse(start_time, "⭐️ 整个流水线")
+        return self.artifacts
+
+    def _release(self, index):
+        """后面的阶段不再依赖的产出物，从内存中释放掉，几个G的DataFrame不能一直留着"""
+        needed = set()
+        for stage in STAGES[index + 1:]:
+            needed.update(DEPENDENCIES[stage])
+        for stage in list(self._values.keys()):
+            if stage not in needed and stage != STAGES[index]:
+                self._values.pop(stage)
+
+    def _is_up_to_date(self, stage, params_hash, inputs_hash):
+        record = self.manifest.get(stage)
+        if record is None: return False
+        if record['params'] != params_hash: return False
+        if record['inputs'] != inputs_hash: return False
+        return Artifact.from_dict(record['artifact']).exists()
+
+    def _stage_params(self, stage):
+        """每个阶段相关的参数，参数变了，这个阶段就要重跑"""
+        from mlstock.ml.data.factor_conf import FACTORS, load_selection
+
+        if stage == 'load': return [self.start_date, self.end_date, self.num]
+        if stage == 'factors': return [f.__name__ for f in FACTORS]
+        if stage == 'targets': return [self.start_date, self.end_date, self.horizons]
+        if stage == 'clean': return [self.start_date, self.end_date, self.is_industry_neutral, self.orthogonalize]
+        if stage == 'train': return [self.start_date, self.split_date, sorted(load_selection() or [])]
+        if stage == 'evaluate': return [self.split_date, self.end_date]
+        if stage == 'backtest': return [self.split_date, self.end_date, self.backtest_type]
+        raise ValueError(f"无效的阶段名：{stage}")
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path): return {}
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_manifest(self):
+        if not os.path.exists(self.checkpoint_dir): os.makedirs(self.checkpoint_dir)
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=4)
+
+    # ---------------------------------------- 产出物的读写 ----------------------------------------
+
+    def _path(self, stage, suffix):
+        if not os.path.exists(self.checkpoint_dir): os.makedirs(self.checkpoint_dir)
+        return os.path.join(self.checkpoint_dir, f"{stage}.{suffix}")
+
+    def _dump_pickle(self, stage, value, meta):
+        path = self._path(stage, "pkl")
+        joblib.dump(value, path)
+        self._values[stage] = value
+        return Artifact(stage, 'pickle', path, hash_file(path), meta)
+
+    def _dump_json(self, stage, value, meta, hash=None):
+        path = self._path(stage, "json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False, indent=4, default=str)
+        return Artifact(stage, 'json', path, hash if hash else hash_file(path), meta)
+
+    def _load(self, artifact):
+        if artifact.stage in self._values: return self._values[artifact.stage]
+        logger.info("从checkpoint加载阶段[%s]的产出物：%s", artifact.stage, artifact.path)
+        if artifact.kind == 'pickle':
+            value = joblib.load(artifact.path)
+        elif artifact.kind == 'json':
+            with open(artifact.path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        else:
+            raise ValueError(f"产出物[{artifact.path}]的类型[{artifact.kind}]无法直接加载")
+        self._values[artifact.stage] = value
+        return value
+
+    @property
+    def data_source(self):
+        if self._data_source is None:
+            from mlstock.data.datasource import DataSource
+            self._data_source = DataSource()
+        return self._data_source
+
+    # ---------------------------------------- 各个阶段 ----------------------------------------
+
+    def _run_load(self, inputs):
+        from mlstock.ml.data import factor_service
+
+        stock_data, ts_codes = factor_service.load_stock_data(self.data_source, self.start_date, self.end_date,
+                                                              self.num)
+        return self._dump_pickle('load', (stock_data, ts_codes), {'stock_num': len(ts_codes)})
+
+    def _run_factors(self, inputs):
+        from mlstock.data.stock_info import StocksInfo
+        from mlstock.ml.data import factor_service
+        from mlstock.ml.data.factor_conf import FACTORS
+
+        stock_data, ts_codes = self._load(inputs['load'])
+        df_weekly, factor_names = factor_service.calculate_factors(FACTORS, self.data_source, stock_data,
+                                                                   StocksInfo(ts_codes, self.start_date,
+                                                                              self.end_date))
+        meta = dict(inputs['load'].meta, factor_names=factor_names)
+        return self._dump_pickle('factors', df_weekly, meta)
+
+    def _run_targets(self, inputs):
+        from mlstock.ml.data import factor_service
+
+        df_weekly = self._load(inputs['factors'])
+        df_weekly = factor_service.prepare_target(df_weekly, self.start_date, self.end_date, self.data_source,
+                                                  self.horizons)
+        return self._dump_pickle('targets', df_weekly, inputs['factors'].meta)
+
+    def _run_clean(self, inputs):
+        from mlstock.ml.data import factor_service
+        from mlstock.ml.data.preprocessor import FactorPreprocessor, preprocessor_path
+
+        meta = inputs['targets'].meta
+        df_weekly = self._load(inputs['targets'])
+        preprocessor = FactorPreprocessor(meta['factor_names'])
+        df_weekly = factor_service.clean_factors(df_weekly, meta['factor_names'], self.start_date, self.end_date,
+                                                 self.is_industry_neutral, preprocessor=preprocessor,
+                                                 orthogonalize=self.orthogonalize)
+        csv_path = factor_service.save_factors(df_weekly, self.start_date, self.end_date, meta['stock_num'],
+                                               self.is_industry_neutral)
+        preprocessor.save(preprocessor_path(csv_path))
+        return Artifact('clean', 'csv', csv_path, hash_file(csv_path), meta)
+
+    def _run_train(self, inputs):
+        from mlstock.ml import train
+        from mlstock.ml.data import factor_conf
+
+        # 清洗阶段保留所有的因子，训练和命令行(train.py)一样，只用精简后的因子
+        clean = inputs['clean']
+        model_pct_path, model_winloss_path = train.main(clean.path, self.start_date, self.split_date, 'all',
+                                                        factor_conf.select_factor_names(clean.meta['factor_names']))
+        models = {'pct': model_pct_path, 'winloss': model_winloss_path}
+        return self._dump_json('train', models, models, hash=hash_files([model_pct_path, model_winloss_path]))
+
+    def _run_evaluate(self, inputs):
+        from mlstock.ml import evaluate
+
+        models = inputs['train'].meta
+        result = evaluate.evaluate(inputs['clean'].path, self.split_date, self.end_date,
+                                   models['pct'], models['winloss'])
+        return self._dump_json('evaluate', result, {})
+
+    def _run_backtest(self, inputs):
+        from mlstock.ml import backtest
+        from mlstock.ml.backtests import plotting
+        from mlstock.ml.data import factor_conf
+
+        # 模型在仓库里登记了训练时的因子，打分用登记的，这里的因子列表只是兜底
+        clean = inputs['clean']
+        models = inputs['train'].meta
+        result = backtest.main(self.backtest_type, clean.path, self.split_date, self.end_date,
+                               models['pct'], models['winloss'],
+                               factor_conf.select_factor_names(clean.meta['factor_names']))
+        plotting.wait()
+        return self._dump_json('backtest', result, {})
+
+
+"""
+python -m mlstock.ml.pipeline -in -s 20080101 -e 20220901 -sp 20190101
+python -m mlstock.ml.pipeline -in -n 50 --from_stage clean  # 调试模式，且从清洗阶段开始重跑
+"""
+if __name__ == '__main__':
+    utils.init_logger(file=True)
+
+    parser = argparse.ArgumentParser()
+
+    # 数据相关的
+    parser.add_argument('-s', '--start_date', type=str, default="20080101", help="开始日期")
+    parser.add_argument('-e', '--end_date', type=str, default="20220901", help="结束日期")
+    parser.add_argument('-sp', '--split_date', type=str, default="20190101", help="训练和测试的分割日期")
+    parser.add_argument('-n', '--num', type=int, default=100000, help="股票数量，调试用")
+    parser.add_argument('-in', '--industry_neutral', action='store_true', default=False, help="是否做行业中性处理")
+    parser.add_argument('-hz', '--horizons', type=str, default=None, help="预测目标的周期(周)，逗号分隔，如：1,2,4,12")
+    parser.add_argument('-og', '--orthogonalize', type=str, default=None,
+                        help="因子组正交化的方法：gram_schmidt|symmetric|pca，默认不做")
+
+    # 流水线相关的
+    parser.add_argument('-t', '--type', type=str, default="deliberate", help="回测类型：simple|deliberate")
+    parser.add_argument('-f', '--from_stage', type=str, default=None, help=f"从哪个阶段开始重跑：{'|'.join(STAGES)}")
+    parser.add_argument('-to', '--to_stage', type=str, default=None, help="运行到哪个阶段为止")
+    parser.add_argument('-c', '--checkpoint_dir', type=str, default=CHECKPOINT_DIR, help="checkpoint目录")
+
+    # 埋点相关的
+    parser.add_argument('-tm', '--trace_memory', action='store_true', default=False, help="是否用tracemalloc跟踪内存")
+    parser.add_argument('-p', '--profile', type=str, default=None, help="需要做cProfile的阶段，逗号分隔，如：clean,train")
+
+    args = parser.parse_args()
+
+    instrument.configure(args.trace_memory, args.profile.split(",") if args.profile else None)
+
+    pipeline = Pipeline(args.start_date,
+                        args.end_date,
+                        args.split_date,
+                        args.num,
+                        args.industry_neutral,
+                        args.type,
+                        args.checkpoint_dir,
+                        [int(h) for h in args.horizons.split(",")] if args.horizons else None,
+                        args.orthogonalize)
+    try:
+        pipeline.run(args.from_stage, args.to_stage)
+    finally:
+        instrument.save_report(extra=vars(args))
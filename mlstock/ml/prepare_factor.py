@@ -2,7 +2,7 @@ import argparse
 
 from mlstock.ml.data import factor_service
 from mlstock.ml.data.factor_conf import FACTORS
-from mlstock.utils import utils
+from mlstock.utils import utils, instrument
 
 
 def main(args):
@@ -10,9 +10,12 @@ def main(args):
     end_date = args.end_date
     num = args.num
     is_industry_neutral = args.industry_neutral
+    horizons = [int(h) for h in args.horizons.split(",")] if args.horizons else None
 
     # 那么就需要从新计算了
-    df_weekly, factor_names, csv_path = factor_service.calculate(FACTORS, start_date, end_date, num, is_industry_neutral)
+    df_weekly, factor_names, csv_path = factor_service.calculate(FACTORS, start_date, end_date, num,
+                                                                 is_industry_neutral, horizons, args.diagnose,
+                                                                 args.orthogonalize)
     return df_weekly, factor_names
 
 """
@@ -29,7 +32,17 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--num', type=int, default=100000, help="股票数量，调试用")
 
     parser.add_argument('-in', '--industry_neutral', action='store_true', default=False, help="是否做行业中性处理")
+    parser.add_argument('-hz', '--horizons', type=str, default=None, help="预测目标的周期(周)，逗号分隔，如：1,2,4,12")
+    parser.add_argument('-og', '--orthogonalize', type=str, default=None,
+                        help="因子组正交化的方法：gram_schmidt|symmetric|pca，默认不做")
+    parser.add_argument('-dg', '--diagnose', action='store_true', default=False, help="是否输出清洗过程的诊断信息")
+
+    # 埋点相关的
+    parser.add_argument('-tm', '--trace_memory', action='store_true', default=False, help="是否用tracemalloc跟踪内存")
+    parser.add_argument('-p', '--profile', type=str, default=None, help="需要做cProfile的阶段，逗号分隔，如：clean,factors")
 
     args = parser.parse_args()
 
+    instrument.configure(args.trace_memory, args.profile.split(",") if args.profile else None)
     df_data, factor_names = main(args)
+    instrument.save_report(extra=vars(args))
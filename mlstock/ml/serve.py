@@ -0,0 +1,239 @@
+import argparse
+import json
+import logging
+import os
+import socketserver
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from mlstock.ml.data.preprocessor import FactorPreprocessor, preprocessor_path
+from mlstock.ml.model_registry import ModelRegistry, load_model, check_feature_num, LATEST
+from mlstock.utils import utils
+
+logger = logging.getLogger(__name__)
+
+"""
+常驻的预测服务，给每周的实盘打分用。
+
+backtest/evaluate每次都要重新读整个因子csv、joblib.load两个模型，而实盘每周只需要给最新的一个截面打分。
+这个服务启动时把Ridge(收益)、XGBoost(涨跌)模型和因子预处理的状态(去极值、标准化、中性化)加载到内存里，
+之后每个请求只做预处理+预测，几百上千只股票是毫秒级的。
+
+接口(HTTP，监听端口或者unix socket)：
+    GET  /health    模型的信息
+    POST /predict   {"raw": true, "rows": [{"ts_code": "000001.SZ", "factors": [..] 或者 {"因子名": 值}, ...}]}
+                    raw=true表示是原始的因子，要先做预处理；false表示已经是清洗后的因子(和训练的csv一样)
+                    行业中性化的模型，原始因子还需要提供行业(industry)和市值对数(total_market_value_log)
+            返回    {"rows": [{"ts_code", "pct_pred", "winloss_pred", "winloss_prob"}], "elapsed_ms": 1.2}
+"""
+
+MAX_BODY_SIZE = 64 << 20  # 一次最多64M的请求
+
+
+class Scorer:
+    """加载好模型和预处理状态的打分器，和HTTP无关，可以直接在代码里用"""
+
+    def __init__(self, model_pct_path, model_winloss_path, factor_names, preprocessor_file=None):
+        self.factor_names = list(factor_names)
+        self.model_pct_path = model_pct_path
+        self.model_winloss_path = model_winloss_path
+        self.model_pct = load_model(model_pct_path) if model_pct_path else None
+        self.model_winloss = load_model(model_winloss_path) if model_winloss_path else None
+        if self.model_pct is None and self.model_winloss is None:
+            raise ValueError("收益模型和涨跌模型至少要提供一个")
+        check_feature_num(self.model_pct, self.factor_names, model_pct_path)
+        check_feature_num(self.model_winloss, self.factor_names, model_winloss_path)
+        self.preprocessor = FactorPreprocessor.load(preprocessor_file) if preprocessor_file else None
+        self.preprocessor_file = preprocessor_file
+        self._warm_up()
+
+    def _warm_up(self):
+        """先预测一次，第一个请求不用等模型的懒加载(如xgboost的线程池)"""
+        self.predict(np.zeros((1, len(self.factor_names)), dtype=np.float32))
+
+    def predict(self, X):
+        result = {}
+        if self.model_pct is not None:
+            result['pct_pred'] = self.model_pct.predict(X)
+        if self.model_winloss is not None:
+            if hasattr(self.model_winloss, 'predict_proba'):
+                prob = self.model_winloss.predict_proba(X)[:, 1]
+                result['winloss_prob'] = prob
+                result['winloss_pred'] = (prob > 0.5).astype(int)
+            else:
+                result['winloss_pred'] = self.model_winloss.predict(X)
+        return result
+
+    def score(self, rows, raw=True):
+        """
+        :param rows: [{'ts_code':..., 'factors': [..]或{因子名:值}, 其他列(行业、市值)}]
+        :param raw: 是否是原始因子，是的话先做和训练数据一样的预处理
+        :return: [{'ts_code', 'pct_pred', 'winloss_pred', 'winloss_prob'}]
+        """
+        if len(rows) == 0: return []
+        df = self._to_dataframe(rows)
+        if raw:
+            if self.preprocessor is None:
+                raise ValueError("没有加载因子预处理的状态，只能预测清洗后的因子(raw=false)")
+            missing = [c for c in self.preprocessor.required_columns if c not in df.columns]
+            if missing: raise ValueError(f"行业中性化需要提供：{missing}")
+            df = self.preprocessor.transform(df)
+
+        X = df[self.factor_names].values.astype(np.float32)
+        # 标准化后的均值是0，缺失的因子用0填充
+        X[np.isnan(X)] = 0
+        result = self.predict(X)
+
+        df_result = pd.DataFrame({'ts_code': df.ts_code.values})
+        for name, values in result.items():
+            df_result[name] = values
+        return df_result.to_dict(orient='records')
+
+    def _to_dataframe(self, rows):
+        factors = [row['factors'] for row in rows]
+        if isinstance(factors[0], dict):
+            df = pd.DataFrame(factors).reindex(columns=self.factor_names)
+        else:
+            X = np.asarray(factors, dtype=np.float64)
+            if X.ndim != 2 or X.shape[1] != len(self.factor_names):
+                raise ValueError(f"因子的个数不对：需要{len(self.factor_names)}个，实际{X.shape}")
+            df = pd.DataFrame(X, columns=self.factor_names)
+        df['ts_code'] = [row.get('ts_code') for row in rows]
+        for column in set().union(*[row.keys() for row in rows]) - {'ts_code', 'factors'}:
+            df[column] = [row.get(column) for row in rows]
+        return df
+
+    def info(self):
+        return {'model_pct': self.model_pct_path,
+                'model_winloss': self.model_winloss_path,
+                'preprocessor': self.preprocessor_file,
+                'factor_num': len(self.factor_names),
+                'factor_names': self.factor_names}
+
+
+class ScoreHandler(BaseHTTPRequestHandler):
+    scorer = None  # 由make_server设置
+
+    def do_GET(self):
+        if self.path != '/health': return self._reply(404, {'error': f"无效的路径：{self.path}"})
+        self._reply(200, self.scorer.info())
+
+    def do_POST(self):
+        if self.path != '/predict': return self._reply(404, {'error': f"无效的路径：{self.path}"})
+        start_time = time.time()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > MAX_BODY_SIZE: raise ValueError(f"请求太大：{length}字节")
+            request = json.loads(self.rfile.read(length))
+            rows = self.scorer.score(request.get('rows', []), request.get('raw', True))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._reply(400, {'error': str(e)})
+        except Exception as e:
+            logger.exception("预测失败")
+            return self._reply(500, {'error': str(e)})
+        elapsed_ms = (time.time() - start_time) * 1000
+        logger.debug("预测%d行，耗时%.1f毫秒", len(rows), elapsed_ms)
+        self._reply(200, {'rows': rows, 'elapsed_ms': elapsed_ms})
+
+    def _reply(self, status, body):
+        data = json.dumps(body, ensure_ascii=False, default=_to_json).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # unix socket的client_address是空的，默认的log_message会出错，统一打到logger里
+        logger.debug(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+def make_server(scorer, port=None, unix_socket=None, host='127.0.0.1'):
+    """创建HTTP服务，提供unix_socket就监听unix socket，否则监听host:port"""
+    handler = type('Handler', (ScoreHandler,), {'scorer': scorer})
+    if unix_socket:
+        if os.path.exists(unix_socket): os.remove(unix_socket)
+        return UnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def load_scorer(model_pct_path=None, model_winloss_path=None, preprocessor_file=None, tag=LATEST):
+    """
+    没有指定模型的话，从模型仓库里找标签为tag的模型，因子列表用模型登记时的，预处理状态用训练数据对应的，
+    两个模型的因子列表必须一样(一个请求只传一组因子)，都没登记的模型文件才用当前配置的因子
+    """
+    registry = ModelRegistry()
+    record_pct = registry.find_by_path(model_pct_path) if model_pct_path else registry.lookup('pct', tag)
+    record_winloss = registry.find_by_path(model_winloss_path) if model_winloss_path \
+        else registry.lookup('winloss', tag)
+    record = record_pct or record_winloss
+    registered = [r['factor_names'] for r in [record_pct, record_winloss] if r is not None and r['factor_names']]
+    if len(registered) == 2 and registered[0] != registered[1]:
+        raise ValueError(f"收益模型和涨跌模型训练时用的因子不一样({len(registered[0])}个 vs {len(registered[1])}个)，"
+                         f"不能用同一组因子打分")
+    if len(registered) == 0:
+        from mlstock.ml.data import factor_conf
+        factor_names = factor_conf.get_factor_names()
+    else:
+        factor_names = registered[0]
+
+    if preprocessor_file is None and record is not None and record['data_path']:
+        candidate = preprocessor_path(record['data_path'])
+        if os.path.exists(candidate): preprocessor_file = candidate
+    if preprocessor_file is None: logger.warning("没有找到因子预处理的状态，只能预测清洗后的因子(raw=false)")
+
+    return Scorer(model_pct_path or record_pct['path'],
+                  model_winloss_path or record_winloss['path'],
+                  factor_names,
+                  preprocessor_file)
+
+
+def _to_json(value):
+    if isinstance(value, np.generic): return value.item()
+    raise TypeError(f"无法json化：{type(value)}")
+
+
+"""
+python -m mlstock.ml.serve -p 8765
+python -m mlstock.ml.serve -u /tmp/mlstock.sock -g prod
+python -m mlstock.ml.serve -p 8765 \
+-mp model/blobs/pct_ridge_20220902112320.model \
+-mw model/blobs/winloss_xgboost_20220902112813.model \
+-pp data/factor_20080101_20220901_2954_1299032__industry_neutral_20220902112049.preprocessor.pkl
+
+curl -s localhost:8765/predict -d '{"raw": false, "rows": [{"ts_code": "000001.SZ", "factors": [0.1, ...]}]}'
+"""
+if __name__ == '__main__':
+    utils.init_logger(file=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=8765, help="HTTP端口")
+    parser.add_argument('-ho', '--host', type=str, default='127.0.0.1', help="监听的地址")
+    parser.add_argument('-u', '--unix_socket', type=str, default=None, help="监听unix socket，而不是端口")
+    parser.add_argument('-mp', '--model_pct', type=str, default=None, help="收益率模型，默认从模型仓库里找")
+    parser.add_argument('-mw', '--model_winloss', type=str, default=None, help="涨跌模型，默认从模型仓库里找")
+    parser.add_argument('-g', '--tag', type=str, default=LATEST, help="从模型仓库里找模型的标签")
+    parser.add_argument('-pp', '--preprocessor', type=str, default=None, help="因子预处理的状态文件")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    scorer = load_scorer(args.model_pct, args.model_winloss, args.preprocessor, args.tag)
+    server = make_server(scorer, args.port, args.unix_socket, args.host)
+    utils.time_elapse(start_time, "加载模型")
+    logger.info("预测服务启动：%s", args.unix_socket if args.unix_socket else f"{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("预测服务退出")
+    finally:
+        server.server_close()
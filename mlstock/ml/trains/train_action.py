@@ -1,19 +1,22 @@
 import logging
-import os.path
 import time
 
-import joblib
-
 from mlstock.const import TRAIN_TEST_SPLIT_DATE
+from mlstock.ml.model_registry import ModelRegistry
+from mlstock.utils import instrument
 from mlstock.utils.utils import time_elapse
 
 logger = logging.getLogger(__name__)
 
 
 class TrainAction:
+    model_type = None  # 模型仓库里的类型：pct | winloss
 
     def __init__(self, factor_names):
         self.factor_names = factor_names
+        self.trade_dates = None  # 训练数据每行的日期，按时间排好序的，子类做按时间切分的交叉验证用
+        self.params = {}  # 训练得到的超参，子类设置，登记到模型仓库
+        self.metrics = {}  # 训练时验证集上的指标，子类设置，登记到模型仓库
 
     def set_target(self):
         raise NotImplemented()
@@ -21,22 +24,62 @@ class TrainAction:
     def _train(self, X_train, y_train):
         raise NotImplemented()
 
-    def train(self, df_weekly):
+    def fit(self, df_train):
+        """
+        用给定的训练数据训练，返回模型，不保存，walk-forward每个fold都会调用它
+        """
         # 根据子类，来调整target（分类要变成0:1)
-        df_weekly = self.set_target(df_weekly)
+        df_train = self.set_target(df_train)
+        # 按时间排序，交叉验证要按时间切分，不能用随机的K-Fold，否则用未来的数据验证过去，会泄露
+        df_train = df_train.sort_values('trade_date', kind='stable')
+        self.trade_dates = df_train.trade_date.values
+        X_train = df_train[self.factor_names].values
+        y_train = df_train.target
+
+        logger.debug("开始训练：数据行数和特征数：%r", X_train.shape)
+        with instrument.stage(f"train/{self.__class__.__name__}", len(X_train)):
+            return self._train(X_train, y_train)
+
+    def _train_store(self, store, start_date, end_date):
+        raise NotImplemented()
+
+    def fit_store(self, store, start_date=None, end_date=None):
+        """
+        从分区的因子存储(FactorStore)里一个分片一个分片的流式训练，不把全量数据加载到内存，返回模型，不保存
+        :param start_date: 开始日期(含)
+        :param end_date: 结束日期(含)
+        """
+        shards = store.select_shards(start_date, end_date)
+        logger.debug("开始流式训练：%s~%s，%d个分片，因子数：%d", start_date, end_date, len(shards), len(self.factor_names))
+        with instrument.stage(f"train_store/{self.__class__.__name__}", sum(shard['rows'] for shard in shards)):
+            return self._train_store(store, start_date, end_date)
 
+    def train_store(self, store, start_date=None, end_date=None):
+        """和train一样，只用TRAIN_TEST_SPLIT_DATE之前的数据，训练完保存模型"""
+        last_date = int(TRAIN_TEST_SPLIT_DATE) - 1  # 存储里的日期是int，< 20190101 等价于 <= 20190100
+        end_date = last_date if end_date is None else min(int(end_date), last_date)
+
+        start_time = time.time()
+        model = self.fit_store(store, start_date, end_date)
+        dates = store.dates(start_date, end_date)
+        model_path = self.save_model(model, dates.min(), dates.max(), store.root, time.time() - start_time)
+        time_elapse(start_time, "⭐️ 流式训练完成")
+
+        return model_path
+
+    def train(self, df_weekly, data_path=None):
+        """
+        :param data_path: 训练数据的文件路径，登记到模型仓库(记录它的哈希)
+        """
         # 划分训练集和测试集，测试集占总数据的15%，随机种子为10(如果不定义，会每次都不一样）
         # 2009.1~2022.8,165个月，Test比例0.3，大约是2019.1~2022.8，正好合适
         df_train = df_weekly[df_weekly.trade_date < TRAIN_TEST_SPLIT_DATE]
-        df_test = df_weekly[df_weekly.trade_date >= TRAIN_TEST_SPLIT_DATE]
-        X_train = df_train[self.factor_names].values
-        y_train = df_train.target
 
         # 训练
         start_time = time.time()
-        logger.debug("开始训练：数据行数和特征数：%r",X_train.shape)
-        model = self._train(X_train, y_train)
-        model_path = self.save_model(model)
+        model = self.fit(df_train)
+        model_path = self.save_model(model, df_train.trade_date.min(), df_train.trade_date.max(), data_path,
+                                     time.time() - start_time)
         time_elapse(start_time, "⭐️ 训练完成")
 
         return model_path
@@ -44,9 +87,18 @@ class TrainAction:
     def get_model_name(self):
         raise NotImplemented()
 
-    def save_model(self, model):
-        if not os.path.exists("./model"): os.mkdir("./model")
-        model_file_path = f"./model/{self.get_model_name()}"
-        joblib.dump(model, model_file_path)
-        logger.info("训练结果保存到：%s", model_file_path)
-        return model_file_path
+    def save_model(self, model, start_date=None, end_date=None, data_path=None, train_seconds=None):
+        """
+        保存模型到模型仓库，记录因子、训练区间、数据、超参、指标和训练耗时
+        :return: 模型文件的路径
+        """
+        record = ModelRegistry().register(model, self.model_type, self.get_model_name(),
+                                          factor_names=self.factor_names,
+                                          start_date=start_date,
+                                          end_date=end_date,
+                                          data_path=data_path,
+                                          params=self.params,
+                                          metrics=self.metrics,
+                                          train_seconds=train_seconds)
+        logger.info("训练结果保存到：%s", record['path'])
+        return record['path']
@@ -1,19 +1,34 @@
 import logging
-import time
 
-import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 from sklearn.linear_model import Ridge
-from sklearn.model_selection import cross_val_score
 
 from mlstock.ml.trains.train_action import TrainAction
 from mlstock.utils import utils
-from mlstock.utils.utils import time_elapse
 
 logger = logging.getLogger(__name__)
 
+ALPHA_SCOPE = np.arange(start=1, stop=200, step=10)
+CV_FOLDS = 5
+SEARCH_METHOD = 'cv'  # cv | gcv
+CHUNK_ROWS = 200000  # 累加统计量时，每次转成float64的行数
+
 
 class TrainPct(TrainAction):
+    model_type = 'pct'
+
+    def __init__(self, factor_names, alpha_scope=ALPHA_SCOPE, method=SEARCH_METHOD, cv=CV_FOLDS):
+        """
+        :param alpha_scope: 岭回归的超参alpha的搜索范围
+        :param method: cv：按时间顺序的前向交叉验证；gcv：广义交叉验证，只用全量数据算一次
+        :param cv: 前向交叉验证的折数
+        """
+        super().__init__(factor_names)
+        self.alpha_scope = np.asarray(alpha_scope, dtype=np.float64)
+        self.method = method
+        self.cv = cv
+        self.alpha_scores = None
 
     def get_model_name(self):
         return f"pct_ridge_{utils.now()}.model"
@@ -23,53 +38,218 @@ class TrainPct(TrainAction):
 
     def _train(self, X_train, y_train):
         """用岭回归预测下周收益"""
-        best_hyperparam = self.search_best_hyperparams(X_train, y_train)
+        best_hyperparam, self.alpha_scores = self.search_best_hyperparams(X_train, y_train)
         ridge = Ridge(alpha=best_hyperparam)
         ridge.fit(X_train, y_train)
+        ridge.alpha_scores_ = self.alpha_scores  # 超参的搜索结果，随模型一起保存
         return ridge
 
     def search_best_hyperparams(self, X_train, y_train):
         """
-        超找最好的超参
-        :param X_train:
-        :param y_train:
-        :return:
+        找最好的超参alpha
+
+        之前是对20个alpha，每个都cross_val_score(Ridge(alpha), cv=10)，是200次全量数据的Ridge拟合，
+        而且随机的K-Fold用未来的数据验证过去，有泄露。现在：
+        - 岭回归的解 w = (XᵀX + αI)⁻¹Xᵀy，对XᵀX做一次特征分解 XᵀX = V diag(s) Vᵀ，
+          所有的α的解都是 w(α) = V diag(1/(s+α)) Vᵀ Xᵀy，一次算出整条alpha路径
+        - 数据按时间分成cv+1段，第k折用前k段训练，第k+1段验证(前向)，
+          每段的XᵀX、Xᵀy只算一次，训练集的统计量是累加出来的，整个搜索只遍历数据两遍
+        - 或者用GCV(广义交叉验证)，只需要全量数据的一次特征分解
+        :return: 最好的alpha，每个alpha的得分(DataFrame，index是alpha)
+        """
+        X = np.asarray(X_train, dtype=np.float64)
+        y = np.asarray(y_train, dtype=np.float64)
+
+        if self.method == 'gcv':
+            df_scores = gcv_scores(X, y, self.alpha_scope)
+        elif self.method == 'cv':
+            df_scores = forward_cv_scores(X, y, self.alpha_scope, self._fold_bounds(len(X)))
+        else:
+            raise ValueError(f"无效的超参搜索方法：{self.method}")
+        return self._select(df_scores)
+
+    def _select(self, df_scores):
+        best_hyperparam = df_scores['mse'].idxmin()
+        self.params = {'alpha': float(best_hyperparam), 'method': self.method, 'cv': self.cv}
+        self.metrics = {'valid_mse': float(df_scores['mse'].min())}
+        logger.info("超参数/验证集的均方误差：\n%r", df_scores)
+        logger.info("Best超参数为：%.0f, Best均方误差：%.6f", best_hyperparam, df_scores['mse'].min())
+        return best_hyperparam, df_scores
+
+    def _train_store(self, store, start_date, end_date):
+        """
+        out-of-core训练：流式读每个分片，把它累加到所属的时间段的统计量(GramStats)上，
+        交叉验证和最终的拟合都只用统计量，内存里只有一个分片和几个 p x p 的矩阵
+        """
+        p = len(self.factor_names)
+        if self.method == 'gcv':
+            cut_dates = []
+        elif self.method == 'cv':
+            dates = store.dates(start_date, end_date)
+            cut_dates = dates[np.linspace(0, len(dates), self.cv + 2).astype(int)[1:-1]]
+        else:
+            raise ValueError(f"无效的超参搜索方法：{self.method}")
+
+        blocks = [GramStats(p) for _ in range(len(cut_dates) + 1)]
+        for batch in store.batches(start_date, end_date, factor_names=self.factor_names):
+            y = batch.targets[:, 0]
+            block_index = np.searchsorted(cut_dates, batch.dates, side='right')
+            for k in np.unique(block_index):
+                mask = block_index == k
+                if mask.all():
+                    blocks[k].update(batch.X, y)
+                else:
+                    blocks[k].update(batch.X[mask], y[mask])
+
+        if self.method == 'gcv':
+            df_scores = gcv_from_stats(blocks[0], self.alpha_scope)
+        else:
+            df_scores = forward_cv_from_stats(blocks, self.alpha_scope)
+        best_hyperparam, self.alpha_scores = self._select(df_scores)
+
+        total = blocks[0]
+        for block in blocks[1:]: total = total + block
+        coef, intercept = ridge_from_stats(total, best_hyperparam)
+
+        # 用解出来的系数构造Ridge，和内存训练的模型一样用(predict、coef_)
+        ridge = Ridge(alpha=best_hyperparam)
+        ridge.coef_, ridge.intercept_, ridge.n_features_in_ = coef, intercept, p
+        ridge.alpha_scores_ = self.alpha_scores
+        return ridge
+
+    def _fold_bounds(self, n):
+        """
+        按时间把数据分成cv+1段，返回每段的[开始,结束)行号，同一天的数据不会被分到两段里
+        没有日期信息时(直接调用_train)，按行号等分，要求数据已按时间排序
         """
-        # 做这个是为了人肉看一下最好的岭回归的超参alpha的最优值是啥
-        # 是没必要的，因为后面还会用 gridsearch自动跑一下，做这个就是想直观的感受一下
-        results = {}
-        alpha_scope = np.arange(start=1, stop=200, step=10)
-        for i in alpha_scope:
-            # Ridge和Lasso回归分别代表L1和L2的正则化，L1会把系数压缩到0，而L2则不会，同时L1还有挑选特征的作用
-            ridge = Ridge(alpha=i)
-            results[i] = cross_val_score(ridge, X_train, y_train, cv=10, scoring='neg_mean_squared_error').mean()
-
-        # 按照value排序：{1: 1, 2: 2, 3: 3} =>[(3, 3), (2, 2), (1, 1)]
-        sorted_results = sorted(results.items(), key=lambda x: (x[1], x[0]), reverse=True)
-
-        logger.info("超参数/样本和预测的均方误差：%r", results)
-        logger.info("Best超参数为：%.0f, Best均方误差的均值：%.2f", sorted_results[0][0], sorted_results[0][1])
-
-        # 保存超参的图像
-        fig = plt.figure(figsize=(20, 5))
-        plt.title('Best Alpha')
-        plt.plot(alpha_scope, [results[i] for i in alpha_scope], c="red", label="alpha")
-        plt.legend()
-        fig.savefig("data/best_alpha.jpg")
-
-        # 自动搜索，暂时保留，上面的代码中，我手工搜索了，还画了图
-        # # 用grid search找最好的alpha：[200,205,...,500]
-        # # grid search的参数是alpha，岭回归就这样一个参数，用于约束参数的平方和
-        # # grid search的入参包括alpha的范围，K-Fold的折数(cv)，还有岭回归评价的函数(负均方误差)
-        # grid_search = GridSearchCV(Ridge(),
-        #                            {'alpha': alpha_scope},
-        #                            cv=5,  # 5折(KFold值)
-        #                            scoring='neg_mean_squared_error')
-        # grid_search.fit(X_train, y_train)
-        # # model = grid_search.estimator.fit(X_train, y_train)
-        # logger.info("GridSarch最好的成绩:%.5f", grid_search.best_score_)
-        # # 得到的结果是495，确实和上面人肉跑是一样的结果
-        # logger.info("GridSarch最好的参数:%.5f", grid_search.best_estimator_.alpha)
-
-        best_hyperparam = sorted_results[0][0]
-        return best_hyperparam
+        if self.trade_dates is None or len(self.trade_dates) != n:
+            bounds = np.linspace(0, n, self.cv + 2).astype(int)
+        else:
+            dates = np.unique(self.trade_dates)
+            cut_dates = dates[np.linspace(0, len(dates), self.cv + 2).astype(int)[1:-1]]
+            bounds = np.concatenate([[0], np.searchsorted(self.trade_dates, cut_dates), [n]])
+        return list(zip(bounds[:-1], bounds[1:]))
+
+
+class GramStats:
+    """
+    岭回归的充分统计量：行数、X的和、y的和、XᵀX、Xᵀy、yᵀy，可以一块一块的累加，
+    训练和验证的均方误差都可以只用它算出来，不需要原始数据，out-of-core训练靠它
+    """
+
+    __slots__ = ('n', 'x_sum', 'y_sum', 'xtx', 'xty', 'yty')
+
+    def __init__(self, p):
+        self.n = 0
+        self.x_sum = np.zeros(p)
+        self.y_sum = 0.0
+        self.xtx = np.zeros((p, p))
+        self.xty = np.zeros(p)
+        self.yty = 0.0
+
+    def update(self, X, y, chunk_rows=CHUNK_ROWS):
+        """累加一块数据，按chunk_rows转成float64再算，float32的XᵀX精度不够"""
+        for start in range(0, len(X), chunk_rows):
+            X_chunk = np.asarray(X[start:start + chunk_rows], dtype=np.float64)
+            y_chunk = np.asarray(y[start:start + chunk_rows], dtype=np.float64)
+            self.n += len(X_chunk)
+            self.x_sum += X_chunk.sum(axis=0)
+            self.y_sum += y_chunk.sum()
+            self.xtx += X_chunk.T @ X_chunk
+            self.xty += X_chunk.T @ y_chunk
+            self.yty += y_chunk @ y_chunk
+        return self
+
+    def __add__(self, other):
+        stats = GramStats(len(self.x_sum))
+        for name in GramStats.__slots__:
+            setattr(stats, name, getattr(self, name) + getattr(other, name))
+        return stats
+
+    def centered(self):
+        """中心化，等价于Ridge的fit_intercept=True，返回 XᵀX、Xᵀy、yᵀy(中心化后的)和x、y的均值"""
+        x_mean, y_mean = self.x_sum / self.n, self.y_sum / self.n
+        gram = self.xtx - self.n * np.outer(x_mean, x_mean)
+        xty = self.xty - self.n * x_mean * y_mean
+        yty = self.yty - self.n * y_mean * y_mean
+        return gram, xty, yty, x_mean, y_mean
+
+    def sse(self, W, b):
+        """
+        用这块数据的统计量，算预测 Xw+b 的残差平方和，W是 p x k，b是k个截距，返回k个值
+        Σ(y-Xw-b)² = yᵀy - 2wᵀXᵀy - 2bΣy + wᵀXᵀXw + 2bwᵀΣx + nb²
+        """
+        return (self.yty - 2 * (self.xty @ W) - 2 * b * self.y_sum + ((self.xtx @ W) * W).sum(axis=0)
+                + 2 * b * (self.x_sum @ W) + self.n * b ** 2)
+
+
+def _ridge_path(gram, xty, alphas):
+    """对中心化后的XᵀX、Xᵀy，算出所有alpha的岭回归系数，返回 p x len(alphas) 的矩阵"""
+    s, V = np.linalg.eigh(gram)
+    s = np.maximum(s, 0)
+    c = V.T @ xty
+    return V @ (c[:, None] / (s[:, None] + alphas[None, :]))
+
+
+def ridge_from_stats(stats, alpha):
+    """用统计量解出一个alpha的岭回归，返回系数和截距"""
+    gram, xty, _, x_mean, y_mean = stats.centered()
+    coef = np.linalg.solve(gram + alpha * np.eye(len(xty)), xty)
+    return coef, y_mean - x_mean @ coef
+
+
+def forward_cv_scores(X, y, alphas, bounds):
+    """
+    前向交叉验证：第k折用第0~k段训练，第k+1段验证
+    :param bounds: 每段的[开始,结束)行号，按时间顺序
+    :return: DataFrame，index是alpha，列是每折的均方误差和平均的mse
+    """
+    return forward_cv_from_stats([GramStats(X.shape[1]).update(X[start:end], y[start:end]) for start, end in bounds],
+                                 alphas)
+
+
+def forward_cv_from_stats(stats, alphas):
+    """
+    前向交叉验证，每段数据只用它的统计量，训练集的统计量是前面各段累加出来的
+    :param stats: 按时间顺序的每段的GramStats
+    """
+    scores = {}
+    train_stats = stats[0]
+    for k in range(1, len(stats)):
+        valid_stats = stats[k]
+        if train_stats.n > 0 and valid_stats.n > 0:
+            gram, xty, _, x_mean, y_mean = train_stats.centered()
+            W = _ridge_path(gram, xty, alphas)
+            scores[f'fold_{k}'] = valid_stats.sse(W, y_mean - x_mean @ W) / valid_stats.n
+        train_stats = train_stats + valid_stats
+
+    df_scores = pd.DataFrame(scores, index=pd.Index(alphas, name='alpha'))
+    df_scores['mse'] = df_scores.mean(axis=1)
+    return df_scores
+
+
+def gcv_scores(X, y, alphas):
+    """
+    广义交叉验证，见gcv_from_stats
+    """
+    return gcv_from_stats(GramStats(X.shape[1]).update(X, y), alphas)
+
+
+def gcv_from_stats(stats, alphas):
+    """
+    广义交叉验证：GCV(α) = n·RSS(α) / (n - df(α))²，df(α) = Σ s/(s+α)是等效自由度，
+    RSS(α)可以在特征分解的坐标下直接算，不需要算残差
+    :return: DataFrame，index是alpha，列是rss、df、gcv和mse(=gcv)
+    """
+    n = stats.n
+    gram, xty, yty, _, _ = stats.centered()
+
+    s, V = np.linalg.eigh(gram)
+    s = np.maximum(s, 0)
+    c2 = (V.T @ xty) ** 2
+    shrink = s[:, None] + alphas[None, :]
+    # RSS = yᵀy - 2wᵀXᵀy + wᵀXᵀXw
+    rss = yty - (c2[:, None] * (2 / shrink - s[:, None] / shrink ** 2)).sum(axis=0)
+    dof = (s[:, None] / shrink).sum(axis=0) + 1  # +1是截距
+    gcv = n * rss / (n - dof) ** 2
+    return pd.DataFrame({'rss': rss, 'df': dof, 'gcv': gcv, 'mse': gcv}, index=pd.Index(alphas, name='alpha'))
@@ -1,61 +1,234 @@
 import logging
+import os
 
-from sklearn.model_selection import GridSearchCV
-from sklearn.preprocessing import LabelEncoder
-from xgboost import XGBClassifier
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from sklearn.model_selection import ParameterGrid
 
 from mlstock.ml.trains.train_action import TrainAction
 from mlstock.utils import utils
 
 logger = logging.getLogger(__name__)
 
+"""
+XGBoost涨跌分类。
+
+之前是XGBClassifier(nthread=1)，optimize模式下GridSearchCV起15个单线程的进程，每个进程2G内存，
+而且随机的5折交叉验证，用未来的数据验证过去。现在：
+    - 用hist(直方图)算法，多线程，一个模型用满所有的核
+    - 按时间切出最后VALID_RATIO的日期做验证集，用它early stopping，n_estimators不用再搜索了
+    - 选出参数和树的个数(best_iteration+1)后，默认用全部的训练数据(包含验证集)重新训练一次，
+      否则最终的模型会少了最近15%的周(约2年)，refit=False时才返回只在前85%上训练的模型
+    - 训练集/验证集只量化(QuantileDMatrix)一次，超参搜索的每组参数都复用它，内存里只有一份数据
+"""
+
 PARAMS_MODE = 'fix'  # fix | optimize
+VALID_RATIO = 0.15  # 按日期，最后15%的周做验证集
+MAX_ROUNDS = 500  # 最多的树的个数，一般early stopping会提前停下来
+EARLY_STOPPING_ROUNDS = 20
+FIX_ROUNDS = 50  # 数据太少，切不出验证集的时候，用固定的树的个数
+MAX_BIN = 256
+
+# 基础参数
+BASE_PARAMS = {'objective': 'binary:logistic',
+               'eval_metric': 'logloss',
+               'tree_method': 'hist',
+               'max_bin': MAX_BIN}
+# 这个参数是由下面的优化结果得出的，下面的时不时跑一次，然后把最优结果抄到这里
+FIX_PARAMS = {'max_depth': 7, 'eta': 0.3}
+# 待搜索的参数列表空间，树的个数由early stopping决定
+PARAM_GRID = {'max_depth': [3, 5, 7, 9],
+              'eta': [0.3, 0.1],
+              'subsample': [0.8, 1]}
 
 
 class TrainWinLoss(TrainAction):
+    model_type = 'winloss'
+
+    def __init__(self, factor_names, params_mode=PARAMS_MODE, n_jobs=None, refit=True):
+        """
+        :param params_mode: fix：用固定的参数；optimize：在PARAM_GRID里搜索
+        :param n_jobs: xgboost的线程数，默认为CPU核数，多个进程同时训练的时候(walk-forward)，要分一下
+        :param refit: early stopping选出参数和树的个数后，是否在全部的训练数据(包含验证集)上重新训练，
+                      False则返回只用前(1-VALID_RATIO)的日期训练的模型，最后的验证集是留出来的
+        """
+        super().__init__(factor_names)
+        self.params_mode = params_mode
+        self.refit = refit
+        self.n_jobs = n_jobs if n_jobs else os.cpu_count()
+        self.search_scores = None
 
     def get_model_name(self):
         return f"winloss_xgboost_{utils.now()}.model"
 
     def set_target(self, df_data):
-        df_data['target'] = df_data.target.apply(lambda x: 1 if x > 0 else 0)
+        # 不修改传入的df，否则先训练分类，再训练回归，回归的target就变成0/1了
         logger.info("设置target为分类：0跌，1涨")
-        return df_data
+        return df_data.assign(target=(df_data.target > 0).astype(int))
 
     def _train(self, X_train, y_train):
         """
         Xgboost来做输赢判断，参考：https://cloud.tencent.com/developer/article/1656126
-        :return:
-        """
-        # https://so.muouseo.com/qa/em6w1x8w20k8.html
-        le = LabelEncoder()
-        y_train = le.fit_transform(y_train)
-
-        if PARAMS_MODE == 'optimize':
-            # 创建xgb分类模型实例
-            model = XGBClassifier(nthread=1)
-
-            # 待搜索的参数列表空间
-            param_list = {"max_depth": [3, 5, 7, 9],
-                          "n_estimators": [10, 30, 50, 70, 90]}
-
-            # 创建网格搜索
-            grid_search = GridSearchCV(model,
-                                       param_grid=param_list,
-                                       cv=5,
-                                       verbose=10,
-                                       scoring='f1_weighted',  # TODO:f1???
-                                       n_jobs=15)  # 最多15个进程同时跑: 1个进程2G内存，15x2=30G内存使用，不能再多了
-            # 基于flights数据集执行搜索
-            grid_search.fit(X_train, y_train)
-
-            # 输出搜索结果
-            logger.debug("GridSearch出最优参数：%r", grid_search.best_estimator_)
-
-            return grid_search.best_estimator_
-        else:
-            # 创建xgb分类模型实例
-            # 这个参数是由上面的优化结果得出的，上面的时不时跑一次，然后把最优结果抄到这里
-            model = XGBClassifier(nthread=1, max_depth=7, n_estimators=50)
-            model.fit(X_train, y_train)
-            return model
+        :return: WinLossClassifier，和XGBClassifier一样有predict/predict_proba
+        """
+        X_train = np.asarray(X_train, dtype=np.float32)
+        y_train = np.asarray(y_train, dtype=np.int32)
+        split = self._valid_split(len(X_train))
+
+        # 只量化一次，验证集用训练集的分桶(ref)
+        dtrain = xgb.QuantileDMatrix(X_train[:split], y_train[:split], max_bin=MAX_BIN, nthread=self.n_jobs)
+        dvalid = None
+        if split < len(X_train):
+            dvalid = xgb.QuantileDMatrix(X_train[split:], y_train[split:], ref=dtrain, nthread=self.n_jobs)
+        logger.debug("训练集%d行，验证集%d行", split, len(X_train) - split)
+        booster, params, iteration = self._search(dtrain, dvalid)
+        if self.refit and dvalid is not None:
+            del dvalid
+            # 用训练集的分桶量化全部的数据，和搜索时的特征分桶一致
+            dfull = xgb.QuantileDMatrix(X_train, y_train, ref=dtrain, nthread=self.n_jobs)
+            booster = self._refit(params, iteration, dfull)
+        return WinLossClassifier(booster, iteration, self.search_scores)
+
+    def _train_store(self, store, start_date, end_date):
+        """
+        out-of-core训练：用迭代器(StoreIter)把分片一个一个的喂给QuantileDMatrix，
+        xgboost只保存量化后的数据(每个值1个字节)，原始的float数据一次只有一个分片在内存里
+        """
+        dates = store.dates(start_date, end_date)
+        valid_num = int(len(dates) * VALID_RATIO)
+        train_end_date = dates[-valid_num - 1] if valid_num > 0 else end_date
+
+        dtrain = xgb.QuantileDMatrix(StoreIter(store, self.factor_names, start_date, train_end_date),
+                                     max_bin=MAX_BIN, nthread=self.n_jobs)
+        dvalid = None
+        if valid_num > 0:
+            dvalid = xgb.QuantileDMatrix(StoreIter(store, self.factor_names, dates[-valid_num], end_date),
+                                         ref=dtrain, nthread=self.n_jobs)
+        logger.debug("训练集%d行，验证集%d行", dtrain.num_row(), dvalid.num_row() if dvalid is not None else 0)
+        booster, params, iteration = self._search(dtrain, dvalid)
+        if self.refit and dvalid is not None:
+            del dvalid
+            dfull = xgb.QuantileDMatrix(StoreIter(store, self.factor_names, start_date, end_date),
+                                        ref=dtrain, nthread=self.n_jobs)
+            booster = self._refit(params, iteration, dfull)
+        return WinLossClassifier(booster, iteration, self.search_scores)
+
+    def _search(self, dtrain, dvalid):
+        """
+        用同一份量化好的训练集/验证集，训练每一组候选参数，选出验证集上最好的
+        :return: (最好的booster，它的参数，best_iteration)
+        """
+        candidates = [FIX_PARAMS] if self.params_mode == 'fix' else list(ParameterGrid(PARAM_GRID))
+        best_booster, best_index, scores = None, 0, []
+        for params in candidates:
+            booster = self._train_booster(params, dtrain, dvalid)
+            score = booster.best_score if dvalid is not None else np.nan
+            iteration = booster.best_iteration if dvalid is not None else FIX_ROUNDS - 1
+            scores.append({**params, 'best_iteration': iteration, 'valid_logloss': score})
+            if best_booster is None or score < scores[best_index]['valid_logloss']:
+                best_booster, best_index = booster, len(scores) - 1
+
+        self.search_scores = pd.DataFrame(scores)
+        best = scores[best_index]
+        if len(candidates) > 1: logger.info("超参搜索结果：\n%r", self.search_scores)
+        logger.info("最优参数：%r", best)
+        self.params = {**BASE_PARAMS, **candidates[best_index], 'best_iteration': int(best['best_iteration']),
+                       'refit': bool(self.refit and dvalid is not None)}
+        self.metrics = {'valid_logloss': float(best['valid_logloss'])}
+        return best_booster, candidates[best_index], int(best['best_iteration'])
+
+    def _refit(self, params, best_iteration, dfull):
+        """用选中的参数，在全部的训练数据上训练best_iteration+1棵树"""
+        logger.info("用全部的训练数据(%d行)重新训练：%r，%d棵树", dfull.num_row(), params, best_iteration + 1)
+        params = {**BASE_PARAMS, **params, 'nthread': self.n_jobs}
+        return xgb.train(params, dfull, num_boost_round=best_iteration + 1)
+
+    def _train_booster(self, params, dtrain, dvalid):
+        params = {**BASE_PARAMS, **params, 'nthread': self.n_jobs}
+        if dvalid is None:
+            return xgb.train(params, dtrain, num_boost_round=FIX_ROUNDS)
+        return xgb.train(params, dtrain,
+                         num_boost_round=MAX_ROUNDS,
+                         evals=[(dvalid, 'valid')],
+                         early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+                         verbose_eval=False)
+
+    def _valid_split(self, n):
+        """
+        按时间切分训练集和验证集，返回验证集开始的行号，同一天的数据不会被分到两边
+        没有日期信息时(直接调用_train)，按行号切，要求数据已按时间排序
+        """
+        if self.trade_dates is None or len(self.trade_dates) != n:
+            return n - int(n * VALID_RATIO)
+        dates = np.unique(self.trade_dates)
+        valid_num = int(len(dates) * VALID_RATIO)
+        if valid_num == 0: return n
+        return int(np.searchsorted(self.trade_dates, dates[-valid_num]))
+
+
+class StoreIter(xgb.DataIter):
+    """把因子存储的分片一个一个的喂给xgboost，target>0为涨(1)"""
+
+    def __init__(self, store, factor_names, start_date, end_date):
+        self.store = store
+        self.factor_names = factor_names
+        self.start_date = start_date
+        self.end_date = end_date
+        self._batches = None
+        super().__init__()
+
+    def next(self, input_data):
+        if self._batches is None:
+            self._batches = self.store.batches(self.start_date, self.end_date, factor_names=self.factor_names)
+        batch = next(self._batches, None)
+        if batch is None: return False
+        input_data(data=batch.X, label=(batch.targets[:, 0] > 0).astype(np.int32))
+        return True
+
+    def reset(self):
+        self._batches = None
+
+
+class WinLossClassifier:
+    """
+    xgboost原生Booster的包装，接口和XGBClassifier一样(predict/predict_proba)，可以直接joblib保存
+    预测只用到early stopping最好的那棵树为止
+    """
+
+    def __init__(self, booster, best_iteration, search_scores=None):
+        self.booster = booster
+        self.best_iteration = best_iteration
+        self.search_scores = search_scores
+        self.classes_ = np.array([0, 1])
+
+    @property
+    def n_features_in_(self):
+        return self.booster.num_features()
+
+    def predict_proba(self, X):
+        prob = self.booster.inplace_predict(np.asarray(X, dtype=np.float32),
+                                            iteration_range=(0, self.best_iteration + 1))
+        return np.column_stack([1 - prob, prob])
+
+    def predict(self, X):
+        return (self.predict_proba(X)[:, 1] > 0.5).astype(int)
+
+    def __getstate__(self):
+        # booster序列化成uint8的numpy数组，模型仓库用joblib的mmap_mode加载时，不用先读进内存再拷贝
+        state = self.__dict__.copy()
+        state['booster'] = np.frombuffer(self.booster.save_raw(raw_format='ubj'), dtype=np.uint8)
+        return state
+
+    def __setstate__(self, state):
+        booster = xgb.Booster()
+        booster.load_model(bytearray(state['booster']))
+        self.__dict__.update(state)
+        self.booster = booster
+
+    @property
+    def feature_importances_(self):
+        scores = self.booster.get_score(importance_type='gain')
+        importances = np.array([scores.get(f"f{i}", 0) for i in range(self.booster.num_features())], dtype=float)
+        total = importances.sum()
+        return importances / total if total > 0 else importances
@@ -0,0 +1,183 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from mlstock.ml import load_and_filter_data
+from mlstock.ml.data import factor_conf
+from mlstock.ml.trains.train_pct import TrainPct
+from mlstock.ml.trains.train_winloss import TrainWinLoss
+from mlstock.utils import utils
+from mlstock.utils.multi_processor import Executor
+
+logger = logging.getLogger(__name__)
+
+"""
+滚动(walk-forward)训练和样本外预测。
+
+之前TrainAction.train是在TRAIN_TEST_SPLIT_DATE(20190101)一刀切，bin/backtest.sh回测两个写死的区间，
+模型只训练一次，2019年以后的几年，用的都是2018年以前的数据训练的模型。
+现在按周(trade_date)生成一组训练/测试窗口(fold)：
+    - expanding：训练集从最早的数据开始，每个fold越来越长
+    - rolling：训练集是固定长度(train_periods周)的滑动窗口
+    - retrain：每隔多少周重新训练一次，也就是每个fold的测试集的长度
+    - embargo：训练集和测试集之间空出多少周，target是未来的收益(多周的target尤其)，防止训练集的标签和测试集重叠
+每个fold在进程池里独立的训练Ridge(收益)和XGBoost(涨跌)，预测自己的测试集，
+最后把所有fold的样本外预测拼成一个连续的序列，存成csv，回测可以直接用它(backtest -pr)，不用再加载模型预测。
+"""
+
+WINDOW_TYPES = ['expanding', 'rolling']
+PREDICTION_COLUMNS = ['trade_date', 'ts_code', 'target', 'next_pct_chg', 'next_pct_chg_baseline']
+
+
+class Fold:
+    """一个训练/测试窗口，日期都是闭区间"""
+
+    def __init__(self, index, train_start, train_end, test_start, test_end):
+        self.index = index
+        self.train_start = train_start
+        self.train_end = train_end
+        self.test_start = test_start
+        self.test_end = test_end
+
+    def __repr__(self):
+        return f"Fold{self.index}[训练:{self.train_start}~{self.train_end},测试:{self.test_start}~{self.test_end}]"
+
+
+def make_folds(trade_dates, min_train_periods=250, retrain=4, embargo=1, window='expanding', train_periods=None,
+               test_start=None):
+    """
+    生成walk-forward的fold
+    :param trade_dates: 所有的交易日(周)
+    :param min_train_periods: 最少的训练周数，不够的话，不生成fold
+    :param retrain: 每隔多少周重新训练，即测试集的长度
+    :param embargo: 训练集最后一周和测试集第一周之间空出的周数
+    :param window: expanding | rolling
+    :param train_periods: rolling的训练集长度(周)，默认为min_train_periods
+    :param test_start: 第一个测试集的开始日期，默认从攒够min_train_periods+embargo周开始
+    :return: [Fold]
+    """
+    if window not in WINDOW_TYPES:
+        raise ValueError(f"无效的窗口类型：{window}，必须是{WINDOW_TYPES}之一")
+    if retrain < 1:
+        raise ValueError(f"重新训练的间隔必须大于0：{retrain}")
+    dates = np.sort(np.unique(trade_dates))
+    train_periods = train_periods if train_periods else min_train_periods
+
+    first = min_train_periods + embargo
+    if test_start is not None: first = max(first, np.searchsorted(dates, test_start))
+
+    folds = []
+    for i in range(first, len(dates), retrain):
+        train_end = i - embargo  # 不含
+        train_start = 0 if window == 'expanding' else max(0, train_end - train_periods)
+        folds.append(Fold(len(folds),
+                          dates[train_start], dates[train_end - 1],
+                          dates[i], dates[min(i + retrain, len(dates)) - 1]))
+    logger.info("生成%d个fold（%s窗口，每%d周重新训练，间隔%d周）", len(folds), window, retrain, embargo)
+    return folds
+
+
+def train_fold(fold, df_data, factor_names, train_type='all', n_jobs=None):
+    """
+    训练一个fold，并预测它的测试集，在子进程中运行
+    :param n_jobs: xgboost的线程数，几个进程同时训练，要把CPU核分一下，否则线程数超过核数，反而更慢
+    :return: 测试集的预测结果
+    """
+    df_train = df_data[(df_data.trade_date >= fold.train_start) & (df_data.trade_date <= fold.train_end)]
+    df_test = df_data[(df_data.trade_date >= fold.test_start) & (df_data.trade_date <= fold.test_end)]
+    df_pred = df_test[PREDICTION_COLUMNS].copy()
+    df_pred['fold'] = fold.index
+    X_test = df_test[factor_names].values
+
+    start_time = time.time()
+    if train_type in ['all', 'pct']:
+        df_pred['pct_pred'] = TrainPct(factor_names).fit(df_train).predict(X_test)
+    if train_type in ['all', 'winloss']:
+        df_pred['winloss_pred'] = TrainWinLoss(factor_names, n_jobs=n_jobs).fit(df_train).predict(X_test)
+    utils.time_elapse(start_time, f"{fold}：训练{len(df_train)}行，预测{len(df_test)}行")
+    return df_pred
+
+
+def walk_forward(df_data, factor_names, train_type='all', worker_num=None, **fold_params):
+    """
+    滚动训练，拼接所有fold的样本外预测
+    :param fold_params: make_folds的参数
+    :return: 样本外预测的DataFrame，包含trade_date、ts_code、fold、pct_pred、winloss_pred和真实的收益
+    """
+    if train_type not in ['all', 'pct', 'winloss']:
+        raise ValueError(f"无法识别训练类型:{train_type}")
+    folds = make_folds(df_data.trade_date.unique(), **fold_params)
+    if len(folds) == 0:
+        raise ValueError("数据的周数不够，无法生成任何一个fold")
+    for fold in folds: logger.debug("%r", fold)
+
+    # 只把需要的列放到共享内存里
+    df_data = df_data[PREDICTION_COLUMNS + factor_names]
+    executor = Executor(worker_num)
+    n_jobs = max(1, os.cpu_count() // min(executor.worker_num, len(folds)))
+    df_preds = executor.map(train_fold, folds, shared={'df_data': df_data},
+                            factor_names=factor_names, train_type=train_type, n_jobs=n_jobs)
+    df_pred = pd.concat(df_preds, ignore_index=True).sort_values(['trade_date', 'ts_code'])
+    logger.info("样本外预测：%d个fold，%s~%s，%d行",
+                len(folds), df_pred.trade_date.min(), df_pred.trade_date.max(), len(df_pred))
+    return df_pred.reset_index(drop=True)
+
+
+def save_predictions(df_pred):
+    if not os.path.exists("data"): os.makedirs("data")
+    file_path = "data/oos_predictions_{}_{}_{}.csv".format(df_pred.trade_date.min(), df_pred.trade_date.max(),
+                                                            utils.now())
+    df_pred.to_csv(file_path, index=False)
+    logger.info("样本外预测保存到：%s", file_path)
+    return file_path
+
+
+def main(data_path, start_date, end_date, factor_names, train_type='all', worker_num=None, **fold_params):
+    df_data = load_and_filter_data(data_path, start_date, end_date)
+    df_pred = walk_forward(df_data, factor_names, train_type, worker_num, **fold_params)
+    return save_predictions(df_pred)
+
+
+"""
+python -m mlstock.ml.walk_forward \
+-s 20090101 -e 20220901 \
+-w expanding -mt 250 -r 4 -eb 1 -ts 20190101 \
+-d data/factor_20080101_20220901_2954_1299032__industry_neutral_20220902112049.csv
+"""
+if __name__ == '__main__':
+    utils.init_logger(file=True)
+    parser = argparse.ArgumentParser()
+
+    # 数据相关的
+    parser.add_argument('-s', '--start_date', type=str, default="20090101", help="开始日期")
+    parser.add_argument('-e', '--end_date', type=str, default="20220901", help="结束日期")
+    parser.add_argument('-d', '--data', type=str, default=None, help="数据文件")
+
+    # 窗口相关的
+    parser.add_argument('-w', '--window', type=str, default="expanding", help="expanding|rolling")
+    parser.add_argument('-mt', '--min_train_periods', type=int, default=250, help="最少的训练周数")
+    parser.add_argument('-tp', '--train_periods', type=int, default=None, help="rolling窗口的训练周数")
+    parser.add_argument('-r', '--retrain', type=int, default=4, help="每隔多少周重新训练")
+    parser.add_argument('-eb', '--embargo', type=int, default=1, help="训练集和测试集之间空出的周数")
+    parser.add_argument('-ts', '--test_start', type=str, default=None, help="第一个测试集的开始日期")
+
+    # 训练相关的
+    parser.add_argument('-t', '--train', type=str, default="all", help="all|pct|winloss")
+    parser.add_argument('-wn', '--worker_num', type=int, default=None, help="并行训练的进程数，默认为CPU核数")
+
+    args = parser.parse_args()
+    factor_names = factor_conf.get_factor_names()
+
+    start_time = time.time()
+    main(args.data, args.start_date, args.end_date, factor_names, args.train, args.worker_num,
+         min_train_periods=args.min_train_periods,
+         retrain=args.retrain,
+         embargo=args.embargo,
+         window=args.window,
+         train_periods=args.train_periods,
+         test_start=args.test_start)
+    utils.time_elapse(start_time, "整个滚动训练过程")
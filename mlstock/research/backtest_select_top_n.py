@@ -4,29 +4,141 @@ python -m mlstock.research.backtest_select_top_n \
 -s 20190101 -e 20220901 \
 -mp model/pct_ridge_20220902112320.model \
 -mw model/winloss_xgboost_20220902112813.model \
--d data/factor_20080101_20220901_2954_1299032__industry_neutral_20220902112049.csv
+-d data/factor_20080101_20220901_2954_1299032__industry_neutral_20220902112049.csv \
+-n 5,10,15,20,25,30,35,40 -tm 0,1 -cs 0,1 -cm 0.00025,0.0003 -en vectorized
 """
 import argparse
+import itertools
+import logging
+import os
 import time
 
-from mlstock.ml.backtests.backtest_deliberate import load_datas, run_broker
+import pandas as pd
+from pandas import DataFrame
+
+from mlstock.ml.backtests import rank_top_n, plotting
+from mlstock.ml.backtests.backtest_deliberate import load_datas, backtest_portfolio
+from mlstock.ml.backtests.metrics import metrics_matrix, METRIC_NAMES
 from mlstock.ml.data import factor_conf
 from mlstock.utils import utils
+from mlstock.utils.multi_processor import Executor
+
+logger = logging.getLogger(__name__)
+
+"""
+参数扫描：对 top_n x 是否择时 x 是否保守价格 x 佣金费率 的所有组合跑回测，
+之前是对每个top_n串行的跑run_broker，每次都要重新排序选股、重新画图。
+
+现在：
+    - 预测、日线、涨跌停、交易日历只加载一次
+    - 只按最大的top_n选股、排序一次，每个组合按排名取前top_n只
+    - 所有的组合在进程池里并行跑，加载好的数据通过共享内存只读共享给子进程
+    - 不画图，每个组合只返回每期收益，最后用metrics_matrix一次算出所有组合的指标，每个组合一行
+"""
+
+TOP_NS = [5, 10, 15, 20, 25, 30, 35, 40]
+TRANSFER_FEE_RATE = 0.0002  # 过户费
+STAMP_TAX_RATE = 0.001  # 印花税，只有卖出收
+COMMISSION_RATES = [0.00025]  # 券商佣金
+
+
+def run_config(config, df_ranked, df_daily, df_index, df_baseline, df_calendar, df_timing=None, engine='broker'):
+    """
+    跑一个参数组合的回测，在子进程里运行
+    :param config: dict(top_n, timing, conservative, commission)
+    :return: 每期收益率的Series(index是trade_date)，佣金总额
+    """
+    df_selected_stocks = df_ranked[df_ranked['rank'] < config['top_n']]
+    df_portfolio, total_commission = backtest_portfolio(
+        df_selected_stocks, df_daily, df_index, df_baseline, df_calendar,
+        df_timing=df_timing if config['timing'] else None,
+        conservative=config['conservative'],
+        engine=engine,
+        buy_commission_rate=config['commission'] + TRANSFER_FEE_RATE,
+        sell_commission_rate=config['commission'] + TRANSFER_FEE_RATE + STAMP_TAX_RATE)
+    return df_portfolio.set_index('trade_date').next_pct_chg, total_commission
+
+
+def sweep(df_data, df_daily, df_index, df_baseline, df_limit, df_calendar,
+          top_ns=TOP_NS, timings=(False,), conservatives=(False,), commissions=COMMISSION_RATES,
+          engine='broker', worker_num=None, plot_path=None):
+    """
+    对所有的参数组合跑回测
+    :param plot_path: 把所有组合的净值曲线画到一张图上的保存路径，None为不画
+    :return: DataFrame，每个组合一行，列是参数和各项指标
+    """
+    # 只排序、选股一次，按最大的N选，组内的名次用于取不同的N
+    df_data = df_data[['trade_date', 'ts_code', 'pct_pred', 'winloss_pred']]
+    df_ranked = rank_top_n(df_data, df_limit, max(top_ns))
+
+    shared = {
+        'df_ranked': df_ranked[['trade_date', 'ts_code', 'rank']],
+        'df_daily': df_daily[['trade_date', 'ts_code', 'open', 'high', 'low', 'close']],
+        'df_index': df_index[['trade_date', 'close']],
+        'df_baseline': df_baseline,
+        'df_calendar': DataFrame({'cal_date': df_calendar.values})
+    }
+    if True in timings:
+        from mlstock.ml.backtests import timing
+        shared['df_timing'] = timing.ma(df_index.copy())
+
+    configs = [{'top_n': top_n, 'timing': _timing, 'conservative': conservative, 'commission': commission}
+               for top_n, _timing, conservative, commission
+               in itertools.product(top_ns, timings, conservatives, commissions)]
+    logger.info("开始参数扫描：%d个组合", len(configs))
+
+    results = Executor(worker_num).map(_run_config, configs, shared=shared, engine=engine)
+
+    # 所有组合的每期收益拼成一个矩阵，一次算出所有组合的指标
+    df_returns = pd.concat([returns for returns, _ in results], axis=1, keys=range(len(configs))).sort_index()
+    baseline = df_baseline.drop_duplicates('trade_date').set_index('trade_date').next_pct_chg_baseline
+    df_metrics = metrics_matrix(df_returns, baseline).rename(columns=METRIC_NAMES)
+    df_configs = DataFrame(configs)
+    df_configs['佣金总额'] = [total_commission for _, total_commission in results]
+
+    if plot_path:
+        df_returns.columns = ["top{top_n}{timing}{conservative}_{commission}".format(
+            top_n=c['top_n'], timing='_择时' if c['timing'] else '', conservative='_保守' if c['conservative'] else '',
+            commission=c['commission']) for c in configs]
+        plotting.plot_batch(df_returns, plot_path, baseline=baseline, title='参数扫描的净值曲线')
+    return pd.concat([df_configs, df_metrics.reset_index(drop=True)], axis=1)
+
 
+def _run_config(config, df_calendar, **kwargs):
+    """共享内存里只能放DataFrame，交易日历要从DataFrame还原成Series"""
+    return run_config(config, df_calendar=df_calendar.cal_date, **kwargs)
 
-def main(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names):
+
+def main(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names,
+         top_ns=TOP_NS, timings=(False,), conservatives=(False,), commissions=COMMISSION_RATES,
+         engine='broker', worker_num=None, is_plot=False, predictions_path=None):
     """
     先预测出所有的下周收益率、下周涨跌 => df_data，
-    然后选出每周的top30 => df_selected_stocks，
-    然后使用Broker，来遍历每天的交易，每周进行调仓，并，记录下每周的股票+现价合计价值 => df_portfolio
-    最后计算出next_pct_chg、cumulative_pct_chg，并画出plot，计算metrics
+    然后对每一组参数(top_n、择时、保守价格、佣金费率)，选出每周的topN，用Broker回测，计算metrics，
+    最后汇总成一个表
     """
     df_data, df_daily, df_index, df_baseline, df_limit, df_calendar = \
-        load_datas(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names)
+        load_datas(data_path, start_date, end_date, model_pct_path, model_winloss_path, factor_names,
+                   predictions_path)
+
+    if not os.path.exists("data"): os.makedirs("data")
+    file_name = "data/sweep_top_n_{}_{}_{}".format(start_date, end_date, utils.now())
+    df_result = sweep(df_data, df_daily, df_index, df_baseline, df_limit, df_calendar,
+                      top_ns, timings, conservatives, commissions, engine, worker_num,
+                      plot_path=file_name + ".jpg" if is_plot else None)
+
+    save_path = file_name + ".csv"
+    df_result.to_csv(save_path, index=False)
+    logger.info("参数扫描结果(%d个组合)保存到：%s\n%r", len(df_result), save_path, df_result)
+    return df_result
+
 
-    for top_n in [5, 10, 15, 20, 25, 30, 35, 40]:
-        run_broker(df_data, df_daily, df_index, df_baseline, df_limit, df_calendar, start_date, end_date, factor_names,
-                   top_n)
+def _list(s, _type):
+    return [_type(x) for x in s.split(",")]
+
+
+def _bools(s):
+    return [bool(int(x)) for x in s.split(",")]
 
 
 if __name__ == '__main__':
@@ -34,12 +146,22 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     # 数据相关的
-    # parser.add_argument('-t', '--type', type=str, default="simple|backtrader|deliberate")
     parser.add_argument('-s', '--start_date', type=str, default="20190101", help="开始日期")
     parser.add_argument('-e', '--end_date', type=str, default="20220901", help="结束日期")
     parser.add_argument('-d', '--data', type=str, default=None, help="数据文件")
     parser.add_argument('-mp', '--model_pct', type=str, default=None, help="收益率模型")
     parser.add_argument('-mw', '--model_winloss', type=str, default=None, help="涨跌模型")
+    parser.add_argument('-pr', '--predictions', type=str, default=None, help="预先算好的预测结果，如walk-forward的样本外预测")
+
+    # 扫描的参数，逗号分隔
+    parser.add_argument('-n', '--top_n', type=str, default=",".join(map(str, TOP_NS)), help="选股数，如5,10,30")
+    parser.add_argument('-tm', '--timing', type=str, default="0", help="是否择时，如0,1")
+    parser.add_argument('-cs', '--conservative', type=str, default="0", help="是否用保守价格(最高价买、最低价卖)，如0,1")
+    parser.add_argument('-cm', '--commission', type=str, default=",".join(map(str, COMMISSION_RATES)),
+                        help="券商佣金费率，如0.00025,0.0003")
+    parser.add_argument('-en', '--engine', type=str, default="broker", help="回测的引擎：broker|vectorized")
+    parser.add_argument('-w', '--worker_num', type=int, default=None, help="并行的进程数，默认为CPU核数")
+    parser.add_argument('-p', '--plot', action='store_true', default=False, help="把所有组合的净值曲线画到一张图上")
 
     args = parser.parse_args()
 
@@ -47,11 +169,18 @@ if __name__ == '__main__':
 
     start_time = time.time()
     main(
-        # args.type,
         args.data,
         args.start_date,
         args.end_date,
         args.model_pct,
         args.model_winloss,
-        factor_names)
-    utils.time_elapse(start_time, "整个回测过程")
+        factor_names,
+        _list(args.top_n, int),
+        _bools(args.timing),
+        _bools(args.conservative),
+        _list(args.commission, float),
+        args.engine,
+        args.worker_num,
+        args.plot,
+        args.predictions)
+    utils.time_elapse(start_time, "整个参数扫描过程")
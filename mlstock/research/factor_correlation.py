@@ -0,0 +1,225 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from mlstock.ml.data import factor_conf
+from mlstock.ml.data.factor_store import FactorStore
+from mlstock.utils import utils
+
+logger = logging.getLogger(__name__)
+
+"""
+因子的相关性和冗余分析。
+
+Turnover的注释里说它的16列是共线的，"应该挑一个或者做正交化"，但是一直没有量化过。这里：
+    - 每个交易日(横截面)算一个所有因子两两之间的相关系数矩阵，再对所有日期取平均(时间平均的横截面相关)，
+      而不是所有行混在一起算一个相关，后者会被不同时期的因子水平的变化带偏
+    - 按块读因子存储(或者因子csv)，每个日期累加 行数、Σx、XᵀX，块里按日期排好序后，每个日期一次矩阵乘法，
+      一个日期被切在两个分片里也没关系，统计量是可以累加的
+    - 按 1-|相关系数| 做层次聚类(平均距离)，|相关系数|>阈值的因子聚到一个簇里
+    - 每个簇选一个代表：提供了screen_factors的结果就选|rank ICIR|最大的，否则选和簇内其他因子最相关的
+    - 可以把选出来的因子写到conf/factor_selection.json，factor_conf.get_factor_names()会只返回这些因子，
+      训练和预测就只用精简后的因子
+"""
+
+CHUNK_ROWS = 500000  # 读csv时每次读的行数
+CORRELATION_THRESHOLD = 0.7  # |相关系数|超过它的因子聚到一个簇里
+TOP_PAIRS = 30  # 日志里显示最相关的因子对的个数
+
+
+class CrossSectionCorrelation:
+    """
+    按日期累加的统计量，每个日期：行数、Σx、XᵀX，最后算出每个日期的相关系数矩阵，再对日期取平均
+    """
+
+    def __init__(self, factor_names):
+        self.factor_names = list(factor_names)
+        self.stats = {}  # 日期 => [行数, Σx, XᵀX]
+
+    def update(self, X, dates):
+        """
+        累加一块数据
+        :param X: 行数x因子数，可以是mmap的float32，NaN当作0(因子是标准化过的，0是均值)
+        :param dates: 每行的日期
+        """
+        dates = np.asarray(dates)
+        order = np.argsort(dates, kind='stable')
+        sorted_dates = dates[order]
+        starts = np.flatnonzero(np.append(True, sorted_dates[1:] != sorted_dates[:-1]))
+        ends = np.append(starts[1:], len(order))
+        p = len(self.factor_names)
+        for start, end in zip(starts, ends):
+            # 每个日期的一段，转成float64再算，float32的XᵀX精度不够
+            X_date = np.nan_to_num(np.asarray(X[order[start:end]], dtype=np.float64))
+            stats = self.stats.setdefault(sorted_dates[start], [0, np.zeros(p), np.zeros((p, p))])
+            stats[0] += len(X_date)
+            stats[1] += X_date.sum(axis=0)
+            stats[2] += X_date.T @ X_date
+        return self
+
+    def result(self, min_rows=3):
+        """
+        :param min_rows: 少于这么多行的日期不算
+        :return: (时间平均的相关系数矩阵DataFrame，每对因子有效的期数)
+        """
+        p = len(self.factor_names)
+        corr_sum, periods = np.zeros((p, p)), np.zeros((p, p))
+        for n, x_sum, xtx in self.stats.values():
+            if n < min_rows: continue
+            mean = x_sum / n
+            cov = xtx / n - np.outer(mean, mean)
+            std = np.sqrt(np.clip(np.diag(cov), 0, None))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                corr = cov / np.outer(std, std)
+            # 当天没有波动(常数)的因子，和其他因子的相关性是NaN，不参与平均
+            valid = np.isfinite(corr)
+            corr_sum += np.where(valid, corr, 0)
+            periods += valid
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = np.clip(corr_sum / periods, -1, 1)
+        return DataFrame(corr, index=self.factor_names, columns=self.factor_names), \
+               DataFrame(periods.astype(int), index=self.factor_names, columns=self.factor_names)
+
+
+def _chunks(data_path, start_date, end_date, factor_names, chunk_rows=CHUNK_ROWS):
+    """按块读因子和日期：因子存储按分片(mmap)，因子csv按chunk_rows行"""
+    if os.path.isdir(data_path):
+        store = FactorStore(data_path)
+        for batch in store.batches(start_date, end_date, factor_names):
+            yield batch.X, batch.dates
+        return
+
+    utils.check_file_path(data_path)
+    for df in pd.read_csv(data_path, header=0, chunksize=chunk_rows, usecols=['trade_date'] + factor_names,
+                          dtype={'trade_date': str}):
+        df = df[(df.trade_date >= start_date) & (df.trade_date <= end_date)]
+        if len(df) == 0: continue
+        yield df[factor_names].values, df.trade_date.astype(np.int32).values
+
+
+def correlation(data_path, start_date, end_date, factor_names):
+    """
+    :return: (时间平均的横截面相关系数矩阵，每对因子有效的期数)
+    """
+    start_time = time.time()
+    accumulator = CrossSectionCorrelation(factor_names)
+    rows = 0
+    for X, dates in _chunks(data_path, start_date, end_date, factor_names):
+        accumulator.update(X, dates)
+        rows += len(dates)
+    if rows == 0: raise ValueError(f"数据[{data_path}]里没有{start_date}~{end_date}的数据")
+    df_corr, df_periods = accumulator.result()
+    utils.time_elapse(start_time, f"计算因子相关性：{rows}行，{len(accumulator.stats)}期，{len(factor_names)}个因子")
+    return df_corr, df_periods
+
+
+def cluster_factors(df_corr, threshold=CORRELATION_THRESHOLD):
+    """
+    按 1-|相关系数| 做层次聚类(平均距离)，簇内的平均|相关系数|不低于threshold
+    :return: Series，index是因子名，值是簇的编号(从1开始)
+    """
+    from scipy.cluster.hierarchy import fcluster, linkage
+    from scipy.spatial.distance import squareform
+
+    distance = 1 - df_corr.abs().fillna(0).values
+    distance = np.clip((distance + distance.T) / 2, 0, None)
+    np.fill_diagonal(distance, 0)
+    Z = linkage(squareform(distance, checks=False), method='average')
+    clusters = fcluster(Z, t=1 - threshold, criterion='distance')
+    return pd.Series(clusters, index=df_corr.index, name='cluster')
+
+
+def select_representatives(df_corr, clusters, scores=None):
+    """
+    每个簇选一个代表因子
+    :param scores: Series，因子的得分(如screen_factors的|rank ICIR|)，越大越好，None则选和簇内其他因子平均|相关|最大的
+    :return: DataFrame，每个因子一行：簇、簇的大小、簇内平均|相关|、最相关的因子和相关系数、得分、是否选中
+    """
+    abs_values = np.abs(df_corr.values)
+    np.fill_diagonal(abs_values, np.nan)
+    abs_corr = DataFrame(abs_values, index=df_corr.index, columns=df_corr.columns)
+    df = DataFrame({'cluster': clusters})
+    df['cluster_size'] = df.groupby('cluster').cluster.transform('size')
+    df['cluster_mean_abs_corr'] = [abs_corr.loc[name, clusters.index[clusters == cluster]].mean()
+                                   for name, cluster in clusters.items()]
+    df['most_correlated'] = abs_corr.fillna(-1).idxmax(axis=1)
+    df['most_correlated_corr'] = [df_corr.loc[name, other] for name, other in df.most_correlated.items()]
+    df['score'] = scores.reindex(df.index) if scores is not None else np.nan
+
+    # 有得分的用得分，没有的(或者得分是NaN)用簇内平均|相关|
+    key = df.score.fillna(-np.inf) if scores is not None else df.cluster_mean_abs_corr.fillna(0)
+    selected = key.groupby(df.cluster).idxmax()
+    df['selected'] = df.index.isin(selected.values)
+    return df.rename_axis('factor').sort_values(['cluster', 'selected'], ascending=[True, False])
+
+
+def top_pairs(df_corr, top=TOP_PAIRS):
+    """|相关系数|最大的因子对"""
+    upper = np.triu(np.ones(df_corr.shape, dtype=bool), k=1)
+    pairs = df_corr.where(upper).stack().rename('corr').reset_index()
+    pairs.columns = ['factor1', 'factor2', 'corr']
+    return pairs.reindex(pairs['corr'].abs().sort_values(ascending=False).index).head(top).reset_index(drop=True)
+
+
+def load_scores(screen_path):
+    """screen_factors的结果 => |rank ICIR|"""
+    utils.check_file_path(screen_path)
+    df_screen = pd.read_csv(screen_path)
+    return df_screen.set_index('factor').rank_ic_ir.abs()
+
+
+def main(data_path, start_date, end_date, factor_names, threshold=CORRELATION_THRESHOLD, screen_path=None,
+         selection_path=None):
+    df_corr, df_periods = correlation(data_path, start_date, end_date, factor_names)
+    clusters = cluster_factors(df_corr, threshold)
+    scores = load_scores(screen_path) if screen_path else None
+    df_clusters = select_representatives(df_corr, clusters, scores)
+    selected = [name for name in factor_names if df_clusters.selected[name]]
+
+    if not os.path.exists("data"): os.makedirs("data")
+    file_name = "data/factor_corr_{}_{}_{}".format(start_date, end_date, utils.now())
+    df_corr.to_csv(file_name + ".csv")
+    df_clusters.to_csv(file_name + "_clusters.csv")
+    logger.info("最相关的%d对因子：\n%s", TOP_PAIRS, top_pairs(df_corr).to_string())
+    logger.info("|相关系数|>%.2f的聚类：%d个因子 => %d个簇，结果保存到：%s_clusters.csv\n%s",
+                threshold, len(factor_names), clusters.nunique(), file_name,
+                df_clusters[df_clusters.cluster_size > 1].to_string())
+
+    if selection_path:
+        factor_conf.save_selection(selected, selection_path,
+                                   source=data_path, start_date=start_date, end_date=end_date,
+                                   threshold=threshold, screen=screen_path, created=utils.now())
+    return df_corr, df_clusters, selected
+
+
+"""
+python -m mlstock.research.factor_correlation \
+-s 20090101 -e 20190101 -t 0.7 \
+-d data/factor_store/20080101_20220901
+
+# 每个簇按screen_factors的|rank ICIR|选代表，生成精简后的因子列表给训练用
+python -m mlstock.research.factor_correlation \
+-s 20090101 -e 20190101 -t 0.7 \
+-d data/factor_store/20080101_20220901 \
+-sc data/screen_factors_20090101_20190101_20220903101010.csv \
+-o conf/factor_selection.json
+"""
+if __name__ == '__main__':
+    utils.init_logger(file=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--start_date', type=str, default="20090101", help="开始日期")
+    parser.add_argument('-e', '--end_date', type=str, default="20190101", help="结束日期")
+    parser.add_argument('-d', '--data', type=str, default=None, help="因子存储的目录，或者因子csv")
+    parser.add_argument('-t', '--threshold', type=float, default=CORRELATION_THRESHOLD, help="聚类的|相关系数|阈值")
+    parser.add_argument('-sc', '--screen', type=str, default=None, help="screen_factors的结果，按|rank ICIR|选代表")
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help=f"精简后的因子列表的保存路径，如{factor_conf.FACTOR_SELECTION_PATH}")
+    args = parser.parse_args()
+
+    main(args.data, args.start_date, args.end_date, factor_conf.get_factor_names(selected=False), args.threshold,
+         args.screen, args.output)
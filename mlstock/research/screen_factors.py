@@ -0,0 +1,180 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from mlstock.ml import load_and_filter_data
+from mlstock.ml.backtests import filter_limit
+from mlstock.ml.backtests.metrics import metrics_matrix
+from mlstock.ml.data import factor_conf
+from mlstock.ml.data.factor_store import FactorStore
+from mlstock.ml.ic_analysis import DateGroups, ic_summary, quantile_returns, QUANTILES
+from mlstock.utils import utils
+from mlstock.utils.multi_processor import Executor
+
+logger = logging.getLogger(__name__)
+
+"""
+单因子筛选：对所有的因子，算IC、rank IC和分位数组合的收益，排出一个因子的排名表。
+
+之前train_backtest_for_each_factor对70多个因子逐个的 train.main + 2次backtest.main，
+每个因子都要把几个G的因子csv读3遍、重新训练、再去MySQL查日线和涨跌停。现在：
+    - 因子存储(或者因子csv)只加载一次，因子是float32，收益的组内名次只算一次
+    - 分位数组合的收益直接用数据里的下周收益(next_pct_chg)，不用再查日线、跑Broker
+    - 所有的因子在进程池里并行算，数据通过共享内存只读共享给子进程
+    - 每个因子：IC/rank IC的均值、ICIR、胜率，分5组的各组年化收益，多空组合的年化收益、夏普、最大回撤，单调性
+    - 按rank ICIR的绝对值排名
+"""
+
+TARGET_NAMES = ['target', 'next_pct_chg', 'next_pct_chg_baseline']
+
+
+def load_data(data_path, start_date, end_date, factor_names):
+    """
+    加载一次数据，只保留要用的列
+    :param data_path: 因子存储的目录，或者因子csv
+    :return: DataFrame(ts_code, trade_date, target..., 因子...)，因子是float32
+    """
+    if not os.path.isdir(data_path):
+        df = load_and_filter_data(data_path, start_date, end_date)
+        df = df[['ts_code', 'trade_date'] + TARGET_NAMES + factor_names]
+        return df.astype({name: np.float32 for name in factor_names})
+
+    store = FactorStore(data_path)
+    frames = []
+    for batch in store.batches(start_date, end_date, factor_names, TARGET_NAMES):
+        keys = store.load_keys(batch.shard)
+        dates = keys.trade_date.astype(np.int32).values
+        keys = keys[(dates >= int(start_date)) & (dates <= int(end_date))]
+        df = DataFrame(np.asarray(batch.X), columns=factor_names)
+        df[TARGET_NAMES] = batch.targets
+        df.insert(0, 'ts_code', keys.ts_code.values)
+        df.insert(1, 'trade_date', keys.trade_date.values)
+        frames.append(df)
+    if len(frames) == 0: raise ValueError(f"因子存储[{data_path}]里没有{start_date}~{end_date}的数据")
+    return pd.concat(frames, ignore_index=True)
+
+
+def screen_factor(factor_name, df_data, baseline, quantiles=QUANTILES):
+    """
+    一个因子的IC和分位数组合，在子进程里运行
+    :param df_data: trade_date(int)、target、target_rank(组内名次)、next_pct_chg和所有因子
+    :param baseline: 基准的每期收益，index是trade_date(int)
+    :return: dict，排名表的一行
+    """
+    groups = DateGroups(df_data.trade_date.values)
+    x = df_data[factor_name].values.astype(np.float64)
+    df_ic = DataFrame({'ic': groups.corr(x, df_data.target.values),
+                       'rank_ic': groups.spearman(x, df_data.target.values, y_ranks=df_data.target_rank.values)})
+    df_summary = ic_summary(df_ic)
+
+    columns = [f"q{i + 1}" for i in range(quantiles)]
+    df_returns = DataFrame(quantile_returns(groups, x, df_data.next_pct_chg.values, quantiles),
+                           index=groups.dates, columns=columns)
+    # 因子的方向：rank IC为负的因子，值越小越好，多头是第1组
+    direction = 1 if df_summary.loc['rank_ic', 'ic_mean'] >= 0 else -1
+    long, short = (columns[-1], columns[0]) if direction > 0 else (columns[0], columns[-1])
+    df_returns['long_short'] = df_returns[long] - df_returns[short]
+    df_metrics = metrics_matrix(df_returns, baseline)
+
+    # 单调性：各组的平均收益和组号的秩相关，1或-1说明收益随着因子值单调变化
+    quantile_means = df_returns[columns].mean()
+    monotonicity = np.corrcoef(quantile_means.rank().values, np.arange(quantiles))[0, 1]
+
+    result = {'factor': factor_name,
+              'direction': direction,
+              'ic': df_summary.loc['ic', 'ic_mean'],
+              'ic_ir': df_summary.loc['ic', 'ic_ir'],
+              'rank_ic': df_summary.loc['rank_ic', 'ic_mean'],
+              'rank_ic_ir': df_summary.loc['rank_ic', 'ic_ir'],
+              'rank_ic_hit_rate': df_summary.loc['rank_ic', 'hit_rate'],
+              'periods': df_summary.loc['rank_ic', 'periods'],
+              'long_annual_return': df_metrics.loc[long, 'annual_return'],
+              'long_active_return': df_metrics.loc[long, 'annual_active_return'],
+              'long_short_annual_return': df_metrics.loc['long_short', 'annual_return'],
+              'long_short_sharpe': df_metrics.loc['long_short', 'sharpe'],
+              'long_short_max_drawdown': df_metrics.loc['long_short', 'max_drawdown'],
+              'monotonicity': monotonicity}
+    for column in columns:
+        result[f"{column}_annual_return"] = df_metrics.loc[column, 'annual_return']
+    return result
+
+
+def screen(df_data, factor_names, quantiles=QUANTILES, worker_num=None, df_limit=None):
+    """
+    对所有的因子并行做筛选
+    :param df_data: load_data的结果
+    :param df_limit: 涨跌停的股票，提供的话先剔除掉(买不进、卖不出)
+    :return: DataFrame，每个因子一行，按rank ICIR的绝对值排好序，rank列是名次(从1开始)
+    """
+    if df_limit is not None: df_data = filter_limit(df_data, df_limit)
+    trade_dates = df_data.trade_date.astype(np.int32).values
+    baseline = pd.Series(df_data.next_pct_chg_baseline.values, index=trade_dates)
+    baseline = baseline[~baseline.index.duplicated()].sort_index()
+
+    # 收益的组内名次，所有的因子都一样，只算一次
+    groups = DateGroups(trade_dates)
+    shared = DataFrame({'trade_date': trade_dates,
+                        'target': df_data.target.values,
+                        'target_rank': groups.rank(df_data.target.values),
+                        'next_pct_chg': df_data.next_pct_chg.values})
+    shared = pd.concat([shared, df_data[factor_names].reset_index(drop=True)], axis=1)
+    logger.info("开始单因子筛选：%d个因子，%d行，%d期", len(factor_names), len(shared), groups.num)
+
+    results = Executor(worker_num).map(screen_factor, factor_names, shared={'df_data': shared},
+                                       baseline=baseline, quantiles=quantiles)
+
+    df_result = DataFrame(results)
+    df_result = df_result.reindex(df_result.rank_ic_ir.abs().sort_values(ascending=False).index)
+    df_result.insert(0, 'rank', np.arange(1, len(df_result) + 1))
+    return df_result.reset_index(drop=True)
+
+
+def main(data_path, start_date, end_date, factor_names, quantiles=QUANTILES, worker_num=None,
+         is_filter_limit=False):
+    start_time = time.time()
+    df_data = load_data(data_path, start_date, end_date, factor_names)
+    utils.time_elapse(start_time, f"加载数据：{len(df_data)}行，{len(factor_names)}个因子")
+
+    df_limit = None
+    if is_filter_limit:
+        from mlstock.data.datasource import DataSource
+        df_limit = DataSource().limit_list(start_date, end_date)
+
+    df_result = screen(df_data, factor_names, quantiles, worker_num, df_limit)
+
+    if not os.path.exists("data"): os.makedirs("data")
+    save_path = "data/screen_factors_{}_{}_{}.csv".format(start_date, end_date, utils.now())
+    df_result.to_csv(save_path, index=False)
+    logger.info("单因子筛选结果(%d个因子)保存到：%s\n%s", len(df_result), save_path, df_result.to_string())
+    return df_result
+
+
+"""
+python -m mlstock.research.screen_factors \
+-s 20090101 -e 20220901 \
+-d data/factor_store/20080101_20220901
+
+python -m mlstock.research.screen_factors \
+-s 20090101 -e 20190101 -q 10 -l \
+-d data/factor_20080101_20220901_2954_1299032__industry_neutral_20220902112049.csv
+"""
+if __name__ == '__main__':
+    utils.init_logger(file=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--start_date', type=str, default="20090101", help="开始日期")
+    parser.add_argument('-e', '--end_date', type=str, default="20220901", help="结束日期")
+    parser.add_argument('-d', '--data', type=str, default=None, help="因子存储的目录，或者因子csv")
+    parser.add_argument('-f', '--factors', type=str, default=None, help="要筛选的因子，逗号分隔，默认为所有因子")
+    parser.add_argument('-q', '--quantiles', type=int, default=QUANTILES, help="分位数组合的组数")
+    parser.add_argument('-w', '--worker_num', type=int, default=None, help="并行的进程数，默认为CPU核数")
+    parser.add_argument('-l', '--filter_limit', action='store_true', default=False, help="剔除涨跌停的股票(要查数据库)")
+    args = parser.parse_args()
+
+    factor_names = args.factors.split(",") if args.factors else factor_conf.get_factor_names(selected=False)
+    main(args.data, args.start_date, args.end_date, factor_names, args.quantiles, args.worker_num,
+         args.filter_limit)
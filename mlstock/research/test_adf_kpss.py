@@ -10,21 +10,37 @@
     "你假设了一个参数，然后，你用这个参数去算某一次事件的概率，如果这个概率小于0.05，那说明你的假设不靠谱啊，你的假设下，应该大概率发生才对；现在小概率发生了，说明你的假设不对啊。"
 后来又测试了macd的hist，果然不是平稳的
 """
+import argparse
+import logging
+import os
 import random
+import warnings
+
 import matplotlib
 import matplotlib.pyplot as plt
-import talib as ta
-from matplotlib.font_manager import FontProperties
-from statsmodels.graphics.tsaplots import plot_acf
-import sys
 import numpy as np
-import tushare as ts
+from matplotlib.font_manager import FontProperties
+from pandas import DataFrame
+
+from mlstock.ml.data import factor_conf
+from mlstock.utils import utils
+from mlstock.utils.multi_processor import Executor
 
 matplotlib.rcParams['font.sans-serif'] = ['SimHei']  # 设置中文字体
 matplotlib.rcParams['axes.unicode_minus'] = False  # 正常显示负号，解决负号'-'显示为方块的问题
 
-token = sys.argv[1]
-pro = ts.pro_api(token)
+logger = logging.getLogger(__name__)
+
+"""
+批量模式：之前只能一次测一只股票的一个指标，每次都要画图。现在可以对所有的因子 x 抽样的股票，
+在进程池里(按股票切分)跑ADF、KPSS、Box-Pierce检验，只收集统计量和p值，汇总成一张表，不画图(除非-p)：
+    每个因子：各检验的p值中位数，ADF认为平稳的比例，KPSS认为平稳的比例，两个都认为平稳的比例，白噪声的比例
+"""
+
+STOCK_NUM = 200  # 抽样的股票数
+MIN_PERIODS = 52  # 少于1年(52周)的序列不检验
+BOX_LAGS = 10  # Box-Pierce检验的延迟期数
+P_VALUE = 0.05
 
 
 # 接下来，还要看看是不是随机序列：https://mlln.cn/2017/10/26/python%E6%97%B6%E9%97%B4%E5%BA%8F%E5%88%97%E5%88%86%E6%9E%90-%E7%BA%AF%E9%9A%8F%E6%9C%BA%E6%80%A7%E6%A3%80%E9%AA%8C/
@@ -149,27 +165,29 @@ def test_adf(df):
     print("检验结果（是否平稳）：",
           adftest[0] < adftest[4]['1%'] and adftest[0] < adftest[4]['5%'] and adftest[0] < adftest[4]['10%'],
           "<====================")
-def test(code):
+def test(code, pro, is_plot=False):
+    import talib as ta
     df = pro.daily(stock_code=code)
 
-    fig = plt.figure(figsize=(16, 6))
+    fig = plt.figure(figsize=(16, 6)) if is_plot else None
 
     # 1. test rsi
     rsi = ta.RSI(df['close'])
     rsi.dropna(inplace=True)
-    test_stock(rsi,'rsi',fig)
+    test_stock(rsi, 'rsi', code, fig)
 
     # 2. test return
     df_pct = df['pct_chg'].dropna()
-    test_stock(df_pct,'pct',fig)
+    test_stock(df_pct, 'pct', code, fig)
 
     # 3. test return log
     df_log = df_pct.apply(np.log)
     df_log.replace([np.inf, -np.inf], np.nan, inplace=True)
     df_log.dropna(inplace=True)
-    test_stock(df_log,'pct_log',fig)
+    test_stock(df_log, 'pct_log', code, fig)
+
 
-def test_stock(data,name,fig):
+def test_stock(data, name, code, fig=None):
 
     print("\n\n")
     print("="*80)
@@ -187,12 +205,17 @@ def test_stock(data,name,fig):
     print("================")
     test_kpss(data)
 
+    if fig is None: return
     print("\n\n================")
     print("随机性检验")
     print(f"** 画自相关图 data/平稳性随机性_{name}_{code}.jpg **")
     print("================")
+    plot_stationarity(data, name, code, fig)
+
+
+def plot_stationarity(data, name, code, fig):
     plt.clf()
-    test_stationarity(data, fig,name)
+    test_stationarity(data, fig, name)
     boxpierce_test(data, fig)
     plt.savefig(f"data/平稳性随机性_{name}_{code}.jpg")
 
@@ -201,6 +224,7 @@ def test_stationarity(x, fig, name):
     https://blog.csdn.net/mfsdmlove/article/details/124769371
     """
 
+    from statsmodels.graphics.tsaplots import plot_acf
     font = FontProperties()
 
     ax = fig.add_subplot(421)
@@ -217,14 +241,133 @@ def test_stationarity(x, fig, name):
     ax = fig.add_subplot(423)
     autocorrelation_plot(x, ax=ax)
 
+
+def stationarity_pvalues(x):
+    """一个序列的ADF、KPSS、Box-Pierce检验，只返回统计量和p值，不打印、不画图"""
+    from statsmodels.stats.diagnostic import acorr_ljungbox
+    from statsmodels.tsa.stattools import adfuller, kpss
+    with warnings.catch_warnings():
+        # KPSS的统计量超出查表的范围时，p值取边界值(0.01或0.1)，会有InterpolationWarning
+        warnings.simplefilter('ignore')
+        adf = adfuller(x, autolag='AIC')
+        kpss_result = kpss(x, regression='ct', nlags='auto')
+        box = acorr_ljungbox(x, lags=[BOX_LAGS], boxpierce=True)
+    return {'adf_stat': adf[0],
+            'adf_pvalue': adf[1],
+            'kpss_stat': kpss_result[0],
+            'kpss_pvalue': kpss_result[1],
+            'lb_pvalue': box.lb_pvalue.iloc[0],
+            'bp_pvalue': box.bp_pvalue.iloc[0]}
+
+
+def test_shard(df, factor_names, min_periods=MIN_PERIODS):
+    """
+    一组股票的所有因子的检验，在子进程里运行
+    :return: DataFrame，每个(股票, 因子)一行
+    """
+    rows = []
+    for ts_code, df_stock in df.groupby('ts_code'):
+        df_stock = df_stock.sort_values('trade_date')
+        for factor_name in factor_names:
+            x = df_stock[factor_name].dropna().values.astype(np.float64)
+            if len(x) < min_periods or np.ptp(x) == 0: continue
+            try:
+                result = stationarity_pvalues(x)
+            except (ValueError, np.linalg.LinAlgError) as e:
+                logger.debug("股票[%s]的因子[%s]检验失败：%s", ts_code, factor_name, e)
+                continue
+            rows.append({'ts_code': ts_code, 'factor': factor_name, 'periods': len(x), **result})
+    return DataFrame(rows)
+
+
+def summarize(df_result, p_value=P_VALUE):
+    """
+    按因子汇总：
+        ADF的原假设是不平稳，p值<0.05才认为平稳；KPSS的原假设是平稳，p值>0.05才认为平稳；
+        Box-Pierce的原假设是白噪声(不相关)，p值>0.05认为是随机序列
+    :return: DataFrame，每个因子一行，按两个检验都认为平稳的比例排序
+    """
+    factors = df_result.factor
+    adf_stationary = df_result.adf_pvalue < p_value
+    kpss_stationary = df_result.kpss_pvalue > p_value
+    df_summary = DataFrame({
+        'stocks': factors.value_counts(),
+        'adf_pvalue_median': df_result.groupby('factor').adf_pvalue.median(),
+        'kpss_pvalue_median': df_result.groupby('factor').kpss_pvalue.median(),
+        'bp_pvalue_median': df_result.groupby('factor').bp_pvalue.median(),
+        'adf_stationary': adf_stationary.groupby(factors).mean(),
+        'kpss_stationary': kpss_stationary.groupby(factors).mean(),
+        'stationary': (adf_stationary & kpss_stationary).groupby(factors).mean(),
+        'white_noise': (df_result.bp_pvalue > p_value).groupby(factors).mean()})
+    return df_summary.sort_values('stationary').rename_axis('factor')
+
+
+def batch(data_path, start_date, end_date, factor_names, stock_num=STOCK_NUM, worker_num=None, is_plot=False,
+          seed=0):
+    """
+    批量检验：所有的因子 x 抽样的stock_num只股票，按股票切分到进程池里
+    :return: (每个(股票, 因子)的检验结果，按因子的汇总)
+    """
+    from mlstock.research.screen_factors import load_data
+    df_data = load_data(data_path, start_date, end_date, factor_names)
+    codes = sorted(df_data.ts_code.unique())
+    codes = random.Random(seed).sample(codes, min(stock_num, len(codes)))
+    df_data = df_data.loc[df_data.ts_code.isin(codes), ['ts_code', 'trade_date'] + factor_names]
+    logger.info("平稳性检验：%d个因子 x %d只股票，%d行", len(factor_names), len(codes), len(df_data))
+
+    df_result = Executor(worker_num).execute(df_data, test_shard, factor_names=factor_names)
+    if len(df_result) == 0: raise ValueError("没有可以检验的序列，数据太短了？")
+    df_summary = summarize(df_result)
+
+    if not os.path.exists("data"): os.makedirs("data")
+    file_name = "data/stationarity_{}_{}_{}".format(start_date, end_date, utils.now())
+    df_result.to_csv(file_name + "_detail.csv", index=False)
+    df_summary.to_csv(file_name + ".csv")
+    logger.info("平稳性检验结果保存到：%s.csv\n%s", file_name, df_summary.to_string())
+
+    if is_plot:
+        # 每个因子画抽样的第一只股票
+        fig = plt.figure(figsize=(16, 6))
+        df_stock = df_data[df_data.ts_code == codes[0]].sort_values('trade_date')
+        for factor_name in factor_names:
+            plot_stationarity(df_stock[factor_name].dropna().reset_index(drop=True), factor_name, codes[0], fig)
+    return df_result, df_summary
+
+
 """
 参考：
 - https://blog.51cto.com/u_15671528/5524434
 """
 
-# python -m mlstock.research.test_adf_kpss xxxxxxxxxxxxxxxxxxxxxxx
+"""
+批量：所有因子 x 200只股票
+python -m mlstock.research.test_adf_kpss \
+-s 20090101 -e 20220901 -n 200 \
+-d data/factor_20080101_20220901_2954_1299032__industry_neutral_20220902112049.csv
+
+单只股票(tushare的日线)：
+python -m mlstock.research.test_adf_kpss -t xxxxxxxxxxxxxxxxxxxxxxx -c 600495.SH -p
+"""
 if __name__ == '__main__':
-    # if len(sys.argv) < 2:
-    #     print("格式：python -m mlstock.research.test_adf_kpss.py xxxxxxxxxxxxxxxxxxxxx(tushare的token)")
-    for code in ["600495.SH"]:  # , "600540.SH", "600819.SH", "600138.SH", "002357.SZ", "002119.SZ"]:
-        test(code)
+    utils.init_logger(file=False)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--data', type=str, default=None, help="因子存储的目录或者因子csv，批量模式")
+    parser.add_argument('-s', '--start_date', type=str, default="20090101", help="开始日期")
+    parser.add_argument('-e', '--end_date', type=str, default="20220901", help="结束日期")
+    parser.add_argument('-f', '--factors', type=str, default=None, help="要检验的因子，逗号分隔，默认为所有因子")
+    parser.add_argument('-n', '--stock_num', type=int, default=STOCK_NUM, help="抽样的股票数")
+    parser.add_argument('-w', '--worker_num', type=int, default=None, help="并行的进程数，默认为CPU核数")
+    parser.add_argument('-p', '--plot', action='store_true', default=False, help="画自相关图")
+    parser.add_argument('-t', '--token', type=str, default=None, help="tushare的token，单只股票模式")
+    parser.add_argument('-c', '--codes', type=str, default="600495.SH", help="单只股票模式的股票，逗号分隔")
+    args = parser.parse_args()
+
+    if args.data:
+        factor_names = args.factors.split(",") if args.factors else factor_conf.get_factor_names(selected=False)
+        batch(args.data, args.start_date, args.end_date, factor_names, args.stock_num, args.worker_num, args.plot)
+    else:
+        if args.token is None: raise ValueError("单只股票模式需要tushare的token(-t)，批量模式需要数据文件(-d)")
+        import tushare as ts
+        pro = ts.pro_api(args.token)
+        for code in args.codes.split(","):  # "600495.SH", "600540.SH", "600819.SH", "600138.SH", "002357.SZ"
+            test(code, pro, args.plot)
@@ -2,6 +2,7 @@ import argparse
 
 from mlstock.ml import train, backtest
 from mlstock.ml.data import factor_conf
+from mlstock.research import screen_factors
 from mlstock.utils import utils
 
 """
@@ -13,7 +14,7 @@ def main(data_path, factor_name):
     split_date = '20190101'
     end_date = '20220901'
 
-    factor_names = factor_conf.get_factor_names()
+    factor_names = factor_conf.get_factor_names(selected=False)
 
     if factor_name is not None:
         if not factor_name in factor_names:
@@ -23,10 +24,9 @@ def main(data_path, factor_name):
         backtest.main(data_path, split_date, end_date, pct_model_path, None, [factor_name])
         return
 
-    for factor_name in factor_names:
-        pct_model_path = train.main(data_path, start_date, split_date, 'pct', [factor_name])
-        backtest.main(data_path, start_date, split_date, pct_model_path, None, [factor_name])
-        backtest.main(data_path, split_date, end_date, pct_model_path, None, [factor_name])
+    # 所有的因子，不再逐个的训练、回测(每个因子都要重新读3遍数据)，用screen_factors一次加载、并行的算IC和分位数组合
+    screen_factors.main(data_path, start_date, split_date, factor_names)
+    screen_factors.main(data_path, split_date, end_date, factor_names)
 
 
 # python -m mlstock.research.train_backtest_by_factor -d data/factor_20080101_20220901_2954_1322891_20220829120341.csv
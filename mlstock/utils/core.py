@@ -0,0 +1,302 @@
+import calendar
+import datetime
+import logging
+import os
+import time
+import warnings
+
+from dateutil.relativedelta import relativedelta
+
+from mlstock.utils import instrument
+
+logger = logging.getLogger(__name__)
+
+"""
+依赖很轻的核心工具：日期、日志、计时、文件检查，只依赖标准库和dateutil。
+
+几乎所有的模块都只是为了init_logger、today、time_elapse才import utils，
+这些函数放在这里，utils再把它们导出来，原来的 utils.xxx 的用法不变；
+backtrader、matplotlib、statsmodels等重的依赖，都推迟到用到它们的函数里才import，
+命令行的入口(如 python -m mlstock.ml.train --help)启动就快了。
+"""
+
+def compile_stock_code(stock_code):
+    """
+    从 "600600=>600600.SH"
+    股票编码：https://zhidao.baidu.com/question/340092837.html
+    """
+    if stock_code.endswith(".SH") or stock_code.endswith(".SZ"): return stock_code
+    if stock_code.startswith("6"): return stock_code + ".SH"
+    return stock_code + ".SZ"
+
+
+def uncompile_stock_code(stock_code):
+    """
+    从 "600600.SH=>600600"
+    股票编码：https://zhidao.baidu.com/question/340092837.html
+    """
+    if not "." in stock_code: return stock_code
+    return stock_code[:stock_code.index(".")]
+
+
+def uncomply_code(func):
+    """
+    一个包装器，用于方法中包含code的参数，把股票代码的后缀去掉（tushare是带后缀的，但是服务器不带）
+    从 "600600.SH=>600600"
+    这个用于把发往服务器的代码都统一成实盘代码
+    """
+
+    def wrapper_it(*args, **kw):
+        import inspect
+        args_spec = inspect.getfullargspec(func)
+        args_names = args_spec.args
+        index = args_names.index('code') if 'code' in args_names else -1
+        if index == -1: return func(*args, **kw)
+        args = list(args)
+        args[index] = uncompile_stock_code(args[index])
+
+        args = tuple(args)
+        return func(*args, **kw)
+
+    return wrapper_it
+
+
+def str2date(s_date, format="%Y%m%d"):
+    return datetime.datetime.strptime(s_date, format)
+
+
+def get_monthly_duration(start_date, end_date):
+    """
+    把开始日期到结束日期，分割成每月的信息
+    比如20210301~20220515 =>
+    [   [20210301,20210331],
+        [20210401,20210430],
+        ...,
+        [20220401,20220430],
+        [20220501,20220515]
+    ]
+    """
+
+    start_date = str2date(start_date)
+    end_date = str2date(end_date)
+    years = list(range(start_date.year, end_date.year + 1))
+    scopes = []
+    for year in years:
+        if start_date.year == year:
+            start_month = start_date.month
+        else:
+            start_month = 1
+
+        if end_date.year == year:
+            end_month = end_date.month + 1
+        else:
+            end_month = 12 + 1
+
+        for month in range(start_month, end_month):
+
+            if start_date.year == year and start_date.month == month:
+                s_start_date = date2str(datetime.date(year=year, month=month, day=start_date.day))
+            else:
+                s_start_date = date2str(datetime.date(year=year, month=month, day=1))
+
+            if end_date.year == year and end_date.month == month:
+                s_end_date = date2str(datetime.date(year=year, month=month, day=end_date.day))
+            else:
+                _, last_day = calendar.monthrange(year, month)
+                s_end_date = date2str(datetime.date(year=year, month=month, day=last_day))
+
+            scopes.append([s_start_date, s_end_date])
+
+    return scopes
+
+
+def get_yearly_duration(start_date, end_date):
+    """
+    把开始日期到结束日期，分割成每年的信息
+    比如20210301~20220501 => [[20210301,20211231],[20220101,20220501]]
+    """
+    start_date = str2date(start_date)
+    end_date = str2date(end_date)
+    years = list(range(start_date.year, end_date.year + 1))
+    scopes = [[f'{year}0101', f'{year}1231'] for year in years]
+
+    if start_date.year == years[0]:
+        scopes[0][0] = date2str(start_date)
+    if end_date.year == years[-1]:
+        scopes[-1][1] = date2str(end_date)
+
+    return scopes
+
+
+def duration(start, end, unit='day'):
+    d0 = str2date(start)
+    d1 = str2date(end)
+    delta = d1 - d0
+    if unit == 'day': return delta.days
+    return None
+
+
+def tomorrow(s_date=None):
+    if s_date is None: s_date = today()
+    return future('day', 1, s_date)
+
+
+def yesterday(s_date=None):
+    if s_date is None: s_date = today()
+    return last_day(s_date, 1)
+
+
+def last(date_type, unit, s_date):
+    return __date_span(date_type, unit, -1, s_date)
+
+
+def last_year(s_date, num=1):
+    return last('year', num, s_date)
+
+
+def last_month(s_date, num=1):
+    return last('month', num, s_date)
+
+
+def last_week(s_date, num=1):
+    return last('week', num, s_date)
+
+
+def last_day(s_date, num=1):
+    return last('day', num, s_date)
+
+
+def today():
+    now = datetime.datetime.now()
+    return datetime.datetime.strftime(now, "%Y%m%d")
+
+
+def now():
+    return datetime.datetime.strftime(datetime.datetime.now(), "%Y%m%d%H%M%S")
+
+
+def strf_delta(tdelta, fmt):
+    d = {"days": tdelta.days}
+    d["hours"], rem = divmod(tdelta.seconds, 3600)
+    d["minutes"], d["seconds"] = divmod(rem, 60)
+    d["milliseconds"], _ = divmod(tdelta.microseconds, 1000)
+    return fmt.format(**d)
+
+
+def time_elapse(start_time, title='', debug_level='info'):
+    if debug_level == 'debug':
+        logger.debug("%s耗时: %s ", title,
+                     strf_delta(datetime.timedelta(seconds=time.time() - start_time),
+                                "{days}天{hours}小时{minutes}分{seconds}秒{milliseconds}毫秒"))
+    else:
+        logger.info("%s耗时: %s ", title,
+                    strf_delta(datetime.timedelta(seconds=time.time() - start_time),
+                               "{days}天{hours}小时{minutes}分{seconds}秒"))
+    return time.time()
+
+
+def nowtime():
+    now = datetime.datetime.now()
+    return datetime.datetime.strftime(now, "%H:%M:%S")
+
+
+def future(date_type, unit, s_date):
+    return __date_span(date_type, unit, 1, s_date)
+
+
+def __date_span(date_type, unit, direction, s_date):
+    """
+    last('year',1,'2020.1.3')=> '2019.1.3'
+    :param unit:
+    :param date_type: year|month|day
+    :return:
+    """
+    the_date = str2date(s_date)
+    if date_type == 'year':
+        return date2str(the_date + relativedelta(years=unit) * direction)
+    elif date_type == 'month':
+        return date2str(the_date + relativedelta(months=unit) * direction)
+    elif date_type == 'week':
+        return date2str(the_date + relativedelta(weeks=unit) * direction)
+    elif date_type == 'day':
+        return date2str(the_date + relativedelta(days=unit) * direction)
+    else:
+        raise ValueError(f"无法识别的date_type:{date_type}")
+
+
+def date2str(date, format="%Y%m%d"):
+    return datetime.datetime.strftime(date, format)
+
+
+def init_logger(file=False, simple=False, log_level=logging.DEBUG):
+    print("开始初始化日志：file=%r, simple=%r" % (file, simple))
+
+    logging.getLogger("requests").setLevel(logging.WARNING)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+    logging.getLogger('matplotlib.font_manager').disabled = True
+    logging.getLogger('matplotlib.colorbar').disabled = True
+    logging.getLogger('matplotlib').disabled = True
+    logging.getLogger('fontTools.ttLib.ttFont').disabled = True
+    logging.getLogger('PIL').setLevel(logging.WARNING)
+    warnings.filterwarnings("ignore")
+    warnings.filterwarnings("ignore", module="matplotlib")
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+    if simple:
+        formatter = logging.Formatter('%(message)s')
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d P%(process)d: %(message)s')
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level=log_level)
+
+    def is_any_handler(handlers, cls):
+        for t in handlers:
+            if type(t) == cls: return True
+        return False
+
+    # 加入控制台
+    if not is_any_handler(root_logger.handlers, logging.StreamHandler):
+        stream_handler = logging.StreamHandler()
+        root_logger.addHandler(stream_handler)
+        print("日志：创建控制台处理器")
+
+    # 加入日志文件
+    if file and not is_any_handler(root_logger.handlers, logging.FileHandler):
+        if not os.path.exists("./logs"): os.makedirs("./logs")
+        filename = "./logs/{}.log".format(time.strftime('%Y%m%d%H%M', time.localtime(time.time())))
+        t_handler = logging.FileHandler(filename, encoding='utf-8')
+        root_logger.addHandler(t_handler)
+        print("日志：创建文件处理器", filename)
+
+    handlers = root_logger.handlers
+    for handler in handlers:
+        handler.setLevel(level=log_level)
+        handler.setFormatter(formatter)
+
+
+def logging_time(title=''):
+    """
+    一个包装器，用于记录函数耗时，
+    同时把耗时、内存、行数记录到运行报告里（参考：mlstock.utils.instrument）
+    """
+
+    def decorate(func):
+        instrumented_func = instrument.instrumented(title if title else None)(func)
+
+        def wrapper_it(*args, **kw):
+            start_time = time.time()
+            result = instrumented_func(*args, **kw)
+            time_elapse(start_time, title, 'debug')
+            return result
+
+        return wrapper_it
+
+    return decorate
+
+
+def check_file_path(file_path):
+    if not os.path.exists(file_path):
+        msg = f"文件[{file_path}]不存在！"
+        logger.error(msg)
+        raise ValueError(msg)
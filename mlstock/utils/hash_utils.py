@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+
+"""
+内容哈希的工具，用于判断数据/模型等产出物是否发生了变化，
+pipeline靠它来决定某个阶段是否需要重新运行。
+"""
+
+CHUNK_SIZE = 1 << 20  # 每次读1M
+
+
+def hash_file(file_path):
+    """
+    计算文件内容的sha1，分块读，防止大文件（几个G的因子数据）撑爆内存
+    :param file_path: 文件路径
+    :return: 16进制的哈希字符串
+    """
+    if not os.path.exists(file_path):
+        raise ValueError(f"文件[{file_path}]不存在，无法计算哈希")
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk: break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def hash_files(file_paths):
+    """多个文件合起来算一个哈希（顺序相关）"""
+    sha1 = hashlib.sha1()
+    for file_path in file_paths:
+        sha1.update(hash_file(file_path).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def hash_object(obj):
+    """
+    对参数字典、列表等可以json化的对象，计算哈希，
+    key排序，保证同样内容的字典得到同样的哈希
+    """
+    s = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
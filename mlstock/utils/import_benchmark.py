@@ -0,0 +1,110 @@
+import argparse
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from mlstock.utils import core
+
+logger = logging.getLogger(__name__)
+
+"""
+命令行入口的启动耗时的基准测试。
+
+每次都起一个新的python进程(模块缓存是空的)：
+    - 跑 python -m 模块 --help 若干次，取中位数，就是命令行启动(还没干活)的耗时
+    - 用 python -X importtime 找出import最慢的那些包(累计耗时)，看看是谁拖慢了启动
+
+重的依赖(backtrader、matplotlib、statsmodels、talib、xgboost、数据库等)应该推迟到用到它们的函数里才import，
+utils里的日期、日志、计时的函数在mlstock.utils.core里，不依赖这些重的包。
+"""
+
+MODULES = ['mlstock.ml.train',
+           'mlstock.ml.evaluate',
+           'mlstock.ml.backtest',
+           'mlstock.ml.pipeline']
+REPEAT = 5
+TOP = 15  # 显示import最慢的包的个数
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _run(args):
+    """
+    在临时目录里起子进程：命令行入口一启动就会在当前目录下建logs/<时间>.log，不能留在调用方的目录里，
+    所以把项目目录放到PYTHONPATH里，保证临时目录里也能import mlstock
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [PROJECT_ROOT, env.get('PYTHONPATH')]))
+    with tempfile.TemporaryDirectory() as cwd:
+        return subprocess.run(args, capture_output=True, text=True, cwd=cwd, env=env)
+
+
+def time_command(module, repeat=REPEAT):
+    """
+    :return: 每次 python -m module --help 的耗时(秒)
+    """
+    elapsed = []
+    for _ in range(repeat):
+        start_time = time.time()
+        result = _run([sys.executable, '-m', module, '--help'])
+        elapsed.append(time.time() - start_time)
+        if result.returncode != 0:
+            raise ValueError(f"运行[python -m {module} --help]失败：\n{result.stderr}")
+    return elapsed
+
+
+def slowest_imports(module, top=TOP):
+    """
+    用 -X importtime 统计import module时，累计耗时最多的包
+    :return: [(累计耗时(毫秒), 包名)]，从慢到快
+    """
+    result = _run([sys.executable, '-X', 'importtime', '-c', f'import {module}'])
+    if result.returncode != 0: raise ValueError(f"import [{module}]失败：\n{result.stderr}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        # 格式：import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main(modules, repeat=REPEAT, top=TOP, budget=None):
+    """
+    :param budget: 启动耗时的上限(秒)，中位数超过它的模块会列出来
+    :return: {模块: 中位数耗时}
+    """
+    results = {}
+    for module in modules:
+        elapsed = time_command(module, repeat)
+        results[module] = statistics.median(elapsed)
+        logger.info("python -m %s --help：中位数%.3f秒，最快%.3f秒，最慢%.3f秒(%d次)",
+                    module, results[module], min(elapsed), max(elapsed), repeat)
+        logger.info("import最慢的%d个包(累计毫秒)：\n%s", top,
+                    "\n".join(f"{ms:10.1f}  {name}" for ms, name in slowest_imports(module, top)))
+
+    if budget:
+        slow = {module: seconds for module, seconds in results.items() if seconds > budget}
+        if slow: logger.warning("启动耗时超过%.2f秒的入口：%r", budget, slow)
+    return results
+
+
+"""
+python -m mlstock.utils.import_benchmark
+
+python -m mlstock.utils.import_benchmark -m mlstock.ml.train -r 10 -b 1
+"""
+if __name__ == '__main__':
+    core.init_logger(simple=True, log_level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--modules', type=str, default=None, help="要测试的模块，逗号分隔，默认为几个主要的命令行入口")
+    parser.add_argument('-r', '--repeat', type=int, default=REPEAT, help="每个模块启动的次数")
+    parser.add_argument('-t', '--top', type=int, default=TOP, help="显示import最慢的包的个数")
+    parser.add_argument('-b', '--budget', type=float, default=None, help="启动耗时的上限(秒)")
+    args = parser.parse_args()
+
+    main(args.modules.split(",") if args.modules else MODULES, args.repeat, args.top, args.budget)
@@ -0,0 +1,233 @@
+import cProfile
+import datetime
+import functools
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+"""
+结构化的埋点：记录每个阶段、每个因子的
+    - 墙上时间(wall)、CPU时间
+    - 阶段前后的RSS，和阶段结束时进程至今的峰值内存(ru_maxrss，不是阶段内的峰值，阶段内的峰值看tracemalloc)
+    - tracemalloc的内存增量和阶段内峰值（需要configure(trace_memory=True)打开，会拖慢一些）
+    - 输入、输出的行数
+结果汇总成一个json的运行报告（logs/run_report_<时间戳>.json），方便不同的运行之间做比较，
+之前utils.logging_time/time_elapse只在日志里打一行中文的耗时，没法比较，也看不出内存峰值在哪里。
+
+用法：
+    with instrument.stage('clean', rows_in=len(df)) as record:
+        df = clean(df)
+        record.rows_out = len(df)
+
+    @instrument.instrumented('TTM计算')
+    def ttm(df): ...
+
+    instrument.configure(trace_memory=True, profile_stages=['clean'])  # clean阶段额外dump一个cProfile文件
+    instrument.save_report()
+"""
+
+REPORT_DIR = "./logs"
+PROFILE_DIR = "./logs/profile"
+
+
+class StageRecord:
+    """一个阶段的埋点记录"""
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.start = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.rss_start_mb = None
+        self.rss_end_mb = None
+        self.process_peak_rss_mb = None  # 阶段结束时，进程至今的峰值RSS
+        self.traced_delta_mb = None
+        self.traced_peak_mb = None
+        self.profile_path = None
+        self.error = None
+        self._traced_start = None
+        self._traced_peak_seen = 0
+
+    def to_dict(self):
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+
+
+class _Config:
+    trace_memory = False
+    profile_stages = set()
+
+
+_config = _Config()
+_records = []  # 所有完成的记录，按完成顺序
+_stack = []  # 正在进行中的阶段，用于拼出嵌套的名字：pipeline/clean
+_started = datetime.datetime.now()
+
+
+def configure(trace_memory=False, profile_stages=None):
+    """
+    :param trace_memory: 是否用tracemalloc跟踪python对象的内存分配，有性能损失，默认关闭
+    :param profile_stages: 需要额外做cProfile的阶段名列表（只匹配阶段自己的名字，不含父阶段前缀）
+    """
+    _config.trace_memory = trace_memory
+    _config.profile_stages = set(profile_stages) if profile_stages else set()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def _rss_mb():
+    """当前的RSS，只在linux下可以拿到（/proc），其他平台返回None"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss_mb():
+    """进程至今的峰值RSS，linux下ru_maxrss单位是KB，mac下是字节"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': return peak / 1024 / 1024
+    return peak / 1024
+
+
+class stage:
+    """
+    埋点的上下文管理器，可以嵌套，嵌套的阶段名字会带上父阶段的前缀
+    """
+
+    def __init__(self, name, rows_in=None):
+        self.short_name = name
+        self.record = None
+        self.rows_in = rows_in
+        self._profiler = None
+
+    def __enter__(self):
+        full_name = "/".join([s.short_name for s in _stack] + [self.short_name])
+        record = StageRecord(full_name, self.rows_in)
+        self.record = record
+
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            # 子阶段要reset峰值，所以先把父阶段到目前为止的峰值记下来
+            if _stack: _stack[-1].record._traced_peak_seen = max(_stack[-1].record._traced_peak_seen, peak)
+            if hasattr(tracemalloc, 'reset_peak'): tracemalloc.reset_peak()
+            record._traced_start = current
+
+        if self.short_name in _config.profile_stages:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+        _stack.append(self)
+        record.rss_start_mb = _rss_mb()
+        record.start = datetime.datetime.now().isoformat()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return record
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        record = self.record
+        record.wall_seconds = time.perf_counter() - self._wall
+        record.cpu_seconds = time.process_time() - self._cpu
+        record.rss_end_mb = _rss_mb()
+        record.process_peak_rss_mb = _peak_rss_mb()
+        if exc_type is not None: record.error = f"{exc_type.__name__}: {exc_val}"
+        _stack.pop()
+
+        if self._profiler is not None:
+            self._profiler.disable()
+            if not os.path.exists(PROFILE_DIR): os.makedirs(PROFILE_DIR)
+            record.profile_path = os.path.join(
+                PROFILE_DIR, "{}_{}.prof".format(record.name.replace('/', '.'), time.strftime('%Y%m%d%H%M%S')))
+            self._profiler.dump_stats(record.profile_path)
+
+        if tracemalloc.is_tracing() and record._traced_start is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, record._traced_peak_seen)
+            record.traced_delta_mb = (current - record._traced_start) / 1024 / 1024
+            record.traced_peak_mb = (peak - record._traced_start) / 1024 / 1024
+            if _stack: _stack[-1].record._traced_peak_seen = max(_stack[-1].record._traced_peak_seen, peak)
+
+        _records.append(record)
+        logger.debug("[埋点] %s: wall %.3f秒, cpu %.3f秒, RSS %s=>%s MB(进程峰值%s MB), 行数 %s=>%s",
+                     record.name, record.wall_seconds, record.cpu_seconds,
+                     "%.0f" % record.rss_start_mb if record.rss_start_mb else "-",
+                     "%.0f" % record.rss_end_mb if record.rss_end_mb else "-",
+                     "%.0f" % record.process_peak_rss_mb if record.process_peak_rss_mb else "-",
+                     record.rows_in, record.rows_out)
+        return False  # 异常照常往外抛
+
+
+def _rows_of(obj):
+    """DataFrame/ndarray返回行数，tuple则看第一个元素，其他返回None"""
+    if isinstance(obj, tuple) and len(obj) > 0: obj = obj[0]
+    shape = getattr(obj, 'shape', None)
+    if shape is not None and len(shape) > 0: return shape[0]
+    return None
+
+
+def instrumented(name=None):
+    """
+    埋点的装饰器，自动记录第一个带shape参数的行数，和返回值的行数
+    """
+
+    def decorate(func):
+        stage_name = name if name else func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper_it(*args, **kw):
+            rows_in = None
+            for arg in list(args) + list(kw.values()):
+                rows_in = _rows_of(arg)
+                if rows_in is not None: break
+            with stage(stage_name, rows_in) as record:
+                result = func(*args, **kw)
+                record.rows_out = _rows_of(result)
+            return result
+
+        return wrapper_it
+
+    return decorate
+
+
+def records():
+    return [r.to_dict() for r in _records]
+
+
+def reset():
+    _records.clear()
+
+
+def save_report(path=None, extra=None):
+    """
+    把所有的埋点记录保存成json运行报告
+    :param path: 报告路径，默认 logs/run_report_<时间戳>.json
+    :param extra: 额外要保存的信息，比如运行参数
+    :return: 报告路径
+    """
+    if path is None:
+        if not os.path.exists(REPORT_DIR): os.makedirs(REPORT_DIR)
+        path = os.path.join(REPORT_DIR, "run_report_{}.json".format(time.strftime('%Y%m%d%H%M%S')))
+    report = {
+        'started': _started.isoformat(),
+        'finished': datetime.datetime.now().isoformat(),
+        'argv': sys.argv,
+        'process_peak_rss_mb': _peak_rss_mb(),
+        'extra': extra if extra else {},
+        'stages': records()
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4, default=str)
+    logger.info("运行报告(%d条埋点)保存到：%s", len(_records), path)
+    return path
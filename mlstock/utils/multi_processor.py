@@ -1,50 +1,261 @@
+import functools
+import heapq
 import logging
+import os
 import time
-from multiprocessing import Process
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
+"""
+多进程/多线程的处理器
+
+之前的execute是直接起Process，结果丢弃，参数里的stocks是塞到一个共享的dict里，只能靠join知道完成，
+子进程的异常也传不回来。现在改成了基于concurrent.futures的Executor：
+    - execute：按股票(by列)把DataFrame切成shard，切分是按照"行数"均衡，而不是按照股票个数，
+      因为不同股票的数据量差别很大（新股 vs 老股），按个数切会导致某个进程特别慢
+    - map：一组任务（如参数组合、因子名），共享同一批只读的大DataFrame
+    - 大的DataFrame放到共享内存（SharedFrame）里，子进程直接映射，不用pickle通过管道传一遍
+    - 收集每个任务的返回值（DataFrame会拼接起来），子进程的异常会在主进程中重新抛出
+    - 用tqdm显示进度
+    - mode='thread'|'process'，numpy/pandas里释放GIL的计算用线程就够了，省去进程启动和数据拷贝
+"""
+
 
-# 把任务平分到每个work进程中，多余的放到最后一个进程，10=>[3,3,4], 11=>[4,4,3]，原则是尽量均衡
 def split(_list, n):
+    """把任务平分到每个work进程中，多余的放到前面的进程，10=>[4,3,3], 11=>[4,4,3]，原则是尽量均衡"""
     k, m = divmod(len(_list), n)
     return (_list[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n))
 
 
+def balanced_shards(sizes, shard_num):
+    """
+    按照大小均衡的切分：从大到小，每次把一个分组放到当前合计最小的shard里（LPT贪心算法）
+    :param sizes: pd.Series，index是分组的key（如ts_code），value是行数
+    :param shard_num: shard个数
+    :return: pd.Series，index是分组的key，value是shard的序号
+    """
+    heap = [(0, i) for i in range(shard_num)]
+    assignment = {}
+    for key, size in sizes.sort_values(ascending=False).items():
+        total, shard_id = heapq.heappop(heap)
+        assignment[key] = shard_id
+        heapq.heappush(heap, (total + size, shard_id))
+    return pd.Series(assignment)
+
+
+class SharedFrame:
+    """
+    把DataFrame放到共享内存里，只读共享给子进程：
+    - 数值列，直接把numpy数组拷贝到共享内存
+    - 其他列（如ts_code、trade_date字符串），先factorize编码，编码放到共享内存，去重后的值随描述信息pickle过去
+    注意：不保留索引
+    """
+
+    def __init__(self, df):
+        self.blocks = []
+        self.columns = []
+        self.length = len(df)
+        for column in df.columns:
+            series = df[column]
+            if isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biufc':
+                values, uniques = series.to_numpy(), None
+            else:
+                values, uniques = pd.factorize(series, sort=False)
+            shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+            self.blocks.append(shm)
+            self.columns.append((column, shm.name, values.dtype.str, uniques))
+
+    def descriptor(self):
+        """传给子进程的描述信息，子进程用SharedFrame.attach还原DataFrame"""
+        return {'length': self.length, 'columns': self.columns}
+
+    @staticmethod
+    def attach(descriptor):
+        """
+        在子进程中映射共享内存，还原DataFrame，数值列是零拷贝的
+        :return: (DataFrame, 打开的SharedMemory列表)，后者要一直持有，否则映射会失效
+        """
+        data = {}
+        blocks = []
+        for column, name, dtype, uniques in descriptor['columns']:
+            shm = shared_memory.SharedMemory(name=name)
+            blocks.append(shm)
+            values = np.ndarray((descriptor['length'],), dtype=np.dtype(dtype), buffer=shm.buf)
+            if uniques is not None:
+                # factorize把NA编码成-1
+                codes = values
+                values = np.asarray(uniques, dtype=object).take(np.where(codes < 0, 0, codes)) \
+                    if len(uniques) > 0 else np.empty(len(codes), dtype=object)
+                values[codes < 0] = None
+                if uniques.dtype != object: values = pd.Series(values, dtype=object).astype(uniques.dtype)
+            data[column] = values
+        return pd.DataFrame(data, copy=False), blocks
+
+    def close(self):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+
+# 子进程中的共享数据：{名字: DataFrame}，由进程池的initializer在每个子进程里初始化一次
+_worker_shared = {}
+_worker_blocks = []
+
+
+def _init_worker(descriptors):
+    for name, descriptor in descriptors.items():
+        df, blocks = SharedFrame.attach(descriptor)
+        _worker_shared[name] = df
+        _worker_blocks.extend(blocks)
+
+
+def _run_task(function, task, params):
+    return function(task, **_worker_shared, **params)
+
+
+def _run_shard(function, start, end, params):
+    df = _worker_shared['df'].iloc[start:end].copy()  # 拷贝出自己那一段，防止误改共享内存
+    return function(df, **params)
+
+
+class Executor:
+
+    def __init__(self, worker_num=None, mode='process', progress=True):
+        """
+        :param worker_num: 工作进程/线程数，默认为CPU核数
+        :param mode: process | thread
+        :param progress: 是否显示进度条
+        """
+        if mode not in ['process', 'thread']:
+            raise ValueError(f"无效的执行模式：{mode}，必须是process或thread")
+        self.worker_num = worker_num if worker_num else os.cpu_count()
+        self.mode = mode
+        self.progress = progress
+
+    def map(self, function, tasks, shared=None, **params):
+        """
+        并行执行 function(task, **shared, **params)，每个task一次
+        :param function: 执行函数，process模式下必须是模块级的函数（要能pickle）
+        :param tasks: 任务列表
+        :param shared: {参数名: DataFrame}，所有任务共享的只读大数据，process模式下通过共享内存传递
+        :param params: 其他的参数，会pickle传给每个任务
+        :return: 和tasks顺序一致的结果列表
+        """
+        tasks = list(tasks)
+        shared = shared if shared else {}
+        start_time = time.time()
+
+        if self.mode == 'thread':
+            with ThreadPoolExecutor(max_workers=self.worker_num) as pool:
+                futures = {pool.submit(function, task, **shared, **params): i for i, task in enumerate(tasks)}
+                results = self._collect(futures, len(tasks))
+        else:
+            shared_frames = {name: SharedFrame(df) for name, df in shared.items()}
+            try:
+                descriptors = {name: sf.descriptor() for name, sf in shared_frames.items()}
+                with ProcessPoolExecutor(max_workers=self.worker_num,
+                                         initializer=_init_worker,
+                                         initargs=(descriptors,)) as pool:
+                    futures = {pool.submit(_run_task, function, task, params): i for i, task in enumerate(tasks)}
+                    results = self._collect(futures, len(tasks))
+            finally:
+                for sf in shared_frames.values(): sf.close()
+
+        logger.info("%d个工作%s运行完毕，处理[%d]个任务，耗时: %.1f 秒",
+                    self.worker_num, "进程" if self.mode == 'process' else "线程", len(tasks), time.time() - start_time)
+        return results
+
+    def execute(self, df, function, by='ts_code', shard_num=None, **params):
+        """
+        按照by列（默认股票）把df切成行数均衡的shard，并行执行 function(df_shard, **params)，
+        同一只股票的数据一定在同一个shard里
+        :param df: 要处理的数据
+        :param function: 执行函数，返回DataFrame（会被拼接）或者其他值（返回列表）
+        :param by: 分组的列
+        :param shard_num: shard个数，默认为工作进程数
+        :return: 拼接后的DataFrame，或者，各个shard的返回值的列表
+        """
+        shard_num = shard_num if shard_num else self.worker_num
+        # groupby会丢掉by为NaN的行，这些行分不到shard里，直接报错，由调用方决定怎么处理
+        nan_num = df[by].isna().sum()
+        if nan_num > 0: raise ValueError(f"分组列[{by}]有{nan_num}行是NaN，无法分配shard，请先剔除或填充")
+        sizes = df.groupby(by, sort=False).size()
+        shard_num = min(shard_num, len(sizes))
+        if shard_num == 0: return []
+        shard_of_key = balanced_shards(sizes, shard_num)
+        row_shards = df[by].map(shard_of_key).to_numpy()
+
+        # 按shard排序，这样每个shard就是连续的一段，子进程按[start,end)取自己的数据
+        order = np.argsort(row_shards, kind='stable')
+        df = df.iloc[order].reset_index(drop=True)
+        counts = np.bincount(row_shards, minlength=shard_num)
+        bounds = np.concatenate([[0], np.cumsum(counts)])
+        logger.debug("按[%s]把%d行数据切成%d个shard，每个shard的行数：%r", by, len(df), shard_num, counts.tolist())
+
+        start_time = time.time()
+        if self.mode == 'thread':
+            with ThreadPoolExecutor(max_workers=self.worker_num) as pool:
+                futures = {pool.submit(function, df.iloc[bounds[i]:bounds[i + 1]], **params): i
+                           for i in range(shard_num)}
+                results = self._collect(futures, shard_num)
+        else:
+            shared_frame = SharedFrame(df)
+            try:
+                with ProcessPoolExecutor(max_workers=self.worker_num,
+                                         initializer=_init_worker,
+                                         initargs=({'df': shared_frame.descriptor()},)) as pool:
+                    futures = {pool.submit(_run_shard, function, bounds[i], bounds[i + 1], params): i
+                               for i in range(shard_num)}
+                    results = self._collect(futures, shard_num)
+            finally:
+                shared_frame.close()
+
+        logger.info("%d个shard处理完毕，处理[%d]行数据，耗时: %.1f 秒", shard_num, len(df), time.time() - start_time)
+        if all(isinstance(r, pd.DataFrame) for r in results):
+            return pd.concat(results, ignore_index=True)
+        return results
+
+    def _collect(self, futures, total):
+        """按完成顺序收集结果，显示进度，任何一个任务异常，取消剩下的，并把异常抛出"""
+        results = [None] * total
+        with tqdm(total=total, disable=not self.progress) as pbar:
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except Exception:
+                    logger.exception("第[%d]个任务执行失败，取消剩余的任务", index)
+                    for f in futures: f.cancel()
+                    raise
+                pbar.update(1)
+        return results
+
+
+def _call_with_stocks(function, stocks, **params):
+    return function(stocks=stocks, **params)
+
+
 def execute(data, worker_num, function, **params):
     """
-    多进程处理器
-    :param data_list: 数据列表，可以是list，也可以是dict（dict会被转成list[0,1])
+    多进程处理器（兼容老的接口）：把数据列表平分给worker_num个进程，调用function(stocks=分到的数据, **params)
+    :param data: 数据列表，可以是list，也可以是dict（dict会被转成list[0,1])
     :param worker_num: 启动多少个进程处理
-    :param function: 执行函数，这个函数的参数有要求，一定是 (数据：函数可以自己来约定, id, queue）
-    :return:
+    :param function: 执行函数，要能接受stocks参数
+    :return: 每个进程的返回值的列表，子进程的异常会抛出
     """
-    start = time.time()
-    producers = []
-
     # convert to list
     if type(data) == dict:
         data = [[k, v] for k, v in data.items()]
 
     assert type(data) == list, "invalid data type,must be list, you are:" + str(type(data))
 
-    split_data_list = split(data, worker_num)
-
-    for id, worker_data_list in enumerate(split_data_list):
-        params['stocks'] = worker_data_list
-        logger.debug("进程[#%d]参数：%r",id, params)
-        p = Process(target=function,kwargs=params)
-        producers.append(p)
-        p.start()
-    for p in producers:
-        p.join()  # 要等着这些子进程结束后，主进程在往下
-
-    all_seconds = time.time() - start
-    minutes = all_seconds // 60
-    seconds = all_seconds % 60
-
-    logger.info("%d个工作进程运行完毕，处理[%d]条数据，耗时: %d 分 %d 秒",
-                id+1,
-                len(data),
-                minutes,
-                seconds)
+    executor = Executor(worker_num, mode='process', progress=False)
+    return executor.map(functools.partial(_call_with_stocks, function), list(split(data, worker_num)), **params)
@@ -0,0 +1,144 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+
+logger = logging.getLogger(__name__)
+
+"""
+因子组的横截面正交化
+
+中性化之后，还有很多高度相关的因子一起喂给Ridge和XGBoost，如不同窗口的换手率收益、不同窗口的收益率、
+基本/稀释每股收益，既浪费训练的时间和内存，又让模型的系数不稳定。这里对配置好的因子组(const.ORTHOGONAL_GROUPS)，
+每个交易日(横截面)做一次正交化，正交化后组内的因子两两不相关，方差为1：
+    - gram_schmidt：按组内的顺序，第1个因子保持不变(标准化)，之后每个因子只保留不能被前面的因子解释的部分(残差)
+    - symmetric：Löwdin对称正交化，S^(-1/2)，离原始因子最近的一组正交的因子，不偏向组内的任何一个因子
+    - pca：主成分，组内第i列变成第i个主成分(按方差从大到小)，列名不变，但是含义变了
+
+做法：
+    - 每个日期的均值、协方差矩阵(k x k，k是组内因子数)用np.bincount按日期累加，不逐日的循环
+    - 所有日期的 k x k 的矩阵叠成 D x k x k，一次批量的cholesky/eigh分解出每个日期的变换矩阵T
+    - 正交化后的因子 = (X - 当天的均值)·T(当天的)
+
+fit/transform：
+    fit记下所有日期平均的横截面均值和协方差，算出一个"时间平均"的变换；
+    transform默认还是用每个日期自己的协方差，只有股票太少(少于min_rows)的日期(如预测服务只给了几只股票)，
+    才用fit出来的变换；没有trade_date列时，所有的行当作一个截面。
+
+使用：
+    orthogonalizer = FactorOrthogonalizer({'return': ['return_1w', 'return_3w']}, 'gram_schmidt').fit(df_train)
+    df_train = orthogonalizer.transform(df_train)
+"""
+
+METHODS = ['gram_schmidt', 'symmetric', 'pca']
+MIN_ROWS = 30  # 一个截面少于这么多只股票，用fit出来的变换
+EPSILON = 1e-8
+
+
+def date_covariances(X, date_codes, date_num):
+    """
+    每个日期的行数、均值、协方差(总体协方差)，按日期用bincount累加
+    :param X: 行数 x k
+    :param date_codes: 每行的日期编号(0~date_num-1)
+    :return: (行数 D，均值 D x k，协方差 D x k x k)
+    """
+    k = X.shape[1]
+    count = np.bincount(date_codes, minlength=date_num).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.stack([np.bincount(date_codes, X[:, i], date_num) for i in range(k)], axis=1) / count[:, None]
+        covs = np.empty((date_num, k, k))
+        for i in range(k):
+            for j in range(i, k):
+                cov = np.bincount(date_codes, X[:, i] * X[:, j], date_num) / count - means[:, i] * means[:, j]
+                covs[:, i, j] = covs[:, j, i] = cov
+    return count, means, covs
+
+
+def orthogonal_transforms(covs, method):
+    """
+    由协方差算出正交化的变换矩阵T，(X-均值)·T 的各列两两不相关、方差为1
+    :param covs: D x k x k(每个日期一个)，或者 k x k，一次批量的分解
+    :return: 和covs同样形状的T
+    """
+    if method not in METHODS: raise ValueError(f"无效的正交化方法：{method}，必须是{'|'.join(METHODS)}")
+    k = covs.shape[-1]
+    # 对角线加一点点，防止组内有完全共线的因子时分解失败
+    ridge = EPSILON * np.maximum(np.trace(covs, axis1=-2, axis2=-1) / k, EPSILON)
+    covs = covs + np.asarray(ridge)[..., None, None] * np.eye(k)
+
+    if method == 'gram_schmidt':
+        # S = LLᵀ，X·L⁻ᵀ 的协方差是单位阵，L⁻ᵀ是上三角的，第j列只用到前j个因子，就是按顺序的Gram-Schmidt
+        L = np.linalg.cholesky(covs)
+        return np.swapaxes(np.linalg.inv(L), -1, -2)
+
+    values, vectors = np.linalg.eigh(covs)
+    if method == 'symmetric':
+        return (vectors / np.sqrt(values)[..., None, :]) @ np.swapaxes(vectors, -1, -2)
+
+    # pca：按方差从大到小，特征向量的正负号取和组内因子之和正相关的，每个日期的方向才一致
+    values, vectors = values[..., ::-1], vectors[..., ::-1]
+    signs = np.where(vectors.sum(axis=-2, keepdims=True) < 0, -1.0, 1.0)
+    return vectors * signs / np.sqrt(values)[..., None, :]
+
+
+class FactorOrthogonalizer(BaseEstimator, TransformerMixin):
+
+    def __init__(self, groups, method='gram_schmidt', min_rows=MIN_ROWS):
+        """
+        :param groups: {组名: [因子名]}，每组单独正交化
+        :param method: gram_schmidt | symmetric | pca
+        :param min_rows: 截面的股票数少于它的日期，用fit出来的变换
+        """
+        if method not in METHODS: raise ValueError(f"无效的正交化方法：{method}，必须是{'|'.join(METHODS)}")
+        self.groups = groups
+        self.method = method
+        self.min_rows = min_rows
+        self.transforms = {}  # 组名 => (时间平均的均值，时间平均的变换矩阵)
+
+    @property
+    def factor_names(self):
+        return [name for columns in self.groups.values() for name in columns]
+
+    @staticmethod
+    def _date_codes(df):
+        if 'trade_date' not in df.columns: return np.zeros(len(df), dtype=np.int64), 1
+        codes, dates = pd.factorize(df.trade_date.values)
+        return codes, len(dates)
+
+    def fit(self, df):
+        codes, date_num = self._date_codes(df)
+        for name, columns in self.groups.items():
+            count, means, covs = date_covariances(self._values(df, columns), codes, date_num)
+            valid = count >= self.min_rows
+            if not valid.any(): valid = count > 1
+            mean, cov = means[valid].mean(axis=0), covs[valid].mean(axis=0)
+            self.transforms[name] = (mean, orthogonal_transforms(cov, self.method))
+            logger.debug("因子组[%s]%r：%d个截面，时间平均的协方差：\n%r", name, columns, valid.sum(), cov)
+        return self
+
+    def transform(self, df):
+        codes, date_num = self._date_codes(df)
+        for name, columns in self.groups.items():
+            X = self._values(df, columns)
+            count, means, covs = date_covariances(X, codes, date_num)
+            few = count < self.min_rows
+            covs[few] = np.eye(len(columns))  # 用不到，防止分解失败
+            T = orthogonal_transforms(covs, self.method)
+            if few.any():
+                if name not in self.transforms:
+                    raise ValueError(f"因子组[{name}]有股票数少于{self.min_rows}的截面，需要先fit")
+                means[few], T[few] = self.transforms[name]
+
+            X -= means[codes]
+            result = np.zeros_like(X)
+            for j in range(len(columns)):
+                for i in range(j + 1 if self.method == 'gram_schmidt' else len(columns)):
+                    result[:, j] += X[:, i] * T[codes, i, j]
+            df[columns] = result
+        return df
+
+    @staticmethod
+    def _values(df, columns):
+        # 因子是标准化过的，缺失的当作均值0
+        return np.nan_to_num(df[columns].values.astype(np.float64))
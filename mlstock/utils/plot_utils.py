@@ -0,0 +1,37 @@
+import logging
+
+import matplotlib.pyplot as plt
+from backtrader.plot import Plot_OldSync
+from backtrader_plotting.schemes import Tradimo
+
+logger = logging.getLogger(__name__)
+
+"""
+backtrader回测的画图相关的类，依赖backtrader、backtrader_plotting(Bokeh)和matplotlib，
+从utils里拆出来，只有画回测图的时候才import。
+"""
+
+
+class MyPlot(Plot_OldSync):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+    def show(self):
+        plt.savefig("debug/backtrader回测.jpg")
+
+
+class AStockPlotScheme(Tradimo):
+    """
+    自定义的bar和volumn的显示颜色，follow A股风格
+    """
+
+    def _set_params(self):
+        super()._set_params()
+        self.barup = "#FC5D45"
+        self.bardown = "#009900"
+        self.barup_wick = self.barup
+        self.bardown_wick = self.bardown
+        self.barup_outline = self.barup
+        self.bardown_outline = self.bardown
+        self.volup = self.barup
+        self.voldown = self.bardown
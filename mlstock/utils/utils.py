@@ -1,24 +1,14 @@
-import calendar
 import datetime
 import logging
 import os
-import time
-import warnings
-import numpy as np
-
-import chinese_calendar
-import matplotlib.pyplot as plt
-import pandas as pd
-import requests
+
 import yaml
-from backtrader.plot import Plot_OldSync
-from backtrader_plotting.schemes import Tradimo
-from dateutil.relativedelta import relativedelta
-from empyrical import max_drawdown
-from pandas import Series
-import statsmodels.api as sm
-from mlstock import const
 
+from mlstock import const
+# 核心的日期、日志、计时等函数放在core里(不依赖重的包)，这里导出，保持 utils.xxx 的用法
+from mlstock.utils.core import compile_stock_code, uncompile_stock_code, uncomply_code, str2date, date2str, \
+    get_monthly_duration, get_yearly_duration, duration, tomorrow, yesterday, last, last_year, last_month, last_week, \
+    last_day, today, now, strf_delta, time_elapse, nowtime, future, init_logger, logging_time, check_file_path
 
 logger = logging.getLogger(__name__)
 
@@ -40,219 +30,13 @@ class StockQuery():
         self.baseline = baseline
 
 
-def compile_stock_code(stock_code):
-    """
-    从 "600600=>600600.SH"
-    股票编码：https://zhidao.baidu.com/question/340092837.html
-    """
-    if stock_code.endswith(".SH") or stock_code.endswith(".SZ"): return stock_code
-    if stock_code.startswith("6"): return stock_code + ".SH"
-    return stock_code + ".SZ"
-
-
-def uncompile_stock_code(stock_code):
-    """
-    从 "600600.SH=>600600"
-    股票编码：https://zhidao.baidu.com/question/340092837.html
-    """
-    if not "." in stock_code: return stock_code
-    return stock_code[:stock_code.index(".")]
-
-
-def uncomply_code(func):
-    """
-    一个包装器，用于方法中包含code的参数，把股票代码的后缀去掉（tushare是带后缀的，但是服务器不带）
-    从 "600600.SH=>600600"
-    这个用于把发往服务器的代码都统一成实盘代码
-    """
-
-    def wrapper_it(*args, **kw):
-        import inspect
-        args_spec = inspect.getfullargspec(func)
-        args_names = args_spec.args
-        index = args_names.index('code') if 'code' in args_names else -1
-        if index == -1: return func(*args, **kw)
-        args = list(args)
-        args[index] = uncompile_stock_code(args[index])
-
-        args = tuple(args)
-        return func(*args, **kw)
-
-    return wrapper_it
-
-
-def str2date(s_date, format="%Y%m%d"):
-    return datetime.datetime.strptime(s_date, format)
-
-
 def str2pandasdate(s_date, format="%Y%m%d"):
+    import pandas as pd
     return pd.Timestamp(datetime.datetime.strptime(s_date, format))
 
 
-def get_monthly_duration(start_date, end_date):
-    """
-    把开始日期到结束日期，分割成每月的信息
-    比如20210301~20220515 =>
-    [   [20210301,20210331],
-        [20210401,20210430],
-        ...,
-        [20220401,20220430],
-        [20220501,20220515]
-    ]
-    """
-
-    start_date = str2date(start_date)
-    end_date = str2date(end_date)
-    years = list(range(start_date.year, end_date.year + 1))
-    scopes = []
-    for year in years:
-        if start_date.year == year:
-            start_month = start_date.month
-        else:
-            start_month = 1
-
-        if end_date.year == year:
-            end_month = end_date.month + 1
-        else:
-            end_month = 12 + 1
-
-        for month in range(start_month, end_month):
-
-            if start_date.year == year and start_date.month == month:
-                s_start_date = date2str(datetime.date(year=year, month=month, day=start_date.day))
-            else:
-                s_start_date = date2str(datetime.date(year=year, month=month, day=1))
-
-            if end_date.year == year and end_date.month == month:
-                s_end_date = date2str(datetime.date(year=year, month=month, day=end_date.day))
-            else:
-                _, last_day = calendar.monthrange(year, month)
-                s_end_date = date2str(datetime.date(year=year, month=month, day=last_day))
-
-            scopes.append([s_start_date, s_end_date])
-
-    return scopes
-
-
-def get_yearly_duration(start_date, end_date):
-    """
-    把开始日期到结束日期，分割成每年的信息
-    比如20210301~20220501 => [[20210301,20211231],[20220101,20220501]]
-    """
-    start_date = str2date(start_date)
-    end_date = str2date(end_date)
-    years = list(range(start_date.year, end_date.year + 1))
-    scopes = [[f'{year}0101', f'{year}1231'] for year in years]
-
-    if start_date.year == years[0]:
-        scopes[0][0] = date2str(start_date)
-    if end_date.year == years[-1]:
-        scopes[-1][1] = date2str(end_date)
-
-    return scopes
-
-
-def duration(start, end, unit='day'):
-    d0 = str2date(start)
-    d1 = str2date(end)
-    delta = d1 - d0
-    if unit == 'day': return delta.days
-    return None
-
-
-def tomorrow(s_date=None):
-    if s_date is None: s_date = today()
-    return future('day', 1, s_date)
-
-
-def yesterday(s_date=None):
-    if s_date is None: s_date = today()
-    return last_day(s_date, 1)
-
-
-def last(date_type, unit, s_date):
-    return __date_span(date_type, unit, -1, s_date)
-
-
-def last_year(s_date, num=1):
-    return last('year', num, s_date)
-
-
-def last_month(s_date, num=1):
-    return last('month', num, s_date)
-
-
-def last_week(s_date, num=1):
-    return last('week', num, s_date)
-
-
-def last_day(s_date, num=1):
-    return last('day', num, s_date)
-
-
-def today():
-    now = datetime.datetime.now()
-    return datetime.datetime.strftime(now, "%Y%m%d")
-
-
-def now():
-    return datetime.datetime.strftime(datetime.datetime.now(), "%Y%m%d%H%M%S")
-
-
-def strf_delta(tdelta, fmt):
-    d = {"days": tdelta.days}
-    d["hours"], rem = divmod(tdelta.seconds, 3600)
-    d["minutes"], d["seconds"] = divmod(rem, 60)
-    d["milliseconds"], _ = divmod(tdelta.microseconds, 1000)
-    return fmt.format(**d)
-
-
-def time_elapse(start_time, title='', debug_level='info'):
-    if debug_level == 'debug':
-        logger.debug("%s耗时: %s ", title,
-                     strf_delta(datetime.timedelta(seconds=time.time() - start_time),
-                                "{days}天{hours}小时{minutes}分{seconds}秒{milliseconds}毫秒"))
-    else:
-        logger.info("%s耗时: %s ", title,
-                    strf_delta(datetime.timedelta(seconds=time.time() - start_time),
-                               "{days}天{hours}小时{minutes}分{seconds}秒"))
-    return time.time()
-
-
-def nowtime():
-    now = datetime.datetime.now()
-    return datetime.datetime.strftime(now, "%H:%M:%S")
-
-
-def future(date_type, unit, s_date):
-    return __date_span(date_type, unit, 1, s_date)
-
-
-def __date_span(date_type, unit, direction, s_date):
-    """
-    last('year',1,'2020.1.3')=> '2019.1.3'
-    :param unit:
-    :param date_type: year|month|day
-    :return:
-    """
-    the_date = str2date(s_date)
-    if date_type == 'year':
-        return date2str(the_date + relativedelta(years=unit) * direction)
-    elif date_type == 'month':
-        return date2str(the_date + relativedelta(months=unit) * direction)
-    elif date_type == 'week':
-        return date2str(the_date + relativedelta(weeks=unit) * direction)
-    elif date_type == 'day':
-        return date2str(the_date + relativedelta(days=unit) * direction)
-    else:
-        raise ValueError(f"无法识别的date_type:{date_type}")
-
-
-def date2str(date, format="%Y%m%d"):
-    return datetime.datetime.strftime(date, format)
-
-
 def dataframe2series(df):
+    from pandas import Series
     if type(df) == Series: return df
     assert len(df.columns) == 1, df.columns
     return df.iloc[:, 0]
@@ -295,6 +79,7 @@ def get_holidays(from_year=2004, include_weekends=False):
     """
     获取所有节假日，默认从2004年开始,chinese_calendar只支持到2004
     """
+    import chinese_calendar
     to_year = datetime.datetime.now().year
     start = datetime.date(from_year, 1, 1)
     end = datetime.date(to_year, 12, 31)
@@ -307,6 +92,7 @@ def get_period_ohlc(df_day, date, unit=4, unit_type='W'):
     计算4周前这段时间的OHLC,
     这个必须要用day2week,day2month出来的结果，因为里面有这周的开始和结束
     """
+    import pandas as pd
 
     # 得到4周前的第一个工作日
     date_index = df_day.index
@@ -330,61 +116,6 @@ def get_period_ohlc(df_day, date, unit=4, unit_type='W'):
     return df_result
 
 
-class MyPlot(Plot_OldSync):
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-
-    def show(self):
-        plt.savefig("debug/backtrader回测.jpg")
-
-
-def init_logger(file=False, simple=False, log_level=logging.DEBUG):
-    print("开始初始化日志：file=%r, simple=%r" % (file, simple))
-
-    logging.getLogger("requests").setLevel(logging.WARNING)
-    logging.getLogger("urllib3").setLevel(logging.WARNING)
-    logging.getLogger('matplotlib.font_manager').disabled = True
-    logging.getLogger('matplotlib.colorbar').disabled = True
-    logging.getLogger('matplotlib').disabled = True
-    logging.getLogger('fontTools.ttLib.ttFont').disabled = True
-    logging.getLogger('PIL').setLevel(logging.WARNING)
-    warnings.filterwarnings("ignore")
-    warnings.filterwarnings("ignore", module="matplotlib")
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
-
-    if simple:
-        formatter = logging.Formatter('%(message)s')
-    else:
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d P%(process)d: %(message)s')
-
-    root_logger = logging.getLogger()
-    root_logger.setLevel(level=log_level)
-
-    def is_any_handler(handlers, cls):
-        for t in handlers:
-            if type(t) == cls: return True
-        return False
-
-    # 加入控制台
-    if not is_any_handler(root_logger.handlers, logging.StreamHandler):
-        stream_handler = logging.StreamHandler()
-        root_logger.addHandler(stream_handler)
-        print("日志：创建控制台处理器")
-
-    # 加入日志文件
-    if file and not is_any_handler(root_logger.handlers, logging.FileHandler):
-        if not os.path.exists("./logs"): os.makedirs("./logs")
-        filename = "./logs/{}.log".format(time.strftime('%Y%m%d%H%M', time.localtime(time.time())))
-        t_handler = logging.FileHandler(filename, encoding='utf-8')
-        root_logger.addHandler(t_handler)
-        print("日志：创建文件处理器", filename)
-
-    handlers = root_logger.handlers
-    for handler in handlers:
-        handler.setLevel(level=log_level)
-        handler.setFormatter(formatter)
-
-
 def get_url(CONF,host=None, port=None, url=None, token=None):
     if host is None:
         host = CONF['broker_client']['host']
@@ -394,24 +125,8 @@ def get_url(CONF,host=None, port=None, url=None, token=None):
     return f"http://{host}:{port}/{url}?token={token}"
 
 
-class AStockPlotScheme(Tradimo):
-    """
-    自定义的bar和volumn的显示颜色，follow A股风格
-    """
-
-    def _set_params(self):
-        super()._set_params()
-        self.barup = "#FC5D45"
-        self.bardown = "#009900"
-        self.barup_wick = self.barup
-        self.bardown_wick = self.bardown
-        self.barup_outline = self.barup
-        self.bardown_outline = self.bardown
-        self.volup = self.barup
-        self.voldown = self.bardown
-
-
 def http_json_post(url, dict_msg):
+    import requests
     logger.debug("向[%s]推送消息：%r", url, dict_msg)
     headers = {'Content-Type': 'application/json'}
     response = requests.post(url, json=dict_msg, headers=headers)
@@ -421,23 +136,6 @@ def http_json_post(url, dict_msg):
     return data
 
 
-def logging_time(title=''):
-    """
-    一个包装器，用于记录函数耗时
-    """
-
-    def decorate(func):
-        def wrapper_it(*args, **kw):
-            start_time = time.time()
-            result = func(*args, **kw)
-            time_elapse(start_time, title, 'debug')
-            return result
-
-        return wrapper_it
-
-    return decorate
-
-
 def OLS(X, y):
     """
     做线性回归，返回 β0（截距）、β0（系数）和残差
@@ -446,6 +144,9 @@ def OLS(X, y):
     :param y: shape(N)
     :return:
     """
+    import numpy as np
+    import statsmodels.api as sm
+
     assert not np.isnan(X).any(), f'X序列包含nan:{X}'
     assert not np.isnan(y).any(), f'y序列包含nan:{y}'
 
@@ -457,17 +158,12 @@ def OLS(X, y):
     return results.params, results.resid
 
 
-def check_file_path(file_path):
-    if not os.path.exists(file_path):
-        msg = f"文件[{file_path}]不存在！"
-        logger.error(msg)
-        raise ValueError(msg)
-
-
 # python -m mlstock.utils.utils
 if __name__ == '__main__':
     import traceback
 
+    import numpy as np
+
     X = np.array([1, 2, 3, 4, 5, 6])
     y = np.array([0.1, 2.1, 4.5, 0.3, 2.4, 5.0])
     print(OLS(X, y))